@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Dict, List, Optional
+
+
+class Priority(IntEnum):
+    """Admission classes, lower value is served first"""
+    INTERACTIVE = 0
+    OPENING = 1
+    PROACTIVE = 2
+    IMAGE = 3
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of queued"""
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _ClassStats:
+    def __init__(self):
+        self.queued = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "deadline": 0, "evicted": 0}
+        self.wait_count = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def observe_wait(self, seconds: float):
+        self.wait_count += 1
+        self.wait_sum += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+
+class _Waiter:
+    __slots__ = ("priority", "future", "enqueued_at")
+
+    def __init__(self, priority: Priority, future: asyncio.Future):
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """Bounded concurrency budget for one upstream with priority-ordered, deadline-bound queueing"""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int = 64,
+        queue_timeouts: Optional[Dict[Priority, float]] = None,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeouts = queue_timeouts or {}
+        self.in_use = 0
+        self._heap: List = []
+        self._sequence = itertools.count()
+        self._service_time = 1.0  # EWMA of slot hold time, used for Retry-After
+        self.stats: Dict[Priority, _ClassStats] = {p: _ClassStats() for p in Priority}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(stats.queued for stats in self.stats.values())
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority):
+        """Hold one unit of upstream concurrency for the duration of the block"""
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+            self.release()
+
+    async def acquire(self, priority: Priority):
+        stats = self.stats[priority]
+        if self.in_use < self.max_concurrency and self.queue_depth == 0:
+            self.in_use += 1
+            stats.admitted += 1
+            stats.observe_wait(0.0)
+            return
+
+        if self.queue_depth >= self.max_queue and not self._evict_lower_than(priority):
+            stats.rejected["queue_full"] += 1
+            raise AdmissionRejected(429, self.retry_after(), f"{self.name} queue is full")
+
+        waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, (int(priority), next(self._sequence), waiter))
+        stats.queued += 1
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter.future),
+                timeout=self.queue_timeouts.get(priority)
+            )
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            stats.rejected["deadline"] += 1
+            raise AdmissionRejected(503, self.retry_after(), f"{self.name} queue deadline exceeded")
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        stats.admitted += 1
+        stats.observe_wait(time.monotonic() - waiter.enqueued_at)
+
+    def release(self):
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            # Hand the slot straight to the next waiter so in_use never dips and gets stolen
+            self.stats[waiter.priority].queued -= 1
+            waiter.future.set_result(None)
+            return
+        self.in_use -= 1
+
+    def retry_after(self) -> int:
+        backlog = (self.queue_depth + 1) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(backlog * self._service_time))
+
+    def snapshot(self) -> Dict:
+        return {
+            "upstream": self.name,
+            "max_concurrency": self.max_concurrency,
+            "in_use": self.in_use,
+            "queue_depth": self.queue_depth,
+            "classes": {
+                priority.name.lower(): {
+                    "queued": stats.queued,
+                    "admitted": stats.admitted,
+                    "rejected": dict(stats.rejected),
+                    "wait_seconds_avg": stats.wait_sum / stats.wait_count if stats.wait_count else 0.0,
+                    "wait_seconds_max": stats.wait_max,
+                }
+                for priority, stats in self.stats.items()
+            },
+        }
+
+    def _abandon(self, waiter: _Waiter):
+        future = waiter.future
+        if not future.done():
+            # Lazy deletion: the heap entry is skipped on release because its future is done
+            future.cancel()
+            self.stats[waiter.priority].queued -= 1
+        elif not future.cancelled() and future.exception() is None:
+            # A slot was handed over just as we gave up waiting; pass it on
+            self.release()
+
+    def _evict_lower_than(self, priority: Priority) -> bool:
+        """Shed the newest waiter of the lowest class if it ranks below priority"""
+        candidates = [
+            entry for entry in self._heap
+            if not entry[2].future.done() and entry[2].priority > priority
+        ]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda entry: (entry[0], entry[1]))[2]
+        victim.future.set_exception(
+            AdmissionRejected(429, self.retry_after(), f"{self.name} shed lower-priority request")
+        )
+        self.stats[victim.priority].queued -= 1
+        self.stats[victim.priority].rejected["evicted"] += 1
+        return True
@@ -0,0 +1,316 @@
+import base64
+import zlib
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from serialization import dumps_json, loads_json
+
+try:
+    import zstandard
+except ImportError:  # zlib is the fallback: larger buckets, same layout
+    zstandard = None
+
+ZSTD = "zstd"
+ZLIB = "zlib"
+DEFAULT_CODEC = ZSTD if zstandard is not None else ZLIB
+
+
+def utc_timestamp(moment: Optional[datetime] = None) -> str:
+    """Fixed-width ISO time, so stored timestamps compare correctly as strings"""
+    return (moment or datetime.utcnow()).isoformat(timespec="microseconds")
+
+
+def encode_cursor(read_at: str, seen: Dict[str, int]) -> str:
+    """Opaque sync cursor: when the sync read started and the last seq sent per conversation"""
+    return base64.urlsafe_b64encode(dumps_json({"t": read_at, "seen": seen})).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, Dict[str, int]]:
+    """(read_at, seen) from encode_cursor; ValueError if the cursor was not one of ours"""
+    try:
+        state = loads_json(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        read_at, seen = state["t"], state["seen"]
+        datetime.fromisoformat(read_at)
+    except Exception:
+        raise ValueError("Malformed sync cursor")
+    if not isinstance(seen, dict) or not all(isinstance(seq, int) for seq in seen.values()):
+        raise ValueError("Malformed sync cursor")
+    return read_at, seen
+
+
+def compress(data: bytes, codec: str, level: int) -> bytes:
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("This archive bucket is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class MemoryArchiveBackend:
+    """Per-process archive, for development and single-worker deployments"""
+
+    def __init__(self):
+        self._heads: Dict[Tuple[str, str], Dict] = {}
+        self._buckets: Dict[Tuple[str, str], List[Dict]] = {}
+
+    async def append(self, key: Tuple[str, str], user_id: str, conversation_id: str, messages: List[Dict], now: str) -> Dict:
+        head = self._heads.get(key)
+        if head is None:
+            head = self._heads[key] = {
+                "_id": key,
+                "user_id": user_id,
+                "conversation_id": conversation_id,
+                "hot": [],
+                "hot_start": 0,
+                "cold_bytes": 0,
+                "cold_raw_bytes": 0,
+                "created_at": now,
+            }
+        head["hot"].extend(messages)
+        head["updated_at"] = now
+        return {**head, "hot": list(head["hot"])}
+
+    async def get(self, key: Tuple[str, str]) -> Optional[Dict]:
+        head = self._heads.get(key)
+        return {**head, "hot": list(head["hot"])} if head else None
+
+    async def put_bucket(self, key: Tuple[str, str], bucket: Dict):
+        buckets = self._buckets.setdefault(key, [])
+        if not buckets or buckets[-1]["first_seq"] < bucket["first_seq"]:
+            buckets.append(bucket)
+
+    async def drop_hot(self, key: Tuple[str, str], first_seq: int, bucket: Dict) -> bool:
+        head = self._heads[key]
+        if head["hot_start"] != first_seq:
+            return False
+        del head["hot"][:bucket["count"]]
+        head["hot_start"] += bucket["count"]
+        head["cold_bytes"] += len(bucket["data"])
+        head["cold_raw_bytes"] += bucket["raw_bytes"]
+        return True
+
+    async def buckets(self, key: Tuple[str, str], before_seq: int, after_seq: int, received_after: Optional[str]) -> AsyncIterator[Dict]:
+        for bucket in self._buckets.get(key, []):
+            if bucket["first_seq"] >= before_seq:
+                break
+            if bucket["last_seq"] > after_seq and (received_after is None or bucket["last_received_at"] > received_after):
+                yield bucket
+
+    async def changed(self, user_id: str, since: str) -> List[Dict]:
+        return [
+            {**head, "hot": list(head["hot"])}
+            for head in self._heads.values()
+            if head["user_id"] == user_id and head["updated_at"] > since
+        ]
+
+
+class MongoArchiveBackend:
+    """Heads (metadata plus hot messages) in one collection, compressed buckets in another.
+
+    A head's _id is the document {"user", "conversation"}, so no id can collide with another
+    user's whatever characters it contains; a bucket's _id adds its first_seq.
+    """
+
+    def __init__(self, heads, buckets):
+        self.heads = heads
+        self.bucket_collection = buckets
+
+    @staticmethod
+    def document_id(key: Tuple[str, str]) -> Dict:
+        return {"user": key[0], "conversation": key[1]}
+
+    async def ensure_indexes(self):
+        await self.heads.create_index([("user_id", 1), ("updated_at", 1)])
+        await self.bucket_collection.create_index([("conversation", 1), ("first_seq", 1)])
+
+    async def append(self, key: Tuple[str, str], user_id: str, conversation_id: str, messages: List[Dict], now: str) -> Dict:
+        from pymongo import ReturnDocument
+
+        # One atomic update, so hot_start + len(hot) always counts every message ever appended
+        return await self.heads.find_one_and_update(
+            {"_id": self.document_id(key)},
+            {
+                "$push": {"hot": {"$each": messages}},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {
+                    "user_id": user_id,
+                    "conversation_id": conversation_id,
+                    "hot_start": 0,
+                    "cold_bytes": 0,
+                    "cold_raw_bytes": 0,
+                    "created_at": now,
+                },
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def get(self, key: Tuple[str, str]) -> Optional[Dict]:
+        return await self.heads.find_one({"_id": self.document_id(key)})
+
+    async def put_bucket(self, key: Tuple[str, str], bucket: Dict):
+        # Keyed by position, so two workers compacting the same messages write the same document
+        document_id = self.document_id(key)
+        await self.bucket_collection.replace_one(
+            {"_id": {**document_id, "first_seq": bucket["first_seq"]}},
+            {**bucket, "conversation": document_id},
+            upsert=True,
+        )
+
+    async def drop_hot(self, key: Tuple[str, str], first_seq: int, bucket: Dict) -> bool:
+        # A pipeline update slices off exactly the archived messages, whatever was appended meanwhile
+        result = await self.heads.update_one(
+            {"_id": self.document_id(key), "hot_start": first_seq},
+            [{"$set": {
+                "hot": {"$slice": ["$hot", bucket["count"], {"$max": [{"$size": "$hot"}, 1]}]},
+                "hot_start": {"$add": ["$hot_start", bucket["count"]]},
+                "cold_bytes": {"$add": ["$cold_bytes", len(bucket["data"])]},
+                "cold_raw_bytes": {"$add": ["$cold_raw_bytes", bucket["raw_bytes"]]},
+            }}],
+        )
+        return result.modified_count == 1
+
+    async def buckets(self, key: Tuple[str, str], before_seq: int, after_seq: int, received_after: Optional[str]) -> AsyncIterator[Dict]:
+        query = {"conversation": self.document_id(key), "first_seq": {"$lt": before_seq}, "last_seq": {"$gt": after_seq}}
+        if received_after is not None:
+            query["last_received_at"] = {"$gt": received_after}
+        async for bucket in self.bucket_collection.find(query).sort("first_seq", 1):
+            yield bucket
+
+    async def changed(self, user_id: str, since: str) -> List[Dict]:
+        return await self.heads.find({"user_id": user_id, "updated_at": {"$gt": since}}).to_list(length=None)
+
+
+class ConversationArchive:
+    """Append-only conversation histories: recent messages hot, older ones in compressed buckets.
+
+    A message's seq is its position in the conversation. The head document keeps the hot tail
+    from hot_start on; once it holds a full bucket beyond hot_messages, the oldest
+    bucket_messages are written out as one compressed NDJSON document and dropped from the head.
+    """
+
+    def __init__(
+        self,
+        backend,
+        hot_messages: int = 50,
+        bucket_messages: int = 100,
+        codec: str = DEFAULT_CODEC,
+        level: int = 9,
+        sync_overlap_seconds: float = 60.0,
+    ):
+        self.backend = backend
+        self.hot_messages = hot_messages
+        self.bucket_messages = bucket_messages
+        self.codec = codec
+        self.level = level
+        self.sync_overlap_seconds = sync_overlap_seconds
+
+    @staticmethod
+    def key(user_id: str, conversation_id: str) -> Tuple[str, str]:
+        return user_id, conversation_id
+
+    async def append(self, user_id: str, conversation_id: str, messages: List[Dict]) -> Dict:
+        """Store messages ({"role", "content", "timestamp"}) and return the seqs they were given"""
+        key = self.key(user_id, conversation_id)
+        now = utc_timestamp()
+        stored = [{**message, "received_at": now} for message in messages]
+        head = await self.backend.append(key, user_id, conversation_id, stored, now)
+        last_seq = head["hot_start"] + len(head["hot"]) - 1
+        if len(head["hot"]) >= self.hot_messages + self.bucket_messages:
+            await self._compact(key, head)
+        return {
+            "conversation_id": conversation_id,
+            "first_seq": last_seq - len(stored) + 1,
+            "last_seq": last_seq,
+            "received_at": now,
+        }
+
+    async def _compact(self, key: Tuple[str, str], head: Dict):
+        hot, hot_start = head["hot"], head["hot_start"]
+        while len(hot) - self.hot_messages >= self.bucket_messages:
+            bucket = self.pack(hot_start, hot[:self.bucket_messages])
+            await self.backend.put_bucket(key, bucket)
+            if not await self.backend.drop_hot(key, hot_start, bucket):
+                return  # another request compacted these first
+            hot, hot_start = hot[self.bucket_messages:], hot_start + self.bucket_messages
+
+    def pack(self, first_seq: int, messages: List[Dict]) -> Dict:
+        raw = b"\n".join(dumps_json(message) for message in messages)
+        return {
+            "first_seq": first_seq,
+            "last_seq": first_seq + len(messages) - 1,
+            "count": len(messages),
+            "codec": self.codec,
+            "data": compress(raw, self.codec, self.level),
+            "raw_bytes": len(raw),
+            "last_received_at": max(message["received_at"] for message in messages),
+        }
+
+    @staticmethod
+    def unpack(bucket: Dict) -> List[Dict]:
+        lines = decompress(bytes(bucket["data"]), bucket["codec"]).split(b"\n")
+        return [{**loads_json(line), "seq": bucket["first_seq"] + offset} for offset, line in enumerate(lines)]
+
+    async def head(self, user_id: str, conversation_id: str) -> Optional[Dict]:
+        return await self.backend.get(self.key(user_id, conversation_id))
+
+    async def messages(self, head: Dict, after_seq: int = -1, received_after: Optional[str] = None) -> AsyncIterator[Dict]:
+        """The conversation's messages after a seq and/or received after a time, oldest first.
+
+        Buckets are decompressed one at a time, so an export never holds the whole history.
+        Buckets are read after the head: a compaction in between shows up as an overlap, not a gap.
+        """
+        key = self.key(head["user_id"], head["conversation_id"])
+        async for bucket in self.backend.buckets(key, head["hot_start"], after_seq, received_after):
+            for message in self.unpack(bucket):
+                if message["seq"] > after_seq and (received_after is None or message["received_at"] > received_after):
+                    yield message
+        for offset, message in enumerate(head["hot"]):
+            seq = head["hot_start"] + offset
+            if seq > after_seq and (received_after is None or message["received_at"] > received_after):
+                yield {**message, "seq": seq}
+
+    async def changes(self, user_id: str, since: str, seen: Optional[Dict[str, int]] = None) -> List[Dict]:
+        """Every conversation of the user's that changed after since, with the messages the caller lacks.
+
+        A message is stamped before the write that stores it lands, so a read can miss one stamped
+        just before it started. Conversations are therefore re-read from sync_overlap_seconds
+        before since, and seen (conversation id -> last seq the caller has) drops what it already has.
+        """
+        seen = seen or {}
+        window = utc_timestamp(datetime.fromisoformat(since) - timedelta(seconds=self.sync_overlap_seconds))
+        changed = []
+        for head in await self.backend.changed(user_id, window):
+            after_seq = seen.get(head["conversation_id"])
+            if after_seq is None:
+                messages = self.messages(head, received_after=window)
+            else:
+                messages = self.messages(head, after_seq=after_seq)
+            changed.append({
+                "conversation_id": head["conversation_id"],
+                "last_seq": head["hot_start"] + len(head["hot"]) - 1,
+                "updated_at": head["updated_at"],
+                "messages": [message async for message in messages],
+            })
+        return changed
+
+    @staticmethod
+    def stats(head: Dict) -> Dict:
+        hot_bytes = sum(len(dumps_json(message)) for message in head["hot"])
+        return {
+            "conversation_id": head["conversation_id"],
+            "message_count": head["hot_start"] + len(head["hot"]),
+            "hot_messages": len(head["hot"]),
+            "hot_bytes": hot_bytes,
+            "cold_messages": head["hot_start"],
+            "cold_bytes": head["cold_bytes"],
+            "cold_raw_bytes": head["cold_raw_bytes"],
+            "created_at": head["created_at"],
+            "updated_at": head["updated_at"],
+        }
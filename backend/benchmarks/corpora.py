@@ -0,0 +1,169 @@
+import random
+
+# Deterministic corpora so runs are comparable with the stored baseline
+_rng = random.Random(1234)
+
+_FILLER = (
+    "honestly today was long but talking to you always helps, "
+    "i went for a walk by the river and thought about what you said yesterday, "
+    "work was hectic and my manager keeps moving the deadline, "
+    "do you remember the song we talked about last week, "
+)
+
+USER_MESSAGES = {
+    "short_plain": "hey, how was your day?",
+    "explicit_image": "Can you create a picture of a cozy cabin in the snowy mountains at sunset?",
+    "self_image": "I've always wondered, what do you look like? show me yourself",
+    "keywords_only": "I love art and photo walks, they help me design my week",
+    "long_plain": _FILLER * 20,
+    "long_image_at_end": _FILLER * 20 + " anyway, could you draw me a picture of a lighthouse?",
+}
+
+# Inputs that make the lazy `.*?` request patterns scan to the end from every start position
+ADVERSARIAL_MESSAGES = {
+    "repeated_verbs": "create the " * 400,
+    "repeated_nouns": "picture and " * 400,
+    "i_want_no_noun": "i want " * 600,
+}
+
+LLM_RESPONSES = {
+    "plain": "That sounds lovely! I'd have loved to walk by the river with you. " * 6,
+    "with_marker": (
+        "Of course! Here's the cabin you asked for. "
+        "[IMAGE: a cozy wooden cabin in snowy mountains at sunset, warm light in the windows] "
+        "I hope it feels as peaceful as it looks."
+    ),
+    "long_with_markers": ("Let me paint this for you. [IMAGE: a lighthouse on a cliff at dawn] " + _FILLER) * 10,
+}
+
+ADVERSARIAL_RESPONSES = {
+    "unterminated_markers": "[IMAGE: a cabin " * 500,
+}
+
+
+def make_history(length: int):
+    roles = ("user", "assistant")
+    return [
+        {"role": roles[i % 2], "content": _FILLER[: _rng.randint(40, len(_FILLER))]}
+        for i in range(length)
+    ]
+
+
+def make_custom_personalities(count: int):
+    return [
+        {
+            "id": f"custom_{i}",
+            "name": f"Persona {i}",
+            "prompt": "A gaming enthusiast who loves anime and late-night study sessions. " * 3,
+            "scenario": "You met at a board game cafe and have been texting ever since." if i % 3 else "",
+            "customImage": None,
+        }
+        for i in range(count)
+    ]
+
+
+HISTORIES = {
+    "short": make_history(6),
+    "long": make_history(200),
+}
+
+CUSTOM_PERSONALITIES = {
+    "few": make_custom_personalities(5),
+    "many": make_custom_personalities(2000),
+}
+
+
+def make_chat_payload(image_bytes: int) -> dict:
+    """A ChatResponse payload as complete_chat_turn builds it, with raw image bytes"""
+    image = _rng.randbytes(image_bytes) if image_bytes else None
+    images = []
+    if image:
+        image_id = "274b79347ff9c6411154d8e4680aa12f"
+        images.append({
+            "prompt": "a cozy cabin in the snowy mountains at sunset",
+            "image": image,
+            "mime_type": "image/webp",
+            "image_id": image_id,
+            "variants": {name: f"/api/images/{image_id}/{name}" for name in ("thumb", "chat", "full")},
+            "quality": "hd",
+            "job_id": None,
+        })
+    return {
+        "response": LLM_RESPONSES["plain"],
+        "personality_used": "lover",
+        "timestamp": "2026-01-01T12:00:00",
+        "image": image,
+        "image_prompt": images[0]["prompt"] if images else None,
+        "images": images,
+    }
+
+
+def make_catalog_page(count: int):
+    """A /api/personalities/public page; every fourth card has an uploaded avatar (a data URL)"""
+    avatar = "data:image/png;base64," + "iVBORw0KGgoAAAANSUhEUgAA" * 700
+    return {
+        "personalities": [
+            {
+                "id": f"public_{i}",
+                "name": f"Persona {i}",
+                "description": "A warm, curious companion who loves stories and late-night talks.",
+                "scenario": "You met at a night market and kept talking until closing time.",
+                "emoji": "🌙",
+                "customImage": avatar if i % 4 == 0 else None,
+                "prompt": "A gaming enthusiast who loves anime and late-night study sessions. " * 3,
+                "gender": "female",
+                "tags": ["romance", "anime", "study"],
+                "creator_id": f"user_{i % 7}",
+                "is_public": True,
+                "created_at": "2026-01-01T12:00:00",
+                "usage_count": 1000 - i,
+            }
+            for i in range(count)
+        ],
+        "total": 1234,
+        "filters": {"gender": None, "tags": None, "search": None},
+    }
+
+
+def make_catalog(count: int):
+    """Public personalities as the suggest index loads them, with generated names sharing common prefixes"""
+    syllables = ["lu", "na", "mi", "ra", "ko", "sa", "el", "ar", "on", "ia", "ze", "th", "ka", "ri", "do"]
+    tags = ["romance", "anime", "study", "fantasy", "gaming", "therapy", "friend", "magic", "comedy", "art", "music", "travel"]
+    catalog = []
+    for i in range(count):
+        words = [
+            "".join(syllables[(i * 7 + w * 3 + s) % len(syllables)] for s in range(2 + (i + w) % 2)).title()
+            for w in range(1 + i % 3)
+        ]
+        catalog.append({
+            "id": f"public_{i}",
+            "name": " ".join(words),
+            "emoji": "🌙",
+            "gender": "female",
+            "tags": [tags[(i + k * 5) % len(tags)] for k in range(3)],
+            "usage_count": (i * 7919) % 5000,
+        })
+    return catalog
+
+
+CHAT_PAYLOADS = {
+    "text_only": make_chat_payload(0),
+    "one_image": make_chat_payload(110 * 1024),  # a 768px WebP inline variant
+}
+
+CATALOG_PAGES = {
+    "50_cards": make_catalog_page(50),
+}
+
+CATALOGS = {
+    "10000_personalities": make_catalog(10000),
+}
+
+# Long conversations for the memory index, as (role, text) pairs; a few details to recall are planted early
+LONG_CONVERSATIONS = {}
+for _length in (400, 4000):
+    _conversation = [(m["role"], m["content"]) for m in make_history(_length)]
+    _conversation[37] = ("user", "My dog is called Biscuit and he loves the beach in Brighton")
+    _conversation[120] = ("user", "I started learning the cello last spring, my teacher is very strict")
+    LONG_CONVERSATIONS[f"{_length}_messages"] = _conversation
+MEMORY_QUERY = "did you remember to take Biscuit to the beach this weekend?"
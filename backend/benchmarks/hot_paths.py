@@ -0,0 +1,356 @@
+"""Microbenchmarks for the pure functions that run on every chat request.
+
+Run from backend/:
+
+    python -m benchmarks.hot_paths              # compare against benchmarks/baseline.json
+    python -m benchmarks.hot_paths --save       # record a new baseline
+    python -m benchmarks.hot_paths -k detect    # only cases whose name contains "detect"
+
+Exits non-zero when a case is slower or allocates more than the baseline allows,
+which gates CI (.github/workflows/benchmarks.yml). Throughput is normalised by a
+fixed calibration workload, which keeps a baseline recorded on one machine usable
+on another. Cases that take under SPEED_FLOOR_NS per call (cache hits, short regex
+scans) mostly measure timer and scheduler noise: their speed is reported but only
+their allocations are gated.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Set
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import archive
+import log_pipeline
+import intent
+import memory
+import serialization
+import server
+import suggest
+import trending
+from benchmarks import corpora
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+SPEED_TOLERANCE = 0.25  # fail when normalised ops/sec drops by more than this fraction...
+SPEED_FLOOR_NS = 2000  # ...for cases that took at least this long per call in the baseline
+ALLOC_TOLERANCE = 0.10  # fail when peak allocation grows by more than this fraction...
+ALLOC_SLACK_BYTES = 1024  # ...plus this many bytes, so tiny cases don't flap
+CONFIRM_RUNS = 2  # suspected regressions are re-measured this many times before failing
+
+
+class Case(NamedTuple):
+    name: str
+    func: Callable[[], object]
+
+
+def cases() -> List[Case]:
+    """Every benchmarked call, bound to its corpus"""
+    found: List[Case] = []
+    messages = {**corpora.USER_MESSAGES, **{f"adversarial_{k}": v for k, v in corpora.ADVERSARIAL_MESSAGES.items()}}
+    for label, text in messages.items():
+        found.append(Case(f"detect_image_request[{label}]", lambda t=text: server.detect_image_request(t)))
+        found.append(Case(f"detect_self_image_request[{label}]", lambda t=text: server.detect_self_image_request(t)))
+        # The public functions are served from the per-message cache; this is the engine itself
+        found.append(Case(f"classify_intent_uncached[{label}]", lambda t=text: intent.classify_uncached(t)))
+
+    responses = {**corpora.LLM_RESPONSES, **{f"adversarial_{k}": v for k, v in corpora.ADVERSARIAL_RESPONSES.items()}}
+    for label, text in responses.items():
+        found.append(Case(f"extract_image_from_response[{label}]", lambda t=text: server.extract_image_from_response(t)))
+        found.append(Case(f"clean_response_text[{label}]", lambda t=text: server.clean_response_text(t)))
+        found.append(Case(f"parse_response[{label}]", lambda t=text: intent.parse_response(t)))
+
+    for label, payload in corpora.CHAT_PAYLOADS.items():
+        # Before respond(): base64 strings in the payload, re-validated against response_model, stdlib json
+        legacy = as_base64(payload)
+        found.append(Case(f"serialize_chat[{label},fastapi_default]", lambda p=legacy: fastapi_default(p, server.ChatResponse)))
+        found.append(Case(f"serialize_chat[{label},orjson]", lambda p=payload: serialization.dumps_json(p)))
+        found.append(Case(f"serialize_chat[{label},msgpack]", lambda p=payload: serialization.dumps_msgpack(p)))
+    for label, page in corpora.CATALOG_PAGES.items():
+        found.append(Case(f"serialize_catalog[{label},fastapi_default]", lambda p=page: fastapi_default(p)))
+        found.append(Case(f"serialize_catalog[{label},orjson]", lambda p=page: serialization.dumps_json(p)))
+        found.append(Case(f"serialize_catalog[{label},msgpack]", lambda p=page: serialization.dumps_msgpack(p)))
+
+    embedder = memory.HashingEmbedder()
+    found.append(Case("memory_embed[query]", lambda: embedder.embed([corpora.MEMORY_QUERY])))
+    for label, conversation in corpora.LONG_CONVERSATIONS.items():
+        recent = server.MEMORY_RECENT_MESSAGES
+        # A conversation this worker has not seen: embed every message, then query
+        found.append(Case(
+            f"memory_index_build[{label}]",
+            lambda c=conversation: memory.ConversationMemory(embedder).recall("k", c, corpora.MEMORY_QUERY, 4, recent)
+        ))
+        # The usual turn: the index is warm, so only the query is embedded before the search
+        warm = memory.ConversationMemory(embedder)
+        warm.recall("k", conversation, corpora.MEMORY_QUERY, 4, recent)
+        found.append(Case(
+            f"memory_recall[{label}]",
+            lambda m=warm, c=conversation: m.recall("k", c, corpora.MEMORY_QUERY, 4, recent)
+        ))
+
+    bucket = [
+        {"role": role, "content": text, "timestamp": None, "received_at": "2026-01-01T12:00:00.000000"}
+        for role, text in corpora.LONG_CONVERSATIONS["400_messages"][:100]
+    ]
+    for codec in (archive.ZLIB, archive.ZSTD) if archive.zstandard else (archive.ZLIB,):
+        store = archive.ConversationArchive(None, codec=codec)
+        found.append(Case(f"archive_pack[100_messages,{codec}]", lambda s=store: s.pack(0, bucket)["data"]))
+        packed = store.pack(0, bucket)
+        found.append(Case(f"archive_unpack[100_messages,{codec}]", lambda b=packed: archive.ConversationArchive.unpack(b)))
+
+    for label, catalog in corpora.CATALOGS.items():
+        index = suggest.SuggestIndex()
+        index.load(catalog)
+        # Re-ranked on every call, as a narrow prefix (or a broad one whose cached ranking expired) is
+        uncached = suggest.SuggestIndex(cache_seconds=0)
+        uncached.load(catalog)
+        for query in ("l", "lun", "luna mi", "art"):
+            found.append(Case(f"suggest[{label},{query!r}]", lambda i=index, q=query: i.suggest(q, 8)))
+            found.append(Case(f"suggest_uncached[{label},{query!r}]", lambda i=uncached, q=query: i.suggest(q, 8)))
+        created = {**catalog[0], "id": "public_new", "name": "Luna Mira"}
+        found.append(Case(f"suggest_put[{label}]", lambda i=index, c=created: i.put(c)))
+
+        # A week of usage on a third of the catalog
+        scores = {p["id"]: (i * 37 % 101) / 7.0 for i, p in enumerate(catalog) if i % 3 == 0}
+        found.append(Case(f"trending_build[{label}]", lambda c=catalog, s=scores: trending.build_ranking(s, c, 20, 0.0)))
+        ranking = trending.build_ranking(scores, catalog, 20, 0.0)
+        found.append(Case(f"trending_page[{label},all]", lambda r=ranking: r.page(None, [], 200, 50)))
+        found.append(Case(f"trending_page[{label},gender_and_tag]", lambda r=ranking: r.page("female", ["anime"], 200, 50)))
+        # A filter with no materialized list is derived on first use and memoized; this is the derivation
+        found.append(Case(
+            f"trending_page_uncached[{label},two_tags]",
+            lambda r=ranking: (r._derived.clear(), r.page("female", ["anime", "art"], 0, 50))
+        ))
+
+    # One proactive-poll log line, as written before (a stream handler on the calling thread) and now
+    devnull = open(os.devnull, "w")
+    for label, log_filters in (
+        ("stream_handler", None),
+        ("background", []),
+        ("background_sampled_out", [log_pipeline.SamplingFilter({"bench": 0.0})]),
+        ("background_rate_limited", [log_pipeline.RateLimitFilter(0.001, 0)]),
+    ):
+        log = logging.Logger(f"bench.{label}", logging.INFO)
+        target = logging.StreamHandler(devnull)
+        target.setFormatter(log_pipeline.TextFormatter(log_pipeline.TEXT_FORMAT))
+        handler = target if log_filters is None else log_pipeline.BackgroundHandler([target])
+        for log_filter in (log_filters or []) + [server.tracing.RequestContextFilter()]:
+            handler.addFilter(log_filter)
+        log.addHandler(handler)
+        found.append(Case(
+            f"log_call[{label}]",
+            lambda l=log: l.info("Proactive check for %s: %.1f minutes passed, need %d, should_send: %s", "lover", 12.5, 5, True)
+        ))
+
+    base_prompt = server.PERSONALITY_PROMPTS["best_friend"]
+    for label, personalities in corpora.CUSTOM_PERSONALITIES.items():
+        target = personalities[-2]["id"]  # near the end, and has a scenario
+        found.append(Case(
+            f"build_system_prompt_with_scenario[{label}]",
+            lambda p=personalities, t=target: server.build_system_prompt_with_scenario(base_prompt, p, t, True)
+        ))
+        for history_label, history in corpora.HISTORIES.items():
+            found.append(Case(
+                f"generate_proactive_message_prompt[{label},{history_label}_history]",
+                lambda p=personalities, h=history, t=target: server.generate_proactive_message_prompt(t, h, 45, p)
+            ))
+    return found
+
+
+def as_base64(payload):
+    """The payload as it looked when images were base64 strings from the start"""
+    if isinstance(payload, dict):
+        return {key: as_base64(value) for key, value in payload.items()}
+    if isinstance(payload, list):
+        return [as_base64(value) for value in payload]
+    if isinstance(payload, bytes):
+        return serialization.base64.b64encode(payload).decode("ascii")
+    return payload
+
+
+def fastapi_default(payload, response_model=None) -> bytes:
+    """FastAPI's own path for a returned dict: validate against response_model (or jsonable_encoder), then json.dumps"""
+    if response_model is not None:
+        content = response_model.model_validate(payload).model_dump(mode="json")
+    else:
+        content = jsonable_encoder(payload)
+    return JSONResponse(content).body
+
+
+def calibrate() -> float:
+    """Ops/sec of a fixed string/regex/dict workload, used to normalise throughput across machines"""
+    pattern = re.compile(r"(alpha|beta).*?(gamma|delta)")
+    text = "alpha beta epsilon " * 20 + "gamma"
+
+    def workload():
+        parts = text.lower().split()
+        counts = {}
+        for part in parts:
+            counts[part] = counts.get(part, 0) + 1
+        return pattern.search(text) is not None, len(counts)
+
+    return measure_ops(workload, repeat=15)
+
+
+def measure_ops(func: Callable[[], object], repeat: int = 5) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return number / best
+
+
+def measure_peak_alloc(func: Callable[[], object]) -> int:
+    """Peak bytes allocated during one call (after a warm-up call)"""
+    func()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(0, peak - before)
+
+
+def run(selected: List[Case], repeat: int) -> Dict:
+    results = {}
+    for case in selected:
+        results[case.name] = {
+            "ops_per_sec": round(measure_ops(case.func, repeat), 1),
+            "peak_alloc_bytes": measure_peak_alloc(case.func),
+        }
+        output = case.func()
+        if isinstance(output, (bytes, str)):
+            results[case.name]["output_bytes"] = len(output)  # payload size, for the encoders
+    return results
+
+
+def speed_gated(previous: Dict) -> bool:
+    return 1e9 / previous["ops_per_sec"] >= SPEED_FLOOR_NS
+
+
+def compare(results: Dict, calibration: float, baseline: Dict, speed_tolerance: float = SPEED_TOLERANCE) -> List[str]:
+    """Human-readable regressions; empty when everything is within tolerance"""
+    scale = calibration / baseline["calibration_ops_per_sec"]
+    regressions = []
+    for name, current in results.items():
+        previous = baseline["cases"].get(name)
+        if previous is None:
+            continue
+        expected_ops = previous["ops_per_sec"] * scale
+        if speed_gated(previous) and current["ops_per_sec"] < expected_ops * (1 - speed_tolerance):
+            regressions.append(
+                f"{name}: {current['ops_per_sec']:.0f} ops/s vs {expected_ops:.0f} expected "
+                f"({current['ops_per_sec'] / expected_ops - 1:+.0%})"
+            )
+        allowed_bytes = previous["peak_alloc_bytes"] * (1 + ALLOC_TOLERANCE) + ALLOC_SLACK_BYTES
+        if current["peak_alloc_bytes"] > allowed_bytes:
+            regressions.append(
+                f"{name}: peak allocation {current['peak_alloc_bytes']} B vs {previous['peak_alloc_bytes']} B baseline"
+            )
+        # Payload and compressed sizes are deterministic, so any growth past the tolerance is real
+        if "output_bytes" in previous and current.get("output_bytes", 0) > previous["output_bytes"] * (1 + ALLOC_TOLERANCE):
+            regressions.append(
+                f"{name}: output {current['output_bytes']} B vs {previous['output_bytes']} B baseline"
+            )
+    return regressions
+
+
+def print_table(results: Dict, calibration: float, baseline: Dict = None, remeasured: Set[str] = frozenset()):
+    scale = calibration / baseline["calibration_ops_per_sec"] if baseline else None
+    width = max(len(name) for name in results)
+    print(f"{'case':<{width}}  {'ops/sec':>12}  {'peak alloc':>11}  {'output':>11}  {'vs baseline':>11}")
+    for name, current in results.items():
+        delta = ""
+        previous = baseline["cases"].get(name) if baseline else None
+        if previous:
+            delta = f"{current['ops_per_sec'] / (previous['ops_per_sec'] * scale) - 1:+.1%}"
+            if not speed_gated(previous):
+                delta += "~"
+        if name in remeasured:
+            delta += "*"
+        output = f"{current['output_bytes']:,} B" if "output_bytes" in current else ""
+        print(f"{name:<{width}}  {current['ops_per_sec']:>12,.0f}  {current['peak_alloc_bytes']:>9,} B  {output:>11}  {delta:>11}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("-k", dest="keyword", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--speed-tolerance", type=float, default=SPEED_TOLERANCE,
+        help="allowed drop in normalised ops/sec (wider on shared CI runners)"
+    )
+    args = parser.parse_args(argv)
+
+    selected = [case for case in cases() if args.keyword in case.name]
+    started = time.perf_counter()
+    calibration = calibrate()
+    results = run(selected, args.repeat)
+    calibration = max(calibration, calibrate())  # best of before/after, so a noisy neighbour can't skew every case
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() and not args.save else None
+
+    regressions = compare(results, calibration, baseline, args.speed_tolerance) if baseline else []
+    remeasured = set()
+    for _ in range(CONFIRM_RUNS):
+        if not regressions:
+            break
+        # Re-measure only the suspects and keep their best result; a real regression stays slow
+        suspects = {line.split(":")[0] for line in regressions}
+        for case in selected:
+            if case.name in suspects:
+                rerun = run([case], args.repeat)[case.name]
+                results[case.name] = dict(
+                    results[case.name],
+                    ops_per_sec=max(results[case.name]["ops_per_sec"], rerun["ops_per_sec"]),
+                    peak_alloc_bytes=min(results[case.name]["peak_alloc_bytes"], rerun["peak_alloc_bytes"]),
+                )
+                remeasured.add(case.name)
+        regressions = compare(results, calibration, baseline, args.speed_tolerance)
+
+    # The numbers the verdict below is based on, re-measured ones included
+    print_table(results, calibration, baseline, remeasured)
+    print(f"\n{len(results)} cases in {time.perf_counter() - started:.1f}s (calibration {calibration:,.0f} ops/s)")
+    if remeasured:
+        print(f"Re-measured (*): {', '.join(sorted(remeasured))}")
+    if baseline and any(not speed_gated(previous) for name, previous in baseline["cases"].items() if name in results):
+        print(f"~ under {SPEED_FLOOR_NS:,} ns per call in the baseline: speed shown, not gated")
+
+    if args.save:
+        args.baseline.write_text(json.dumps({
+            "python": platform.python_version(),
+            "calibration_ops_per_sec": round(calibration, 1),
+            "cases": results,
+        }, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save to create one")
+        return 0
+
+    missing = sorted(set(results) - set(baseline["cases"]))
+    if missing:
+        print(f"Not in baseline (run --save to add): {', '.join(missing)}")
+    if regressions:
+        print("\nRegressions:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
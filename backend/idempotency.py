@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused with a different request body"""
+
+
+class IdempotencyInProgress(Exception):
+    """Raised when another worker holds the key for longer than we are willing to wait"""
+
+
+def request_fingerprint(payload: Any) -> str:
+    """Stable hash of a request body so a reused key with different content is rejected"""
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class MemoryIdempotencyBackend:
+    """Per-process TTL store, bounded in size (oldest entries are evicted first)"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Dict]:
+        record = self._entries.get(key)
+        if record is None:
+            return None
+        if record["expires_at"] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return record
+
+    async def claim(self, key: str, fingerprint: str, ttl_seconds: float) -> bool:
+        # In-flight requests are already de-duplicated by the store's futures
+        self._entries[key] = {
+            "status": "in_progress",
+            "fingerprint": fingerprint,
+            "expires_at": time.monotonic() + ttl_seconds,
+        }
+        self._evict()
+        return True
+
+    async def complete(self, key: str, fingerprint: str, response: Any, ttl_seconds: float):
+        self._entries[key] = {
+            "status": "completed",
+            "fingerprint": fingerprint,
+            "response": response,
+            "expires_at": time.monotonic() + ttl_seconds,
+        }
+        self._entries.move_to_end(key)
+        self._evict()
+
+    async def release(self, key: str):
+        record = self._entries.get(key)
+        if record and record["status"] == "in_progress":
+            del self._entries[key]
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class MongoIdempotencyBackend:
+    """Shared TTL store so retries landing on another worker are still de-duplicated"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def get(self, key: str) -> Optional[Dict]:
+        return await self.collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+
+    async def claim(self, key: str, fingerprint: str, ttl_seconds: float) -> bool:
+        from pymongo.errors import DuplicateKeyError
+
+        now = datetime.utcnow()
+        document = {
+            "status": "in_progress",
+            "fingerprint": fingerprint,
+            "expires_at": now + timedelta(seconds=ttl_seconds),
+        }
+        try:
+            await self.collection.insert_one({"_id": key, **document})
+            return True
+        except DuplicateKeyError:
+            # The TTL monitor only runs once a minute, so take over stale records ourselves
+            result = await self.collection.update_one(
+                {"_id": key, "expires_at": {"$lte": now}},
+                {"$set": document, "$unset": {"response": ""}},
+            )
+            return result.modified_count == 1
+
+    async def complete(self, key: str, fingerprint: str, response: Any, ttl_seconds: float):
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "status": "completed",
+                "fingerprint": fingerprint,
+                "response": response,
+                "expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds),
+            }},
+            upsert=True,
+        )
+
+    async def release(self, key: str):
+        await self.collection.delete_one({"_id": key, "status": "in_progress"})
+
+
+class IdempotencyStore:
+    """Runs a producer at most once per key; repeats attach to it or replay its result"""
+
+    def __init__(
+        self,
+        backend,
+        ttl_seconds: float = 24 * 60 * 60,
+        lock_ttl_seconds: float = 5 * 60,
+        poll_interval: float = 0.25,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.poll_interval = poll_interval
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        producer: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """Return (result, replayed) for this key, running producer only if nobody has yet"""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            inflight_fingerprint, future = inflight
+            if inflight_fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            return await asyncio.shield(future), True
+
+        # Register before the first await so concurrent repeats in this process attach to us
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._inflight[key] = (fingerprint, future)
+        try:
+            result, replayed = await self._run_owned(key, fingerprint, producer)
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, replayed
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _run_owned(self, key, fingerprint, producer) -> Tuple[Any, bool]:
+        deadline = time.monotonic() + self.lock_ttl_seconds
+        while True:
+            record = await self.backend.get(key)
+            if record is not None:
+                if record.get("fingerprint") != fingerprint:
+                    raise IdempotencyConflict(key)
+                if record.get("status") == "completed":
+                    return record.get("response"), True
+            elif await self.backend.claim(key, fingerprint, self.lock_ttl_seconds):
+                break
+
+            # Another worker owns the key; wait for it to finish or give up
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress(key)
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await producer()
+        except BaseException:
+            await self.backend.release(key)
+            raise
+        await self.backend.complete(key, fingerprint, result, self.ttl_seconds)
+        return result, False
+
+
+def _consume_exception(future: asyncio.Future):
+    # Nobody may be attached when the producer fails; avoid "exception never retrieved" noise
+    if not future.cancelled():
+        future.exception()
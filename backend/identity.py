@@ -0,0 +1,32 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Optional, Tuple
+
+
+class UserTokens:
+    """Issues random user ids with an HMAC signature, so a client can only act as a user it was given.
+
+    A token is "<user id>.<signature>" and needs no storage: any worker holding the same secret
+    verifies it. Changing the secret invalidates every token issued before.
+    """
+
+    def __init__(self, secret: bytes):
+        self.secret = secret
+
+    def issue(self) -> Tuple[str, str]:
+        """A new (user id, token) pair"""
+        user_id = secrets.token_urlsafe(16)
+        return user_id, f"{user_id}.{self._sign(user_id)}"
+
+    def verify(self, token: Optional[str]) -> Optional[str]:
+        """The user id a token was issued for, or None if it is missing or forged"""
+        user_id, _, signature = (token or "").partition(".")
+        if not user_id or not hmac.compare_digest(signature, self._sign(user_id)):
+            return None
+        return user_id
+
+    def _sign(self, user_id: str) -> str:
+        digest = hmac.new(self.secret, user_id.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
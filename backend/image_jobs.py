@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+RENDERING = "rendering"  # the preview (if any) is available, the final render is still running
+COMPLETE = "complete"  # the final render replaced the preview
+FAILED = "failed"  # the final render failed; the preview, if any, is all there is
+
+
+class MemoryImageJobBackend:
+    """Per-process TTL store, bounded in size (oldest jobs are evicted first)"""
+
+    def __init__(self, max_entries: int = 256):
+        # Jobs hold rendered images, so keep this far smaller than the idempotency store
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        record = self._entries.get(job_id)
+        if record is None:
+            return None
+        if record["expires_at"] <= time.monotonic():
+            del self._entries[job_id]
+            return None
+        return record
+
+    async def put(self, job_id: str, record: Dict, ttl_seconds: float):
+        self._entries[job_id] = {**record, "expires_at": time.monotonic() + ttl_seconds}
+        self._entries.move_to_end(job_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class MongoImageJobBackend:
+    """Shared TTL store, so a poll can land on any worker"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        return await self.collection.find_one(
+            {"_id": job_id, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+
+    async def put(self, job_id: str, record: Dict, ttl_seconds: float):
+        await self.collection.replace_one(
+            {"_id": job_id},
+            {**record, "expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds)},
+            upsert=True,
+        )
+
+
+class ImageJobStore:
+    """Progressive renders: the preview is stored at once and the final image replaces it when ready"""
+
+    def __init__(self, backend, ttl_seconds: float = 15 * 60, poll_interval: float = 0.5):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.poll_interval = poll_interval
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._settled: Dict[str, asyncio.Event] = {}
+
+    async def start(
+        self,
+        prompt: str,
+        preview: Dict,
+        preview_quality: str,
+        quality: str,
+        render: Callable[[], Awaitable[Dict]],
+    ) -> str:
+        """Store the preview and run the final render in the background; returns the job id to poll.
+
+        Images are the response fields describing them ("image" and friends); empty when a render failed.
+        """
+        job_id = uuid.uuid4().hex
+        record = {
+            "job_id": job_id,
+            "status": RENDERING,
+            "prompt": prompt,
+            "image": None,
+            "quality": preview_quality if preview else None,
+            **preview,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+        await self.backend.put(job_id, record, self.ttl_seconds)
+        self._settled[job_id] = asyncio.Event()
+        self._tasks[job_id] = asyncio.create_task(self._finish(record, quality, render))
+        return job_id
+
+    async def _finish(self, record: Dict, quality: str, render: Callable[[], Awaitable[Dict]]):
+        job_id = record["job_id"]
+        try:
+            try:
+                image = await render()
+            except Exception as e:
+                logging.error("Final render for image job %s failed: %s", job_id, e)
+                image = {}
+            if image:
+                record.update(image, status=COMPLETE, quality=quality)
+            else:
+                record.update(status=FAILED)
+            record["updated_at"] = datetime.utcnow().isoformat()
+            await self.backend.put(job_id, record, self.ttl_seconds)
+        finally:
+            self._tasks.pop(job_id, None)
+            self._settled.pop(job_id).set()
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        return await self.backend.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict]:
+        """The job once it has settled, or as it stands after timeout seconds (None if unknown)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            record = await self.backend.get(job_id)
+            remaining = deadline - time.monotonic()
+            if record is None or record["status"] != RENDERING or remaining <= 0:
+                return record
+            settled = self._settled.get(job_id)
+            if settled is not None:
+                # Rendering in this worker: wake as soon as it lands
+                try:
+                    await asyncio.wait_for(settled.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # Rendering elsewhere (or just finished): poll the shared backend
+                await asyncio.sleep(min(self.poll_interval, remaining))
+
+    async def close(self):
+        """Cancel final renders still running at shutdown"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
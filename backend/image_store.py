@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from serialization import accepted_types
+
+ORIGINAL = "original"  # the bytes fal.ai returned, untouched
+
+
+class ImageFormat(NamedTuple):
+    mime_type: str
+    pillow_format: str
+    pillow_feature: str  # codec name for PIL.features.check
+    options: Dict
+
+
+FORMATS: Dict[str, ImageFormat] = {
+    "avif": ImageFormat("image/avif", "AVIF", "avif", {"quality": 50, "speed": 8}),
+    "webp": ImageFormat("image/webp", "WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ImageFormat("image/jpeg", "JPEG", "jpg", {"quality": 85, "optimize": True, "progressive": True}),
+}
+PREFERENCE = ("avif", "webp", "jpeg")  # smallest first
+
+
+def sniff_mime_type(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def parse_variants(spec: str) -> Dict[str, int]:
+    """"thumb:256,chat:768,full:0" -> longest edge per variant name (0 keeps the original size)"""
+    variants = {}
+    for item in spec.split(","):
+        name, _, edge = item.strip().partition(":")
+        variants[name] = int(edge or 0)
+    return variants
+
+
+def available_formats(wanted: List[str]) -> List[str]:
+    """The wanted formats this Pillow build can encode; empty without Pillow (originals are served as-is)"""
+    try:
+        from PIL import features
+    except ImportError:
+        logging.warning("Pillow is not installed; images are served in their original format and size")
+        return []
+    return [name for name in wanted if name in FORMATS and features.check(FORMATS[name].pillow_feature)]
+
+
+def negotiate(accept: Optional[str], formats: List[str], default: str) -> str:
+    """Smallest format the client names explicitly; wildcards and non-image Accepts get the default"""
+    types = accepted_types(accept)
+    for name in PREFERENCE:
+        if name in formats and types.get(FORMATS[name].mime_type, 0) > 0:
+            return name
+    return default
+
+
+def transcode(data: bytes, format_name: str, max_edge: int) -> Tuple[bytes, str]:
+    """Re-encode (and shrink to max_edge, if non-zero) one image; CPU-bound, so run it in an executor"""
+    from PIL import Image
+
+    target = FORMATS[format_name]
+    with Image.open(io.BytesIO(data)) as image:
+        if max_edge:
+            # JPEG can decode at 1/2, 1/4 or 1/8 scale, which is most of the resize for free
+            image.draft("RGB", (max_edge, max_edge))
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode not in ("RGB", "RGBA") or (target.pillow_format == "JPEG" and image.mode != "RGB"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, target.pillow_format, **target.options)
+    return output.getvalue(), target.mime_type
+
+
+class ByteBoundedLRU:
+    """LRU of (bytes, metadata) entries, bounded by the total size of the bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[object, Tuple[bytes, object]]" = OrderedDict()
+
+    def get(self, key) -> Optional[Tuple[bytes, object]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, data: bytes, metadata: object):
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous[0])
+        self._entries[key] = (data, metadata)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class MemoryImageBackend:
+    """Originals in this process only, bounded by total size (oldest first out)"""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self._originals = ByteBoundedLRU(max_bytes)
+
+    async def get(self, image_id: str) -> Optional[bytes]:
+        entry = self._originals.get(image_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def put(self, image_id: str, data: bytes, ttl_seconds: float):
+        self._originals.put(image_id, data, time.monotonic() + ttl_seconds)
+
+
+class MongoImageBackend:
+    """Originals shared across workers, so a variant URL works whichever worker it reaches"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def get(self, image_id: str) -> Optional[bytes]:
+        document = await self.collection.find_one(
+            {"_id": image_id, "expires_at": {"$gt": datetime.utcnow()}}, {"data": 1}
+        )
+        return bytes(document["data"]) if document else None
+
+    async def put(self, image_id: str, data: bytes, ttl_seconds: float):
+        await self.collection.update_one(
+            {"_id": image_id},
+            {"$set": {"data": data, "expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds)}},
+            upsert=True,
+        )
+
+
+class RenderedImage(NamedTuple):
+    image_id: str
+    data: bytes  # the original, or the size variant the client opted into, already transcoded
+    mime_type: str
+
+
+class ImageStore:
+    """Keeps each original once and derives sized WebP/AVIF variants on demand, off the event loop"""
+
+    def __init__(
+        self,
+        backend,
+        executor: Executor,
+        variants: Dict[str, int],
+        formats: List[str],
+        default_format: str = "webp",
+        ttl_seconds: float = 7 * 24 * 60 * 60,
+        cache_max_bytes: int = 128 * 1024 * 1024,
+    ):
+        self.backend = backend
+        self.executor = executor
+        self.variants = variants
+        self.formats = formats
+        self.default_format = default_format if default_format in formats else ORIGINAL
+        self.ttl_seconds = ttl_seconds
+        self._cache = ByteBoundedLRU(cache_max_bytes)
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+
+    def negotiate(self, accept: Optional[str]) -> str:
+        return negotiate(accept, self.formats, self.default_format)
+
+    async def publish(self, data: bytes, inline_variant: Optional[str] = None, format_name: str = ORIGINAL) -> RenderedImage:
+        """Store a freshly rendered original and return the bytes to send inline.
+
+        That is the original itself unless the client opted into one of the size variants, which
+        is then transcoded to format_name.
+        """
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+        await self.backend.put(image_id, data, self.ttl_seconds)
+        if inline_variant not in self.variants:
+            return RenderedImage(image_id, data, sniff_mime_type(data))
+        variant = await self._derive(image_id, data, inline_variant, format_name)
+        return RenderedImage(image_id, *variant)
+
+    async def variant(self, image_id: str, variant: str, format_name: str) -> Optional[Tuple[bytes, str]]:
+        """(bytes, mime type) of one size/format of a stored image, or None if it is unknown or expired"""
+        key = (image_id, variant, format_name)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        original = await self.backend.get(image_id)
+        if original is None:
+            return None
+        return await self._derive(image_id, original, variant, format_name)
+
+    async def _derive(self, image_id: str, original: bytes, variant: str, format_name: str) -> Tuple[bytes, str]:
+        key = (image_id, variant, format_name)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        # Concurrent requests for the same variant share one transcode
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._transcode(original, variant, format_name)
+            self._cache.put(key, *result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, so an unawaited failure isn't logged as never retrieved
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _transcode(self, original: bytes, variant: str, format_name: str) -> Tuple[bytes, str]:
+        if format_name == ORIGINAL or format_name not in self.formats:
+            return original, sniff_mime_type(original)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, transcode, original, format_name, self.variants.get(variant, 0)
+            )
+        except Exception as e:
+            # An image Pillow can't read is still an image the browser may be able to show
+            logging.warning("Transcoding to %s failed, serving the original: %s", format_name, e)
+            return original, sniff_mime_type(original)
+
+
+_request: ContextVar[Tuple[Optional[str], Optional[str]]] = ContextVar("image_request", default=(None, None))
+
+
+def bind_request(headers: Mapping[str, str]):
+    """Remember how this request wants the images rendered while serving it: its Accept header,
+    and the size variant named by X-Image-Variant if the client opted into one instead of the original
+    """
+    _request.set((headers.get("accept"), headers.get("x-image-variant")))
+
+
+def current_request() -> Tuple[Optional[str], Optional[str]]:
+    """(Accept header, opted-in inline variant) of the request being served"""
+    return _request.get()
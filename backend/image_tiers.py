@@ -0,0 +1,84 @@
+import json
+import os
+from typing import Dict, Mapping, NamedTuple, Optional
+
+
+class ImageTier(NamedTuple):
+    """One fal.ai render configuration: model, output size and step count"""
+    name: str
+    model: str
+    image_size: str
+    steps: int
+    guidance_scale: Optional[float] = None
+
+    def arguments(self, prompt: str) -> dict:
+        arguments = {"prompt": prompt, "image_size": self.image_size, "num_inference_steps": self.steps}
+        if self.guidance_scale is not None:
+            arguments["guidance_scale"] = self.guidance_scale
+        return arguments
+
+
+BUILTIN_TIERS: Dict[str, ImageTier] = {
+    "preview": ImageTier("preview", "fal-ai/flux/schnell", "square", 4),
+    "standard": ImageTier("standard", "fal-ai/flux/dev", "square_hd", 16, 3.5),
+    "hd": ImageTier("hd", "fal-ai/flux/dev", "square_hd", 28, 3.5),
+}
+
+
+class TierPolicy:
+    """Which tier each endpoint and personality renders at, and whether chat images go progressive"""
+
+    def __init__(
+        self,
+        tiers: Dict[str, ImageTier],
+        endpoints: Dict[str, str] = None,
+        personalities: Dict[str, str] = None,
+        default: str = "hd",
+        preview: str = "preview",
+        progressive: bool = False,
+    ):
+        self.tiers = tiers
+        self.endpoints = endpoints or {}
+        self.personalities = personalities or {}
+        self.default = default
+        self.progressive = progressive
+        unknown = ({default, preview} | set(self.endpoints.values()) | set(self.personalities.values())) - set(tiers)
+        if unknown:
+            raise ValueError(f"Unknown image tiers in configuration: {', '.join(sorted(unknown))}")
+        self.preview = tiers[preview]
+
+    def tier_for(self, endpoint: str, personality: Optional[str] = None, requested: Optional[str] = None) -> ImageTier:
+        """A tier the client asked for wins, then the personality's, then the endpoint's, then the default"""
+        name = requested or self.personalities.get(personality) or self.endpoints.get(endpoint) or self.default
+        if name not in self.tiers:
+            raise ValueError(f"Unknown image quality '{name}', expected one of: {', '.join(self.tiers)}")
+        return self.tiers[name]
+
+
+def load_tier_policy(environ: Mapping[str, str] = os.environ) -> TierPolicy:
+    """Build the policy from the environment.
+
+    IMAGE_TIERS               JSON {"name": {"model", "image_size", "steps", "guidance_scale"}}, added to the built-ins
+    IMAGE_TIER_DEFAULT        tier used when nothing more specific applies (hd)
+    IMAGE_TIER_ENDPOINTS      JSON {"chat": "standard", "generate_image": "hd"}
+    IMAGE_TIER_PERSONALITIES  JSON {"fantasy_rpg": "hd", "best_friend": "standard"}
+    IMAGE_PREVIEW_TIER        tier used for progressive previews (preview)
+    IMAGE_PROGRESSIVE         "true" to send chat images as a preview plus an HD job unless the request says otherwise
+    """
+    tiers = dict(BUILTIN_TIERS)
+    for name, spec in json.loads(environ.get("IMAGE_TIERS") or "{}").items():
+        tiers[name] = ImageTier(
+            name,
+            spec["model"],
+            spec.get("image_size", "square_hd"),
+            int(spec["steps"]),
+            spec.get("guidance_scale"),
+        )
+    return TierPolicy(
+        tiers,
+        endpoints=json.loads(environ.get("IMAGE_TIER_ENDPOINTS") or "{}"),
+        personalities=json.loads(environ.get("IMAGE_TIER_PERSONALITIES") or "{}"),
+        default=environ.get("IMAGE_TIER_DEFAULT", "hd"),
+        preview=environ.get("IMAGE_PREVIEW_TIER", "preview"),
+        progressive=environ.get("IMAGE_PROGRESSIVE", "false").lower() == "true",
+    )
@@ -0,0 +1,189 @@
+import re
+from enum import Enum
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+
+class Intent(Enum):
+    NONE = "none"
+    GENERIC = "generic"  # the user wants an image of something
+    SELF = "self"  # the user wants to see the character
+
+
+VERBS = ("create", "generate", "make", "draw", "show", "paint")
+NOUNS = ("picture", "image", "photo", "illustration", "art", "sketch", "drawing")
+WANTED_NOUNS = ("picture", "image", "photo", "illustration", "art")
+CONNECTORS = ("of", "showing", "with")
+KEYWORDS = (
+    "create", "generate", "make", "draw", "show", "picture", "image",
+    "photo", "illustration", "art", "sketch", "paint", "design"
+)
+ASKS = tuple(f"can you {verb}" for verb in VERBS)
+SELF_PHRASES = (
+    "show me what you look like", "show me how you look", "show me yourself",
+    "take a selfie", "take a picture of yourself", "take a photo of yourself",
+    "what do you look like", "can i see you", "show yourself", "picture of you",
+    "image of you", "how do you appear", "your appearance", "describe yourself visually",
+)
+
+# (heads, tails): some head followed later on the same line by some tail. Same language as
+# the old r"(create|...).*?(picture|...)" patterns, without their quadratic backtracking.
+SEQUENCES = ((VERBS, NOUNS), (NOUNS, CONNECTORS), (("i want",), WANTED_NOUNS))
+
+
+def _followed_on_same_line(text: str, heads, tails) -> bool:
+    """True when some head is followed, on the same line, by some tail.
+
+    Only the earliest-ending head on a line is worth trying. Each head keeps a cursor to its
+    next occurrence that only moves forward, and tails are searched within one line, so every
+    literal scans the text at most once: linear, using str.find's C search throughout.
+    """
+    next_at = {head: text.find(head) for head in heads}
+    pos = 0
+    while True:
+        head_end = -1
+        for head, at in next_at.items():
+            if at != -1 and at < pos:
+                at = next_at[head] = text.find(head, pos)
+            if at != -1 and (head_end == -1 or at + len(head) < head_end):
+                head_end = at + len(head)
+        if head_end == -1:
+            return False
+        line_end = text.find("\n", head_end)
+        if line_end == -1:
+            line_end = len(text)
+        if any(text.find(tail, head_end, line_end) != -1 for tail in tails):
+            return True
+        pos = line_end + 1
+
+
+def _has_keywords(text: str, needed: int = 2) -> bool:
+    found = 0
+    for keyword in KEYWORDS:
+        if keyword in text:
+            found += 1
+            if found >= needed:
+                return True
+    return False
+
+
+def classify_uncached(text: str) -> Intent:
+    """Image intent of a user message"""
+    lowered = text.lower()
+    if any(phrase in lowered for phrase in SELF_PHRASES):
+        return Intent.SELF
+    if any(ask in lowered for ask in ASKS) or _has_keywords(lowered):
+        return Intent.GENERIC
+    if any(_followed_on_same_line(lowered, heads, tails) for heads, tails in SEQUENCES):
+        return Intent.GENERIC
+    return Intent.NONE
+
+
+CACHE_MAX_CHARS = 1000  # longer messages (pastes) only get a few cache slots, so they can't pile up per worker
+_classify_short = lru_cache(maxsize=2048)(classify_uncached)
+_classify_long = lru_cache(maxsize=8)(classify_uncached)
+
+
+def classify(text: str) -> Intent:
+    """classify_uncached, cached, since a chat turn asks about the same message several times"""
+    return _classify_short(text) if len(text) <= CACHE_MAX_CHARS else _classify_long(text)
+
+
+_MARKER = re.compile(r"\[IMAGE:\s*([^\]]+)\]", re.IGNORECASE)
+
+
+class ParsedResponse(NamedTuple):
+    image_prompts: List[str]
+    text: str  # the reply with every [IMAGE: ...] marker removed, stripped
+
+
+def parse_response(text: str) -> ParsedResponse:
+    """Extract every [IMAGE: ...] marker and the cleaned text in one scan.
+
+    A marker can only close at or before the last "]". Bounding the scan there means an
+    unterminated marker is never rescanned to the end of the text, which was the pattern's
+    only quadratic case; every other match consumes what it scans.
+    """
+    end = text.rfind("]") + 1
+    if not end:
+        return ParsedResponse([], text.strip())
+    # Only slice (and copy) when some "[" after the last "]" could start an unterminated marker
+    head, tail = (text, "") if text.find("[", end) == -1 else (text[:end], text[end:])
+    # split() with a capturing group alternates kept text and marker descriptions, in C
+    parts = _MARKER.split(head)
+    if len(parts) == 1:
+        return ParsedResponse([], text.strip())
+    kept = parts[0::2]
+    kept.append(tail)
+    # A blank marker ("[IMAGE:   ]") is removed from the text but asks for no image
+    prompts = [description.strip() for description in parts[1::2]]
+    if "" in prompts:
+        prompts = [prompt for prompt in prompts if prompt]
+    return ParsedResponse(prompts, "".join(kept).strip())
+
+
+def first_image_prompt(text: str) -> Optional[str]:
+    """The first non-blank marker's description, without building the cleaned text"""
+    for match in _MARKER.finditer(text, 0, text.rfind("]") + 1):
+        prompt = match.group(1).strip()
+        if prompt:
+            return prompt
+    return None
+
+
+def strip_markers(text: str) -> str:
+    """Just the cleaned text, for callers that don't need the descriptions"""
+    end = text.rfind("]") + 1
+    if not end:
+        return text.strip()
+    if text.find("[", end) == -1:
+        return _MARKER.sub("", text).strip()
+    return (_MARKER.sub("", text[:end]) + text[end:]).strip()
+
+
+class MarkerStripper:
+    """strip_markers for streamed text: feed it deltas, get back what is safe to show.
+
+    Text goes out as soon as it cannot be part of a marker. From a "[" that could still open
+    one it is held until the marker closes (and is dropped) or turns out not to be a marker.
+    """
+
+    OPENING = "[image:"
+
+    def __init__(self):
+        self._held = ""
+
+    def feed(self, text: str) -> str:
+        held = self._held + text
+        shown = []
+        while held:
+            start = held.find("[")
+            if start == -1:
+                shown.append(held)
+                held = ""
+                break
+            shown.append(held[:start])
+            held = held[start:]
+            opening = held[:len(self.OPENING)].lower()
+            if not self.OPENING.startswith(opening):
+                shown.append("[")
+                held = held[1:]
+                continue
+            if len(opening) < len(self.OPENING):
+                break  # could still be a marker: wait for more text
+            end = held.find("]", len(self.OPENING))
+            if end == -1:
+                break
+            if end == len(self.OPENING):
+                # "[IMAGE:]" has no description, so it is not a marker
+                shown.append("[")
+                held = held[1:]
+                continue
+            held = held[end + 1:]
+        self._held = held
+        return "".join(shown)
+
+    def flush(self) -> str:
+        """Whatever is still held at the end of the stream: an unterminated marker stays in the text"""
+        held, self._held = self._held, ""
+        return held
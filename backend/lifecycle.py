@@ -0,0 +1,84 @@
+import asyncio
+import signal
+import time
+from typing import Callable, Iterable
+
+
+class InFlightTracker:
+    """Counts live requests and websockets so shutdown can wait for them to finish"""
+
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def enter(self):
+        self.active += 1
+        self._idle.clear()
+
+    def exit(self):
+        self.active -= 1
+        self.completed += 1
+        if self.active == 0:
+            self._idle.set()
+
+    async def drain(self, timeout: float) -> int:
+        """Stop advertising readiness and wait up to timeout for in-flight work; returns leftovers"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+        return self.active
+
+
+def drain_on_signal(
+    tracker: InFlightTracker,
+    on_drain: Callable[[], None],
+    grace: float,
+    signals: Iterable[int] = (signal.SIGTERM,),
+):
+    """Start draining when the server is told to stop, grace seconds before it stops accepting.
+
+    uvicorn registers its exit handler on the event loop before the app starts; this wraps it, so
+    /api/ready turns 503 and on_drain runs first, and balancers get grace seconds to stop routing
+    here. A second signal stops the server at once. Call from the running app (e.g. lifespan).
+    """
+    loop = asyncio.get_running_loop()
+    handlers = getattr(loop, "_signal_handlers", None) or {}  # asyncio has no public accessor
+    for sig in signals:
+        server_handler = handlers.get(sig)
+        if server_handler is None:
+            continue  # not running under uvicorn's main thread
+
+        def begin(server_handler=server_handler):
+            stop = lambda: server_handler._callback(*server_handler._args)
+            if tracker.draining:
+                stop()
+                return
+            tracker.draining = True
+            on_drain()
+            loop.call_later(grace, stop)
+
+        loop.add_signal_handler(sig, begin)
+
+
+class InFlightMiddleware:
+    """Pure ASGI middleware, so the count covers streamed bodies until the last chunk is sent"""
+
+    def __init__(self, app, tracker: InFlightTracker):
+        self.app = app
+        self.tracker = tracker
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        self.tracker.enter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.tracker.exit()
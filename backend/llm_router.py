@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+    RetryPolicy,
+    call_with_resilience,
+    is_retryable,
+)
+import tracing
+
+DEFAULT_MODEL = "Meta-Llama-3.1-8B-Instruct"
+
+
+class LLMEndpoint:
+    """One OpenAI-compatible backend with its own live latency/error statistics"""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: str,
+        model: str = DEFAULT_MODEL,
+        weight: float = 1.0,
+        max_concurrency: int = 8,
+        cost: float = 1.0,
+        models: Optional[Dict[str, str]] = None,
+        purposes: Optional[List[str]] = None,
+        timeout: float = 60.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30.0,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.weight = max(weight, 0.01)
+        self.max_concurrency = max_concurrency
+        self.cost = cost
+        self.models = models or {}  # per-purpose model overrides
+        self.purposes = set(purposes) if purposes else None  # None serves every purpose
+        self._api_key = api_key
+        self._timeout = timeout
+        self._client = None
+        self.breaker = CircuitBreaker(f"llm:{name}", breaker_threshold, breaker_cooldown)
+        self.latency = LatencyTracker()
+        self.in_flight = 0
+        self.ewma_latency = 1.0
+        self.ewma_error = 0.0
+        self._updated_at = time.monotonic()
+
+    @property
+    def client(self):
+        # Deferred so importing the app (and every forked worker) does not pay for openai up front
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=self._api_key,
+                timeout=self._timeout,
+                max_retries=0
+            )
+        return self._client
+
+    async def warm(self):
+        """Open the connection pool (DNS, TCP, TLS) with a cheap models listing"""
+        await self.client.models.list()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+    def model_for(self, purpose: str) -> str:
+        return self.models.get(purpose, self.model)
+
+    def serves(self, purpose: str) -> bool:
+        return self.purposes is None or purpose in self.purposes
+
+    def error_rate(self) -> float:
+        # Decay toward zero while idle so a recovered endpoint is tried again
+        idle = time.monotonic() - self._updated_at
+        return self.ewma_error * 0.5 ** (idle / 60.0)
+
+    def score(self) -> float:
+        """Lower is better: expected latency, inflated by errors and current load"""
+        load = 1.0 + self.in_flight / max(self.max_concurrency, 1)
+        return self.ewma_latency * (1.0 + 10.0 * self.error_rate()) * load / self.weight
+
+    def observe(self, seconds: Optional[float], failed: bool):
+        self.ewma_error = 0.9 * self.error_rate() + (0.1 if failed else 0.0)
+        if seconds is not None:
+            self.ewma_latency = 0.8 * self.ewma_latency + 0.2 * seconds
+        self._updated_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "model": self.model,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "ewma_latency_seconds": round(self.ewma_latency, 4),
+            "error_rate": round(self.error_rate(), 4),
+            "circuit_breaker": self.breaker.snapshot(),
+        }
+
+
+class LLMRouter:
+    """Sends each completion to the best-scoring endpoint and fails over to the rest"""
+
+    def __init__(
+        self,
+        endpoints: List[LLMEndpoint],
+        timeout: float = 60.0,
+        retry: Optional[RetryPolicy] = None,
+        hedge_percentile: Optional[float] = None,
+        cost_routed_purposes: Optional[List[str]] = None,
+    ):
+        if not endpoints:
+            raise ValueError("LLMRouter needs at least one endpoint")
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy(attempts=2)
+        self.hedge_percentile = hedge_percentile
+        self.cost_routed_purposes = set(cost_routed_purposes or [])
+
+    @property
+    def total_concurrency(self) -> int:
+        return sum(endpoint.max_concurrency for endpoint in self.endpoints)
+
+    def candidates(self, purpose: str) -> List[LLMEndpoint]:
+        """Endpoints in the order they should be tried for this purpose"""
+        eligible = [e for e in self.endpoints if e.serves(purpose)] or list(self.endpoints)
+        if purpose in self.cost_routed_purposes:
+            key = lambda e: (e.in_flight >= e.max_concurrency, e.cost, e.score())
+        else:
+            key = lambda e: (e.in_flight >= e.max_concurrency, e.score())
+        return sorted(eligible, key=key)
+
+    async def complete(self, messages: list, max_tokens: int, temperature: float, purpose: str = "chat"):
+        """Create a chat completion, failing over across endpoints on provider errors"""
+        last_error: Optional[BaseException] = None
+        for endpoint in self.candidates(purpose):
+            endpoint.in_flight += 1
+            started = time.monotonic()
+            try:
+                with tracing.span("llm.chat_completion", "client", **{
+                    "llm.endpoint": endpoint.name,
+                    "llm.model": endpoint.model_for(purpose),
+                    "llm.purpose": purpose,
+                }) as span:
+                    response = await call_with_resilience(
+                        lambda: endpoint.client.chat.completions.create(
+                            model=endpoint.model_for(purpose),
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            stream=False
+                        ),
+                        breaker=endpoint.breaker,
+                        timeout=self.timeout,
+                        retry=self.retry,
+                        latency=endpoint.latency,
+                        hedge_percentile=self.hedge_percentile,
+                    )
+                    usage = getattr(response, "usage", None)
+                    if usage is not None:
+                        span.set_attribute("llm.prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+                        span.set_attribute("llm.completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+            except CircuitOpenError as e:
+                last_error = e
+                continue
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                endpoint.observe(None, failed=True)
+                logging.warning("LLM endpoint %s failed, failing over: %s", endpoint.name, e)
+                last_error = e
+                continue
+            finally:
+                endpoint.in_flight -= 1
+            endpoint.observe(time.monotonic() - started, failed=False)
+            return response
+        raise last_error
+
+    async def stream(self, messages: list, max_tokens: int, temperature: float, purpose: str = "chat"):
+        """Yield completion chunks as the provider streams them.
+
+        Failover and retries only cover opening the stream: once chunks have been handed to the
+        caller they may already be on their way to a client, so a mid-stream error propagates.
+        """
+        last_error: Optional[BaseException] = None
+        for endpoint in self.candidates(purpose):
+            endpoint.in_flight += 1
+            started = time.monotonic()
+            try:
+                with tracing.span("llm.chat_completion", "client", **{
+                    "llm.endpoint": endpoint.name,
+                    "llm.model": endpoint.model_for(purpose),
+                    "llm.purpose": purpose,
+                    "llm.stream": True,
+                }) as span:
+                    try:
+                        # No hedging: a duplicate stream would have to be drained or torn down
+                        stream = await call_with_resilience(
+                            lambda: endpoint.client.chat.completions.create(
+                                model=endpoint.model_for(purpose),
+                                messages=messages,
+                                max_tokens=max_tokens,
+                                temperature=temperature,
+                                stream=True
+                            ),
+                            breaker=endpoint.breaker,
+                            timeout=self.timeout,
+                            retry=self.retry,
+                        )
+                    except CircuitOpenError as e:
+                        last_error = e
+                        continue
+                    except Exception as e:
+                        if not is_retryable(e):
+                            raise
+                        endpoint.observe(None, failed=True)
+                        logging.warning("LLM endpoint %s failed, failing over: %s", endpoint.name, e)
+                        last_error = e
+                        continue
+                    try:
+                        async for chunk in stream:
+                            usage = getattr(chunk, "usage", None)
+                            if usage is not None:
+                                span.set_attribute("llm.prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+                                span.set_attribute("llm.completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+                            yield chunk
+                    except Exception:
+                        endpoint.observe(None, failed=True)
+                        raise
+                    finally:
+                        await stream.close()
+            finally:
+                endpoint.in_flight -= 1
+            endpoint.observe(time.monotonic() - started, failed=False)
+            return
+        raise last_error
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {endpoint.name: endpoint.snapshot() for endpoint in self.endpoints}
+
+    async def warm(self, timeout: float) -> Dict[str, bool]:
+        """Pre-open every endpoint's pool; returns which endpoints answered"""
+        async def probe(endpoint: LLMEndpoint) -> bool:
+            try:
+                await asyncio.wait_for(endpoint.warm(), timeout=timeout)
+                return True
+            except Exception as e:
+                logging.warning("LLM endpoint %s warm-up failed: %s", endpoint.name, e)
+                return False
+
+        results = await asyncio.gather(*(probe(endpoint) for endpoint in self.endpoints))
+        return dict(zip((endpoint.name for endpoint in self.endpoints), results))
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.close()
+
+
+def load_llm_router(timeout: float, retry: RetryPolicy, hedge_percentile: Optional[float]) -> LLMRouter:
+    """Build the router from LLM_ENDPOINTS (JSON list) or fall back to the single SambaNova endpoint"""
+    raw = os.getenv("LLM_ENDPOINTS")
+    if raw:
+        configs = json.loads(raw)
+    else:
+        configs = [{
+            "name": "sambanova",
+            "base_url": os.getenv("SAMBA_BASE_URL"),
+            "api_key_env": "SAMBA_API_KEY",
+            "model": os.getenv("LLM_MODEL", DEFAULT_MODEL),
+            "max_concurrency": int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+        }]
+
+    endpoints = []
+    for config in configs:
+        config = dict(config)
+        # Keep secrets out of the JSON blob by naming the variable that holds the key
+        api_key_env = config.pop("api_key_env", None)
+        if api_key_env:
+            config["api_key"] = os.getenv(api_key_env)
+        config.setdefault("api_key", None)
+        config.setdefault("timeout", timeout)
+        endpoints.append(LLMEndpoint(**config))
+
+    cost_routed = [p.strip() for p in os.getenv("LLM_COST_ROUTED_PURPOSES", "proactive").split(",") if p.strip()]
+    return LLMRouter(endpoints, timeout, retry, hedge_percentile, cost_routed)
@@ -0,0 +1,303 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from serialization import dumps_json
+import tracing
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s trace=%(trace_id)s span=%(span_id)s] %(message)s"
+# Attributes every LogRecord has; anything else on a record came from extra= and is emitted as a JSON field
+STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "request_id", "trace_id", "span_id", "suppressed", "sample_rate",
+    "color_message",  # uvicorn's ANSI-coloured copy of the message
+}
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, noting how many similar records the rate limiter held back"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{line} ({suppressed} similar suppressed)" if suppressed else line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with request/trace ids and any extra= fields as top-level keys"""
+
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+            "trace_id": getattr(record, "trace_id", "-"),
+            "span_id": getattr(record, "span_id", "-"),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if getattr(record, "sample_rate", 1.0) < 1.0:
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        try:
+            return dumps_json(entry).decode("utf-8")
+        except TypeError:
+            # An extra= value orjson cannot encode: keep the line, stringify what it could not
+            plain = (str, int, float, bool, type(None))
+            return dumps_json({k: v if isinstance(v, plain) else str(v) for k, v in entry.items()}).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records below WARNING from chosen loggers (and their children).
+
+    Kept records carry sample_rate, so counts derived from the logs can be scaled back up.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+        self._resolved: Dict[str, float] = {}
+
+    def rate_for(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            # The most specific configured ancestor wins
+            logger_name, rate = name, 1.0
+            while logger_name:
+                if logger_name in self.rates:
+                    rate = self.rates[logger_name]
+                    break
+                logger_name = logger_name.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        if rate >= 1.0:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        self.dropped += 1
+        return False
+
+
+class RateLimitFilter(logging.Filter):
+    """A token bucket per call site (logger, level and message template) that drops bursts below WARNING.
+
+    Only works when messages are %-style templates: an f-string makes every record its own
+    call site. The first record let through after a suppression says how many were dropped;
+    if none comes, a notice with the count goes to notify once the site's bucket has refilled.
+    """
+
+    MAX_KEYS = 4096
+    SWEEP_SECONDS = 1.0  # how often to look for refilled buckets that still owe a count
+
+    def __init__(self, per_second: float, burst: int, notify: Optional[Callable[[logging.LogRecord], None]] = None):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst
+        self.notify = notify
+        self.dropped = 0
+        self._buckets: Dict[tuple, List[float]] = {}  # key -> [tokens, last refill, suppressed]
+        self._owed: Dict[tuple, tuple] = {}  # key -> (template, pathname, lineno) of sites with an unreported count
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else id(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_KEYS:
+                    self._buckets.clear()
+                    self._owed.clear()
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+                bucket[1] = now
+            allowed = bucket[0] >= 1.0
+            if not allowed:
+                bucket[2] += 1
+                self.dropped += 1
+                self._owed.setdefault(key, (str(record.msg), record.pathname, record.lineno))
+            else:
+                bucket[0] -= 1.0
+                if bucket[2]:
+                    record.suppressed, bucket[2] = int(bucket[2]), 0
+                    self._owed.pop(key, None)
+            notices = self._sweep(now) if self._owed and now >= self._next_sweep else []
+        for notice in notices:
+            self.notify(notice)
+        return allowed
+
+    def _sweep(self, now: float) -> List[logging.LogRecord]:
+        """Notices for call sites that went quiet with a count owed and can log again; hold the lock"""
+        self._next_sweep = now + self.SWEEP_SECONDS
+        notices = []
+        for key, (template, pathname, lineno) in list(self._owed.items()):
+            bucket = self._buckets[key]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+            if tokens < 1.0:
+                continue
+            del self._owed[key]
+            bucket[0], bucket[1] = tokens - 1.0, now
+            if self.notify is not None:
+                name, levelno, _ = key
+                notice = logging.LogRecord(name, levelno, pathname, lineno, "Rate limit lifted for: %s", (template,), None)
+                notice.suppressed = int(bucket[2])
+                notices.append(notice)
+            bucket[2] = 0
+        return notices
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Hands records to a daemon thread that formats and writes them; drops records rather than block.
+
+    The filters run on the calling thread, before a record is queued, so request context is read
+    where it is set and suppressed records cost no more than the filter. The listener thread is
+    started lazily and again after a fork, like the span exporter.
+    """
+
+    def __init__(self, targets: List[logging.Handler], max_queue: int = 10000):
+        super().__init__(queue.Queue(max_queue))
+        self.targets = targets
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._reported_drops = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._pid = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, since they may change once the caller moves on, but leave
+        # timestamps, JSON and tracebacks to the listener thread
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped != self._reported_drops:
+            missed, self._reported_drops = self.dropped - self._reported_drops, self.dropped
+            self.notice(logging.LogRecord(__name__, logging.WARNING, __file__, 0, "Log queue was full, dropped %d records", (missed,), None))
+
+    def notice(self, record: logging.LogRecord):
+        """Queue a record the pipeline produced itself, past the filters; lost if the queue is full"""
+        record.request_id = record.trace_id = record.span_id = "-"
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            pass
+
+    def _ensure_listener(self):
+        if self._pid != os.getpid():
+            # A forked child inherits neither the thread nor a usable queue lock
+            self._pid = os.getpid()
+            self.queue = queue.Queue(self.max_queue)
+            self._listener = logging.handlers.QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self._listener.start()
+
+    def stop(self):
+        """Write out what is queued; called at exit"""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+_pipeline: Optional[BackgroundHandler] = None
+_filters: List[logging.Filter] = []
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """"chat.proactive=0.05,uvicorn.access=0.1" -> {"chat.proactive": 0.05, "uvicorn.access": 0.1}"""
+    rates = {}
+    for item in spec.split(","):
+        name, _, rate = item.strip().partition("=")
+        if name and rate:
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def configure(
+    level: str = "INFO",
+    json_format: bool = False,
+    max_queue: int = 10000,
+    sample_rates: Optional[Dict[str, float]] = None,
+    rate_limit_per_second: float = 5.0,
+    rate_limit_burst: int = 20,
+    capture_uvicorn: bool = True,
+):
+    """Route every log record through one queue to a background writer on stderr"""
+    global _pipeline
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if json_format else TextFormatter(TEXT_FORMAT))
+    pipeline = BackgroundHandler([stream], max_queue)
+    _filters.clear()
+    if sample_rates:
+        _filters.append(SamplingFilter(sample_rates))
+    if rate_limit_per_second > 0:
+        _filters.append(RateLimitFilter(rate_limit_per_second, rate_limit_burst, notify=pipeline.notice))
+    _filters.append(tracing.RequestContextFilter())  # last: only for records that will be written
+    for log_filter in _filters:
+        pipeline.addFilter(log_filter)
+
+    root = logging.getLogger()
+    if _pipeline is not None:
+        root.removeHandler(_pipeline)
+        _pipeline.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(pipeline)
+    root.setLevel(level.upper())
+    if capture_uvicorn:
+        # uvicorn's own handlers write to the terminal from the event loop, one access line per request
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            uvicorn_logger = logging.getLogger(name)
+            uvicorn_logger.handlers.clear()
+            uvicorn_logger.propagate = True
+    _pipeline = pipeline
+
+
+def stats() -> Dict[str, int]:
+    """Records discarded so far in this process, by reason"""
+    counts = {"queue_full": _pipeline.dropped if _pipeline else 0, "sampled": 0, "rate_limited": 0}
+    for log_filter in _filters:
+        if isinstance(log_filter, SamplingFilter):
+            counts["sampled"] = log_filter.dropped
+        elif isinstance(log_filter, RateLimitFilter):
+            counts["rate_limited"] = log_filter.dropped
+    return counts
+
+
+@atexit.register
+def _flush_at_exit():
+    if _pipeline is not None:
+        _pipeline.stop()
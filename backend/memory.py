@@ -0,0 +1,165 @@
+import math
+import re
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from typing import Hashable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+TOKEN = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a about am an and are as at be been but by can do for from had has have he her him his how i i'm if in is "
+    "it it's its just me my of oh on or our she so that the their them then there they this to too was we were "
+    "what when which who will with would you you're your".split()
+)
+
+
+class HashingEmbedder:
+    """Words and word pairs hashed into a fixed number of signed buckets (the hashing trick).
+
+    No model to download or load, and crc32 rather than hash() keeps vectors identical across
+    processes. Good at "which earlier message mentioned the dog's name", not at paraphrase.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def features(self, text: str) -> Counter:
+        words = [word for word in TOKEN.findall(text.lower()) if word not in STOPWORDS]
+        grams = Counter(words)
+        grams.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+        return grams
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """One L2-normalised float32 row per text; texts with no features get a zero row"""
+        cells, weights = [], []
+        for row, text in enumerate(texts):
+            offset = row * self.dimensions
+            for gram, count in self.features(text).items():
+                hashed = zlib.crc32(gram.encode("utf-8"))
+                cells.append(offset + hashed % self.dimensions)
+                # Sublinear term frequency; the sign bit keeps collisions from only ever adding up
+                weights.append((1.0 + math.log(count)) * (1.0 if hashed & 0x80000000 else -1.0))
+        size = len(texts) * self.dimensions
+        vectors = np.bincount(cells, weights, minlength=size).astype(np.float32).reshape(len(texts), self.dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class Recollection(NamedTuple):
+    position: int  # index of the message in the conversation history
+    role: str
+    text: str  # the message, cut to the memory's snippet length
+    score: float  # cosine similarity to the query
+
+
+class ConversationIndex:
+    """One conversation's message vectors, in a float32 matrix that doubles as it fills"""
+
+    def __init__(self, dimensions: int, capacity: int = 32):
+        self._vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.size = 0
+        self.roles: List[str] = []
+        self.snippets: List[str] = []
+        self.checksum = _history_hash(())  # of every indexed message, in order
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes
+
+    def add(self, roles: List[str], snippets: List[str], vectors: np.ndarray, checksum: int):
+        needed = self.size + len(vectors)
+        if needed > len(self._vectors):
+            grown = np.zeros((max(needed, 2 * len(self._vectors)), self._vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self._vectors[:self.size]
+            self._vectors = grown
+        self._vectors[self.size:needed] = vectors
+        self.size = needed
+        self.roles.extend(roles)
+        self.snippets.extend(snippets)
+        self.checksum = checksum
+
+    def search(self, query: np.ndarray, k: int, before: int, min_score: float) -> List[Tuple[int, float]]:
+        """(position, score) of the k messages before `before` most similar to query, best first"""
+        scores = self._vectors[:before] @ query
+        if k < before:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(before)
+        top = top[np.argsort(-scores[top])]
+        return [(int(position), float(scores[position])) for position in top if scores[position] >= min_score]
+
+
+def _history_hash(messages: Sequence[Tuple[str, str]]) -> int:
+    """hash() of the (role, text) pairs. Strings hash with SipHash under a per-process random key,
+    so no history can be crafted to match another's; a string caches its hash, so hashing the
+    same request's messages twice costs little more than once.
+    """
+    return hash(tuple(messages))
+
+
+class ConversationMemory:
+    """Per-conversation vector indexes over the history clients send, kept in an LRU in this process.
+
+    Clients send the whole history with every request, so an index is only a cache: each request
+    embeds just the messages that are new since the last one, and an evicted or never-seen
+    conversation is rebuilt on demand. An index is reused only if the checksum of everything it
+    holds matches the same messages in the request, so recall can only ever return messages the
+    caller sent itself; any other history under the same key is re-indexed from scratch.
+    Thread-safe, so a first look at a long history can be embedded off the event loop.
+    """
+
+    def __init__(
+        self,
+        embedder: HashingEmbedder,
+        max_bytes: int = 64 * 1024 * 1024,
+        snippet_chars: int = 300,
+        min_score: float = 0.1,
+    ):
+        self.embedder = embedder
+        self.max_bytes = max_bytes
+        self.snippet_chars = snippet_chars
+        self.min_score = min_score
+        self.size = 0
+        self._indexes: "OrderedDict[Hashable, ConversationIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self, key: Hashable, messages: Sequence[Tuple[str, str]]) -> ConversationIndex:
+        """The conversation's index, brought up to date with messages ((role, text) pairs); hold the lock"""
+        index = self._indexes.pop(key, None)
+        if index is not None:
+            self.size -= index.nbytes
+            if index.size > len(messages) or index.checksum != _history_hash(messages[:index.size]):
+                index = None
+        if index is None:
+            index = ConversationIndex(self.embedder.dimensions)
+        new = messages[index.size:]
+        if new:
+            index.add(
+                [role for role, _ in new],
+                [text[:self.snippet_chars] for _, text in new],
+                self.embedder.embed([text for _, text in new]),
+                _history_hash(messages)
+            )
+        self._indexes[key] = index
+        self.size += index.nbytes
+        while self.size > self.max_bytes and len(self._indexes) > 1:
+            _, evicted = self._indexes.popitem(last=False)
+            self.size -= evicted.nbytes
+        return index
+
+    def recall(self, key: Hashable, messages: Sequence[Tuple[str, str]], query: str, k: int, skip_recent: int) -> List[Recollection]:
+        """The k earlier messages most relevant to query, in conversation order.
+
+        The last skip_recent messages are left out, since the prompt carries those verbatim.
+        """
+        searchable = len(messages) - skip_recent
+        vector = self.embedder.embed([query])[0]
+        with self._lock:
+            index = self.index(key, messages)
+            if searchable <= 0 or k <= 0 or not vector.any():
+                return []
+            hits = sorted(index.search(vector, k, searchable, self.min_score))
+        return [Recollection(position, index.roles[position], index.snippets[position], score) for position, score in hits]
@@ -0,0 +1,162 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+import server_timing
+import tracing
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+BUILTIN_PERSONALITIES = {"lover", "therapist", "best_friend", "fantasy_rpg", "neutral"}
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of the chat pipeline",
+    ["endpoint", "personality", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time until the first streamed token arrives",
+    ["endpoint", "personality"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Prompt and completion tokens reported by the LLM",
+    ["endpoint", "personality", "direction"],
+)
+IMAGES = Counter(
+    "images_generated_total",
+    "Image renders by outcome",
+    ["endpoint", "personality", "outcome"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache and result",
+    ["cache", "result"],
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "rate_limit_rejections_total",
+    "Requests rejected by the token-bucket rate limiter",
+    ["endpoint"],
+)
+
+_labels: ContextVar[Dict[str, str]] = ContextVar("metric_labels", default={"endpoint": "unknown", "personality": "unknown"})
+
+
+def personality_label(personality: str) -> str:
+    """Custom personality ids are unbounded, so they share one label value"""
+    return personality if personality in BUILTIN_PERSONALITIES else "custom"
+
+
+def bind(endpoint: str, personality: str = "none"):
+    """Set the endpoint/personality labels for every metric recorded in this request"""
+    _labels.set({"endpoint": endpoint, "personality": personality_label(personality)})
+
+
+def current_labels() -> Dict[str, str]:
+    return _labels.get()
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Observe the block's duration as one pipeline stage, traced as a span of the same name"""
+    started = time.perf_counter()
+    try:
+        with tracing.span(name, **attributes) as span:
+            yield span
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(stage=name, **_labels.get()).observe(seconds)
+    server_timing.add(name, seconds)
+
+
+def observe_time_to_first_token(seconds: float):
+    LLM_TIME_TO_FIRST_TOKEN.labels(**_labels.get()).observe(seconds)
+
+
+def record_tokens(usage):
+    """Count tokens from an OpenAI-style usage object, if the provider sent one"""
+    if usage is None:
+        return
+    labels = _labels.get()
+    LLM_TOKENS.labels(direction="in", **labels).inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(direction="out", **labels).inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+def record_image(outcome: str):
+    IMAGES.labels(outcome=outcome, **_labels.get()).inc()
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_rate_limited(endpoint: str):
+    RATE_LIMIT_REJECTIONS.labels(endpoint=endpoint).inc()
+
+
+class SnapshotCollector:
+    """Exports admission queues and circuit breakers by reading their live state at scrape time"""
+
+    def __init__(self, admission_controllers: Callable[[], Iterable], breakers: Callable[[], Iterable]):
+        self.admission_controllers = admission_controllers
+        self.breakers = breakers
+
+    def collect(self):
+        depth = GaugeMetricFamily("admission_queue_depth", "Requests waiting for upstream capacity", labels=["upstream", "priority"])
+        in_use = GaugeMetricFamily("admission_in_use", "Upstream slots currently held", labels=["upstream"])
+        admitted = CounterMetricFamily("admission_admitted", "Requests admitted to an upstream", labels=["upstream", "priority"])
+        rejected = CounterMetricFamily("admission_rejected", "Requests shed by admission control", labels=["upstream", "priority", "reason"])
+        wait_avg = GaugeMetricFamily("admission_wait_seconds_avg", "Mean queue wait", labels=["upstream", "priority"])
+        wait_max = GaugeMetricFamily("admission_wait_seconds_max", "Longest queue wait", labels=["upstream", "priority"])
+        for controller in self.admission_controllers():
+            snapshot = controller.snapshot()
+            upstream = snapshot["upstream"]
+            in_use.add_metric([upstream], snapshot["in_use"])
+            for priority, stats in snapshot["classes"].items():
+                depth.add_metric([upstream, priority], stats["queued"])
+                admitted.add_metric([upstream, priority], stats["admitted"])
+                wait_avg.add_metric([upstream, priority], stats["wait_seconds_avg"])
+                wait_max.add_metric([upstream, priority], stats["wait_seconds_max"])
+                for reason, count in stats["rejected"].items():
+                    rejected.add_metric([upstream, priority, reason], count)
+
+        breaker_open = GaugeMetricFamily("circuit_breaker_open", "1 while a provider circuit is open or half-open", labels=["provider"])
+        for breaker in self.breakers():
+            breaker_open.add_metric([breaker.name], 0 if breaker.state == breaker.CLOSED else 1)
+
+        yield from (depth, in_use, admitted, rejected, wait_avg, wait_max, breaker_open)
+
+
+def register_snapshot_collector(admission_controllers, breakers):
+    REGISTRY.register(SnapshotCollector(admission_controllers, breakers))
+
+
+class LogCollector:
+    """Exports how many log records were sampled out, rate limited or dropped on a full queue"""
+
+    def __init__(self, stats: Callable[[], Dict[str, int]]):
+        self.stats = stats
+
+    def collect(self):
+        discarded = CounterMetricFamily("log_records_discarded", "Log records never written, by reason", labels=["reason"])
+        for reason, count in self.stats().items():
+            discarded.add_metric([reason], count)
+        yield discarded
+
+
+def register_log_collector(stats):
+    REGISTRY.register(LogCollector(stats))
+
+
+def render_latest():
+    """Body and content type for the /metrics endpoint"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,51 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a helper thread and folds the stacks for flamegraphs.
+
+    Sampling the event-loop thread from outside means blocking calls (a sync SDK call,
+    a long regex, a big json.dumps) show up with their full stack even while the loop is stuck.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        self.stopped_at = time.monotonic()
+        return dict(self.samples)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def folded(self) -> str:
+        """Collapsed-stack format, readable by flamegraph.pl, speedscope and inferno"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
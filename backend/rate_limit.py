@@ -0,0 +1,259 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a bucket does not hold enough tokens for the request's cost"""
+
+    def __init__(self, key: str, retry_after: int):
+        super().__init__(f"Rate limit exceeded for {key}")
+        self.key = key
+        self.retry_after = retry_after
+
+
+class RateLimitRule:
+    """Token bucket parameters parsed from a slowapi-style string such as "20/minute"."""
+
+    def __init__(self, spec: str):
+        amount, _, period = spec.partition("/")
+        self.spec = spec
+        self.capacity = float(amount)
+        self.refill_per_second = self.capacity / PERIODS[period.strip().rstrip("s")]
+
+    def scaled(self, factor: float) -> "RateLimitRule":
+        rule = RateLimitRule(self.spec)
+        rule.capacity *= factor
+        rule.refill_per_second *= factor
+        return rule
+
+
+def estimate_cost(max_tokens: int = 0, history_chars: int = 0, images: int = 0, image_cost: float = 2.0) -> float:
+    """Cost in bucket units: 1 unit per 1000 completion tokens, ~4 chars per prompt token"""
+    prompt_tokens = history_chars / 4
+    return max_tokens / 1000 + prompt_tokens / 4000 + images * image_cost
+
+
+def _refill(tokens: float, updated_at: float, now: float, rule: RateLimitRule) -> float:
+    return min(rule.capacity, tokens + max(0.0, now - updated_at) * rule.refill_per_second)
+
+
+def _retry_after(tokens: float, cost: float, rule: RateLimitRule) -> int:
+    return max(1, math.ceil((cost - tokens) / rule.refill_per_second))
+
+
+class MemoryBucketStorage:
+    """Per-process buckets; only correct with a single worker"""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def take(self, key: str, cost: float, rule: RateLimitRule) -> Tuple[bool, float]:
+        now = time.time()
+        tokens, updated_at = self._buckets.get(key, (rule.capacity, now))
+        tokens = _refill(tokens, updated_at, now, rule)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        if len(self._buckets) >= self.max_keys and key not in self._buckets:
+            self._buckets.clear()  # every bucket refills eventually; dropping them only forgives
+        self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+    async def refund(self, key: str, amount: float, rule: RateLimitRule):
+        entry = self._buckets.get(key)
+        if entry is not None:
+            tokens, updated_at = entry
+            self._buckets[key] = (min(rule.capacity, tokens + amount), updated_at)
+
+
+class SharedMemoryBucketStorage:
+    """Buckets in a memory-mapped file shared by every worker on the host, guarded by flock"""
+
+    SLOT = struct.Struct("<Qddd")  # key hash, tokens, updated_at, time the bucket is full again
+    PROBES = 8
+
+    def __init__(self, path: Optional[str] = None, slots: int = 65536):
+        default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.path = path or os.path.join(default_dir, "chat-api-ratelimit")
+        self.slots = slots
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _ensure_open(self):
+        # Re-open after fork: an inherited flock descriptor would be shared with the parent
+        if self._pid == os.getpid():
+            return
+        size = self.slots * self.SLOT.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def _key_hash(self, key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def _find(self, key_hash: int, now: float):
+        """(offset, tokens, updated_at) of the key's slot, or (offset to claim, None, None); hold the lock"""
+        start = key_hash % self.slots
+        free, oldest, oldest_at = None, None, None
+        for probe in range(self.PROBES):
+            offset = ((start + probe) % self.slots) * self.SLOT.size
+            slot_hash, tokens, updated_at, full_at = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, updated_at
+            if free is None and (slot_hash == 0 or full_at <= now):
+                # A bucket that has refilled completely is the same as no bucket
+                free = offset
+            if oldest_at is None or updated_at < oldest_at:
+                oldest, oldest_at = offset, updated_at
+        return (free if free is not None else oldest), None, None
+
+    async def take(self, key: str, cost: float, rule: RateLimitRule) -> Tuple[bool, float]:
+        self._ensure_open()
+        key_hash = self._key_hash(key)
+        now = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            offset, tokens, updated_at = self._find(key_hash, now)
+            tokens = rule.capacity if tokens is None else _refill(tokens, updated_at, now, rule)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            full_at = now + (rule.capacity - tokens) / rule.refill_per_second
+            self.SLOT.pack_into(self._map, offset, key_hash, tokens, now, full_at)
+            return allowed, tokens
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def refund(self, key: str, amount: float, rule: RateLimitRule):
+        self._ensure_open()
+        key_hash = self._key_hash(key)
+        now = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            offset, tokens, updated_at = self._find(key_hash, now)
+            if tokens is None:
+                return  # evicted, which already means full
+            tokens = min(rule.capacity, _refill(tokens, updated_at, now, rule) + amount)
+            full_at = now + (rule.capacity - tokens) / rule.refill_per_second
+            self.SLOT.pack_into(self._map, offset, key_hash, tokens, now, full_at)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class MongoBucketStorage:
+    """Buckets shared by every worker and host, updated atomically with a pipeline update"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def take(self, key: str, cost: float, rule: RateLimitRule) -> Tuple[bool, float]:
+        from pymongo import ReturnDocument
+
+        now = time.time()
+        refilled = {"$min": [
+            rule.capacity,
+            {"$add": [
+                {"$ifNull": ["$tokens", rule.capacity]},
+                {"$multiply": [
+                    {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]},
+                    rule.refill_per_second,
+                ]},
+            ]},
+        ]}
+        document = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"refilled": refilled}},
+                {"$set": {
+                    "allowed": {"$gte": ["$refilled", cost]},
+                    "tokens": {"$cond": [
+                        {"$gte": ["$refilled", cost]},
+                        {"$subtract": ["$refilled", cost]},
+                        "$refilled",
+                    ]},
+                    "updated_at": now,
+                    "expires_at": datetime.utcnow() + timedelta(
+                        seconds=rule.capacity / rule.refill_per_second
+                    ),
+                }},
+                {"$unset": "refilled"},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return document["allowed"], document["tokens"]
+
+    async def refund(self, key: str, amount: float, rule: RateLimitRule):
+        # updated_at is left alone, so the next take still refills from the original charge
+        await self.collection.update_one(
+            {"_id": key},
+            [{"$set": {"tokens": {"$min": [rule.capacity, {"$add": ["$tokens", amount]}]}}}],
+        )
+
+
+class TokenBucketLimiter:
+    """Cost-weighted token buckets keyed by user and client IP over pluggable shared storage"""
+
+    def __init__(self, storage, rules: Dict[str, RateLimitRule], ip_multiplier: float = 5.0):
+        self.storage = storage
+        self.rules = rules
+        self.ip_multiplier = ip_multiplier
+        self.rejections: Dict[str, int] = {}
+
+    async def check(self, scope: str, cost: float, ip: str, user_id: Optional[str] = None):
+        """Charge cost against every bucket that applies, raising RateLimitExceeded if one is short.
+
+        user_id must be a verified id (one the server issued), never a client-chosen header: it
+        earns the IP bucket ip_multiplier times the room, so several users can share a NAT.
+        Buckets are charged one at a time, so a rejection refunds the ones already charged: a
+        request throttled by its IP bucket does not also spend its user's quota.
+        """
+        rule = self.rules.get(scope)
+        if rule is None:
+            return
+        buckets: List[Tuple[str, RateLimitRule]] = []
+        if user_id:
+            # The IP bucket stays as a looser backstop against one address minting many users
+            buckets.append((f"{scope}:user:{user_id}", rule))
+            buckets.append((f"{scope}:ip:{ip}", rule.scaled(self.ip_multiplier)))
+        else:
+            buckets.append((f"{scope}:ip:{ip}", rule))
+
+        charged: List[Tuple[str, float, RateLimitRule]] = []
+        for key, bucket_rule in buckets:
+            # A request bigger than the whole bucket may still run once the bucket is full
+            bucket_cost = min(cost, bucket_rule.capacity)
+            allowed, tokens = await self.storage.take(key, bucket_cost, bucket_rule)
+            if not allowed:
+                for charged_key, charged_cost, charged_rule in charged:
+                    await self.storage.refund(charged_key, charged_cost, charged_rule)
+                self.rejections[scope] = self.rejections.get(scope, 0) + 1
+                raise RateLimitExceeded(key, _retry_after(tokens, bucket_cost, bucket_rule))
+            charged.append((key, bucket_cost, bucket_rule))
+
+
+def create_bucket_storage(kind: str, db=None):
+    """memory | shared | mongo"""
+    if kind == "mongo":
+        return MongoBucketStorage(db.rate_limit_buckets)
+    if kind == "memory":
+        return MemoryBucketStorage()
+    return SharedMemoryBucketStorage(os.getenv("RATE_LIMIT_SHM_PATH"))
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import tracing
+from serialization import dumps_json, dumps_msgpack, loads_json, loads_msgpack, msgpack
+
+SUBPROTOCOLS = ("msgpack", "json")  # preference order; JSON text frames when the client names neither
+GOING_AWAY = 1001  # the server is shutting down
+SLOW_CONSUMER = 1013  # "try again later": the client stopped reading its frames
+MESSAGE_TOO_BIG = 1009
+
+Handler = Callable[["Session", str, dict], Awaitable[Optional[dict]]]
+
+
+class TokenStream:
+    """Sends one request's streamed text as "token" frames, merging deltas that arrive within interval seconds"""
+
+    def __init__(self, session: "Session", request_id: str, interval: float):
+        self.session = session
+        self.request_id = request_id
+        self.interval = interval
+        self._pending: List[str] = []
+        self._sent_at = float("-inf")  # the first token goes out at once
+
+    async def write(self, text: str):
+        self._pending.append(text)
+        if time.monotonic() - self._sent_at >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if self._pending:
+            text = "".join(self._pending)
+            self._pending.clear()
+            self._sent_at = time.monotonic()
+            await self.session.send({"id": self.request_id, "type": "token", "text": text})
+
+
+class Session:
+    """One client's WebSocket, multiplexing correlated requests, streamed events and server pushes.
+
+    Client frames are {"id", "type", "body"}. Every frame answering a request repeats its id:
+    any "token" frames, then one "result" or "error". Pushes started by a request ("image_ready",
+    "proactive") repeat it too. {"type": "cancel", "id"} stops a request and its pushes, and
+    {"type": "ping"} gets a "pong".
+
+    Flow control: at most max_in_flight requests run at once (more are refused with a 429), and
+    outgoing frames go through one bounded queue with a single writer, so a slow reader slows
+    its own producers down; one that stops reading for send_timeout seconds is disconnected.
+
+    go_away() (on shutdown) refuses new requests and closes with 1001 once the running ones have
+    answered, so an idle connection closes at once instead of holding up the drain.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        handlers: Dict[str, Handler],
+        max_in_flight: int = 4,
+        max_background: int = 16,
+        send_queue: int = 64,
+        send_timeout: float = 10.0,
+        max_message_bytes: int = 1024 * 1024,
+        token_interval: float = 0.025,
+    ):
+        self.websocket = websocket
+        self.handlers = handlers
+        self.max_in_flight = max_in_flight
+        self.max_background = max_background
+        self.send_timeout = send_timeout
+        self.max_message_bytes = max_message_bytes
+        self.token_interval = token_interval
+        self.encoding = "json"
+        self.state: Dict = {}  # per-connection state shared by the handlers
+        self._outbox: asyncio.Queue = asyncio.Queue(send_queue)
+        self._requests: Dict[str, asyncio.Task] = {}
+        self._background: Dict[str, Set[asyncio.Task]] = {}
+        self._writer: Optional[asyncio.Task] = None
+        self._closed = False
+        self._going_away = False
+
+    async def run(self):
+        """Accept the connection and serve it until the client goes away"""
+        offered = self.websocket.scope.get("subprotocols") or []
+        subprotocol = next(
+            (name for name in SUBPROTOCOLS if name in offered and (name != "msgpack" or msgpack is not None)),
+            None
+        )
+        self.encoding = subprotocol or "json"
+        await self.websocket.accept(subprotocol=subprotocol)
+        self._writer = asyncio.create_task(self._write())
+        try:
+            await self._read()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            tasks = [self._writer, *self._requests.values()]
+            for group in self._background.values():
+                tasks.extend(group)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def send(self, frame: dict):
+        """Queue a frame for the writer, waiting while the queue is full"""
+        if self._closed:
+            return
+        try:
+            await asyncio.wait_for(self._outbox.put(frame), self.send_timeout)
+        except asyncio.TimeoutError:
+            logging.warning("WebSocket client stopped reading for %ss, disconnecting it", self.send_timeout)
+            await self.close(SLOW_CONSUMER)
+
+    async def close(self, code: int):
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code)
+        except Exception:
+            pass  # already gone
+
+    def go_away(self):
+        """Close with 1001 as soon as no request is running"""
+        self._going_away = True
+        if not self._requests:
+            asyncio.create_task(self._leave())
+
+    async def _leave(self):
+        # Let the writer send the frames already queued (e.g. the last result) before closing
+        try:
+            await asyncio.wait_for(self._outbox.join(), self.send_timeout)
+        except asyncio.TimeoutError:
+            pass
+        await self.close(GOING_AWAY)
+
+    def token_stream(self, request_id: str) -> TokenStream:
+        return TokenStream(self, request_id, self.token_interval)
+
+    def background(self, request_id: str, coro) -> bool:
+        """Run a push (e.g. an image-ready notification) for a request after it has answered.
+
+        Returns False, and drops the push, when the connection already runs max_background.
+        """
+        if sum(len(group) for group in self._background.values()) >= self.max_background:
+            coro.close()
+            return False
+        task = asyncio.create_task(coro)
+        group = self._background.setdefault(request_id, set())
+        group.add(task)
+
+        def done(finished: asyncio.Task):
+            group.discard(finished)
+            if not group and self._background.get(request_id) is group:
+                del self._background[request_id]
+            if not finished.cancelled() and finished.exception() is not None:
+                logging.error("WebSocket push for request %s failed: %s", request_id, finished.exception())
+
+        task.add_done_callback(done)
+        return True
+
+    def cancel_background(self, request_id: str):
+        for task in self._background.pop(request_id, set()):
+            task.cancel()
+
+    def cancel(self, request_id: str):
+        task = self._requests.get(request_id)
+        if task is not None:
+            task.cancel()
+        self.cancel_background(request_id)
+
+    async def _write(self):
+        while True:
+            frame = await self._outbox.get()
+            if self.encoding == "msgpack":
+                await self.websocket.send_bytes(dumps_msgpack(frame))
+            else:
+                await self.websocket.send_text(dumps_json(frame).decode("utf-8"))
+            self._outbox.task_done()
+
+    async def _read(self):
+        while not self._closed:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data = message.get("text")
+            if data is None:
+                data = message.get("bytes") or b""
+            if len(data) > self.max_message_bytes:
+                await self.close(MESSAGE_TOO_BIG)
+                return
+            try:
+                frame = loads_msgpack(data) if isinstance(data, bytes) and self.encoding == "msgpack" else loads_json(data)
+            except Exception:
+                await self.send({"type": "error", "status": 400, "detail": "Malformed frame"})
+                continue
+            if not isinstance(frame, dict):
+                await self.send({"type": "error", "status": 400, "detail": "Frames must be objects"})
+                continue
+            await self._dispatch(frame)
+
+    async def _dispatch(self, frame: dict):
+        frame_type = frame.get("type")
+        request_id = frame.get("id")
+        if frame_type == "ping":
+            await self.send({"id": request_id, "type": "pong"})
+            return
+        if frame_type == "cancel":
+            self.cancel(request_id)
+            return
+
+        handler = self.handlers.get(frame_type)
+        if handler is None:
+            error = (400, f"Unknown frame type, expected one of: {', '.join(['ping', 'cancel', *self.handlers])}")
+        elif not isinstance(request_id, str) or not request_id:
+            error = (400, "Every request needs a string id")
+        elif request_id in self._requests:
+            error = (409, "A request with this id is still in flight")
+        elif self._going_away:
+            error = (503, "The server is restarting, reconnect to continue")
+        elif len(self._requests) >= self.max_in_flight:
+            error = (429, f"At most {self.max_in_flight} requests can be in flight per connection")
+        else:
+            task = asyncio.create_task(self._handle(handler, frame_type, request_id, frame.get("body") or {}))
+            self._requests[request_id] = task
+            task.add_done_callback(lambda _: self._finished(request_id))
+            return
+        status, detail = error
+        await self.send({"id": request_id, "type": "error", "status": status, "detail": detail})
+
+    def _finished(self, request_id: str):
+        self._requests.pop(request_id, None)
+        if self._going_away and not self._requests:
+            asyncio.create_task(self._leave())
+
+    async def _handle(self, handler: Handler, frame_type: str, request_id: str, body: dict):
+        with tracing.span(f"ws.{frame_type}", "server", **{"ws.request_id": request_id}) as span:
+            try:
+                result = await handler(self, request_id, body)
+            except HTTPException as e:
+                span.set_attribute("http.status_code", e.status_code)
+                frame = {"id": request_id, "type": "error", "status": e.status_code, "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    frame["retry_after"] = float(e.headers["Retry-After"])
+                await self.send(frame)
+                return
+            except ValidationError as e:
+                await self.send({
+                    "id": request_id,
+                    "type": "error",
+                    "status": 422,
+                    "detail": e.errors(include_url=False, include_context=False)
+                })
+                return
+            except Exception as e:
+                logging.error("WebSocket %s request failed: %s", frame_type, e)
+                span.status = "error"
+                await self.send({"id": request_id, "type": "error", "status": 500, "detail": "Internal error"})
+                return
+            await self.send({"id": request_id, "type": "result", "body": result})
@@ -0,0 +1,187 @@
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "APITimeoutError",
+    "APIConnectionError",
+    "ConnectError",
+    "ConnectTimeout",
+    "ReadError",
+    "ReadTimeout",
+    "WriteTimeout",
+    "PoolTimeout",
+    "RemoteProtocolError",
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose breaker is open"""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} circuit is open")
+        self.status_code = 503
+        self.retry_after = retry_after
+        self.reason = f"{name} is temporarily unavailable"
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Timeouts, connection failures and 408/429/5xx responses are worth another attempt"""
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return type(exc).__name__ in RETRYABLE_ERROR_NAMES
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures, half-open probe after a cool-down"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_failures = 0
+        self.total_short_circuits = 0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            remaining = self.recovery_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                self.total_short_circuits += 1
+                raise CircuitOpenError(self.name, math.ceil(remaining))
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # Only one probe at a time; everybody else keeps failing fast
+            if self._probe_in_flight:
+                self.total_short_circuits += 1
+                raise CircuitOpenError(self.name, 1)
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_ignored(self):
+        # Non-retryable errors (bad request etc.) say nothing about provider health
+        self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "total_failures": self.total_failures,
+            "short_circuits": self.total_short_circuits,
+        }
+
+
+class LatencyTracker:
+    """Sliding window of recent call latencies, used to pick the hedging delay"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RetryPolicy:
+    """Bounded attempts with full-jitter exponential backoff"""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.25, max_delay: float = 4.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+async def call_with_resilience(
+    call: Callable[[], Awaitable[Any]],
+    breaker: CircuitBreaker,
+    timeout: float,
+    retry: RetryPolicy,
+    latency: Optional[LatencyTracker] = None,
+    hedge_percentile: Optional[float] = None,
+) -> Any:
+    """Run call with a per-attempt deadline, retries on retryable errors and a circuit breaker"""
+    for attempt in range(retry.attempts):
+        breaker.before_call()
+        started = time.monotonic()
+        try:
+            hedge_after = latency.percentile(hedge_percentile) if latency and hedge_percentile else None
+            if hedge_after is not None and hedge_after < timeout:
+                result = await asyncio.wait_for(_hedged(call, hedge_after), timeout=timeout)
+            else:
+                result = await asyncio.wait_for(call(), timeout=timeout)
+        except asyncio.CancelledError:
+            breaker.record_ignored()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_ignored()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= retry.attempts:
+                raise
+            await asyncio.sleep(retry.backoff(attempt))
+            continue
+        breaker.record_success()
+        if latency:
+            latency.observe(time.monotonic() - started)
+        return result
+
+
+async def _hedged(call: Callable[[], Awaitable[Any]], hedge_after: float) -> Any:
+    """Start a second identical call if the first is slower than hedge_after; first success wins"""
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            tasks.append(asyncio.ensure_future(call()))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,129 @@
+import base64
+import json
+from datetime import date, datetime
+from typing import Dict, Optional
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.responses import Response
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # stdlib json is the fallback, just slower
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # without msgpack every client gets JSON
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack", "application/vnd.msgpack")
+# Headers the handler set on FastAPI's injected Response that describe its (empty) body, not ours
+BODY_HEADERS = (b"content-length", b"content-type")
+
+
+def accepted_types(accept: Optional[str]) -> Dict[str, float]:
+    """Media types listed in an Accept header, with their q-values"""
+    types = {}
+    for item in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            types[media_type.lower()] = quality
+    return types
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """msgpack is opt-in: only when the client names it, and prefers it at least as much as JSON"""
+    if msgpack is None:
+        return False
+    types = accepted_types(accept)
+    preference = max((types.get(media_type, 0) for media_type in MSGPACK_TYPES), default=0)
+    return preference > 0 and preference >= types.get("application/json", 0)
+
+
+def _json_default(value):
+    # Image bytes travel raw through the handlers and only become base64 at the JSON boundary
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _msgpack_default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, memoryview):
+        return bytes(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not msgpack serializable")
+
+
+def dumps_json(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_msgpack(content) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+
+
+def loads_json(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def loads_msgpack(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (stdlib json without it); bytes values become base64"""
+
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+
+class MsgPackResponse(Response):
+    """Binary responses for clients that ask for them; bytes values (images) stay raw"""
+
+    media_type = MSGPACK
+
+    def render(self, content) -> bytes:
+        return dumps_msgpack(content)
+
+
+def respond(request, content, response: Optional[Response] = None, status_code: int = 200) -> Response:
+    """Encode a handler's payload as JSON or msgpack (by Accept), bypassing FastAPI's encoder.
+
+    Returning a Response skips FastAPI's second validation against response_model and its
+    jsonable_encoder walk; our payloads are already built from our own models. Headers the
+    handler set on an injected `response` are carried over, as FastAPI would have.
+    """
+    if isinstance(content, BaseModel):
+        content = content.model_dump()
+    response_class = MsgPackResponse if wants_msgpack(request.headers.get("accept")) else FastJSONResponse
+    with metrics.stage("serialization"):
+        encoded = response_class(content, status_code=status_code)
+    if response is not None:
+        encoded.raw_headers.extend(
+            (name, value) for name, value in response.raw_headers if name not in BODY_HEADERS
+        )
+        if response.status_code:
+            encoded.status_code = response.status_code
+    encoded.headers.append("Vary", "Accept")
+    return encoded
@@ -1,49 +1,436 @@
 import os
+import asyncio
 import logging
-import re
-import base64
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import List, Dict, Optional
-from datetime import datetime
+from typing import List, Dict, Optional, Set
+from datetime import datetime, timezone
 
-from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.requests import HTTPConnection
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from openai import OpenAI
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-import fal_client
+import httpx
+
+from admission import AdmissionController, AdmissionRejected, Priority
+from archive import ConversationArchive, MemoryArchiveBackend, MongoArchiveBackend, decode_cursor, encode_cursor, utc_timestamp
+from image_jobs import ImageJobStore, MemoryImageJobBackend, MongoImageJobBackend
+from image_store import (
+    ImageStore,
+    MemoryImageBackend,
+    MongoImageBackend,
+    RenderedImage,
+    available_formats,
+    bind_request as bind_image_request,
+    current_request as current_image_request,
+    parse_variants,
+)
+from image_jobs import RENDERING
+from identity import UserTokens
+from image_tiers import ImageTier, load_tier_policy
+from intent import Intent, MarkerStripper, classify as classify_intent, first_image_prompt, parse_response, strip_markers
+import log_pipeline
+import metrics
+import server_timing
+import tracing
+from lifecycle import InFlightMiddleware, InFlightTracker, drain_on_signal
+from profiler import SamplingProfiler
+from llm_router import load_llm_router
+from memory import ConversationMemory, HashingEmbedder, Recollection
+from realtime import GOING_AWAY, Session
+from rate_limit import RateLimitExceeded, RateLimitRule, TokenBucketLimiter, create_bucket_storage, estimate_cost
+from serialization import FastJSONResponse, dumps_json, respond
+from suggest import SuggestIndex
+from trending import GENDERS, MemoryUsageBackend, MongoUsageBackend, TrendingRanker
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_resilience
+from idempotency import (
+    IDEMPOTENCY_HEADER,
+    REPLAYED_HEADER,
+    MAX_KEY_LENGTH,
+    IdempotencyConflict,
+    IdempotencyInProgress,
+    IdempotencyStore,
+    MemoryIdempotencyBackend,
+    MongoIdempotencyBackend,
+    request_fingerprint,
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Set FAL API key
-os.environ["FAL_KEY"] = os.getenv("FAL_KEY")
+# Upstream deadlines, retries and circuit breakers
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0")) or None  # e.g. 0.95 to enable hedging
+IMAGE_SUBMIT_TIMEOUT_SECONDS = float(os.getenv("IMAGE_SUBMIT_TIMEOUT_SECONDS", "15"))
+IMAGE_RESULT_TIMEOUT_SECONDS = float(os.getenv("IMAGE_RESULT_TIMEOUT_SECONDS", "120"))
+IMAGE_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT_SECONDS", "30"))
+REPLY_IMAGES_MAX = int(os.getenv("REPLY_IMAGES_MAX", "4"))  # [IMAGE: ...] markers beyond this are dropped
+REPLY_IMAGE_CONCURRENCY = int(os.getenv("REPLY_IMAGE_CONCURRENCY", "3"))  # renders in flight per reply
+IMAGE_JOB_WAIT_MAX_SECONDS = float(os.getenv("IMAGE_JOB_WAIT_MAX_SECONDS", "30"))
+IMAGE_BATCH_MAX_RENDERS = int(os.getenv("IMAGE_BATCH_MAX_RENDERS", "8"))
+IMAGE_BATCH_CONCURRENCY = int(os.getenv("IMAGE_BATCH_CONCURRENCY", "4"))  # per batch, inside the global image budget
+
+# WebSocket transport (/api/ws): per-connection flow control
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))  # concurrent requests per connection
+WS_MAX_PUSHES = int(os.getenv("WS_MAX_PUSHES", "16"))  # pending image-ready watches and proactive subscriptions
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "64"))  # frames buffered for a slow reader
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))  # then the reader is disconnected
+WS_MAX_MESSAGE_KB = int(os.getenv("WS_MAX_MESSAGE_KB", "1024"))
+WS_TOKEN_FLUSH_MS = float(os.getenv("WS_TOKEN_FLUSH_MS", "25"))  # token deltas arriving closer together share a frame
+WS_PROACTIVE_CHECK_SECONDS = float(os.getenv("WS_PROACTIVE_CHECK_SECONDS", "60"))
+
+# Server-side conversation archive: hot recent messages, zstd/zlib buckets for the rest
+ARCHIVE_MAX_APPEND = int(os.getenv("ARCHIVE_MAX_APPEND", "500"))  # messages per append request
+# Signs the user tokens archives belong to. entrypoint.sh generates one shared by the workers when
+# unset; set it to keep tokens valid across restarts
+user_tokens = UserTokens((os.getenv("USER_TOKEN_SECRET") or secrets.token_hex(32)).encode("utf-8"))
+
+# Long-term memory: long histories are cut to the recent messages plus the most relevant older ones
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "true").lower() == "true"
+MEMORY_RECENT_MESSAGES = int(os.getenv("MEMORY_RECENT_MESSAGES", "12"))  # sent verbatim
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))  # older messages recalled into the system prompt
+
+# Render quality per endpoint/personality, and progressive preview-then-HD mode (see image_tiers)
+image_tiers = load_tier_policy()
+
+# Vector indexes over conversation histories, per process (see memory)
+conversation_memory = ConversationMemory(
+    HashingEmbedder(int(os.getenv("MEMORY_DIMENSIONS", "256"))),
+    max_bytes=int(os.getenv("MEMORY_MAX_MB", "64")) * 1024 * 1024,
+    snippet_chars=int(os.getenv("MEMORY_SNIPPET_CHARS", "300")),
+    min_score=float(os.getenv("MEMORY_MIN_SCORE", "0.1"))
+) if MEMORY_ENABLED else None
+
+# Prefix index behind /api/personalities/suggest, per process and resynced with the trending refresh (see suggest)
+SUGGEST_MAX_QUERY_CHARS = 64
+personality_suggestions = SuggestIndex(
+    max_results=int(os.getenv("SUGGEST_MAX_RESULTS", "10")),
+    cache_seconds=float(os.getenv("SUGGEST_CACHE_SECONDS", "5"))
+)
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Catalog ranking: decayed usage recomputed in the background, served from precomputed lists (see trending)
+TRENDING_REFRESH_SECONDS = float(os.getenv("TRENDING_REFRESH_SECONDS", "60"))
 
-# SambaNova client setup
-samba_client = OpenAI(
-    base_url=os.getenv("SAMBA_BASE_URL"),
-    api_key=os.getenv("SAMBA_API_KEY")
+fal_breaker = CircuitBreaker(
+    "fal",
+    failure_threshold=int(os.getenv("IMAGE_BREAKER_THRESHOLD", "5")),
+    recovery_timeout=float(os.getenv("IMAGE_BREAKER_COOLDOWN_SECONDS", "60"))
 )
+llm_retry = RetryPolicy(attempts=int(os.getenv("LLM_RETRY_ATTEMPTS", "3")))
+image_retry = RetryPolicy(attempts=int(os.getenv("IMAGE_RETRY_ATTEMPTS", "2")), base_delay=0.5)
+
+# Rate limiting setup: cost-weighted token buckets shared across workers
+# Limits are in cost units; a default chat turn (1000 max_tokens, short history) costs 1
+RATE_LIMITS = {
+    "chat": os.getenv("RATE_LIMIT_CHAT", "20/minute"),
+    "opening_message": os.getenv("RATE_LIMIT_OPENING", "10/minute"),
+    "proactive_message": os.getenv("RATE_LIMIT_PROACTIVE", "30/minute"),
+    "generate_image": os.getenv("RATE_LIMIT_IMAGE", "10/minute"),
+    # Per IP: each verified user raises its address's other limits, so minting them is limited too
+    "create_user": os.getenv("RATE_LIMIT_CREATE_USER", "5/minute"),
+}
+IMAGE_COST = float(os.getenv("RATE_LIMIT_IMAGE_COST", "2"))
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "true").lower() == "true"
+# Forwarding headers are only believed from these peers (nginx, in the same container); workers
+# listen on every interface, so anyone else could pick their own IP bucket
+RATE_LIMIT_TRUSTED_PROXIES = frozenset(
+    address.strip() for address in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if address.strip()
+)
+
+# Worker processes behind nginx (set by entrypoint.sh). Stores default to mongo when there are
+# several, since a per-process store would give each worker its own jobs, images and history
+BACKEND_WORKERS = int(os.getenv("BACKEND_WORKERS", "1"))
+STORE_BACKEND_DEFAULT = "mongo" if BACKEND_WORKERS > 1 else "memory"
+
+# Seconds to wait for in-flight requests and streams on shutdown
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "25"))
+# Seconds between SIGTERM (when /api/ready turns 503) and uvicorn no longer accepting connections
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "2"))
+
+# Shared resources. Created per worker process in lifespan() so that no client,
+# connection pool or event-loop-bound object is created before uvicorn forks.
+client: Optional[AsyncIOMotorClient] = None
+db = None
+llm_router = None  # LLM endpoint pool (LLM_ENDPOINTS, defaults to the single SambaNova endpoint)
+fal = None  # fal_client.AsyncClient, imported on first use (see get_fal)
+http_client: Optional[httpx.AsyncClient] = None  # pooled client for CDN downloads
+idempotency_store: Optional[IdempotencyStore] = None
+image_jobs: Optional[ImageJobStore] = None  # progressive renders awaiting their HD image
+image_store: Optional[ImageStore] = None  # rendered originals and their WebP/AVIF size variants
+conversation_archive: Optional[ConversationArchive] = None
+suggest_load: Optional[asyncio.Task] = None  # the one-off load of personality_suggestions
+trending_ranker: Optional[TrendingRanker] = None  # usage buckets and the current catalog ranking
+rate_limiter: Optional[TokenBucketLimiter] = None
+llm_admission: Optional[AdmissionController] = None
+image_admission: Optional[AdmissionController] = None
+in_flight = InFlightTracker()
+ws_sessions: Set[Session] = set()  # open /api/ws connections, told to go away on shutdown
+
+# Startup warm-up: pre-open pools and prime caches before /api/ready reports ready
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "5"))
+READY_PING_TIMEOUT_SECONDS = float(os.getenv("READY_PING_TIMEOUT_SECONDS", "1"))
+startup_complete = False
+warm_state: Dict[str, bool] = {}  # what the warm-up phase managed to prime
+upstream_reachability: Dict[str, bool] = {}
+
+def get_fal():
+    """fal.ai client, keyed explicitly; the import is deferred to the first image request"""
+    global fal
+    if fal is None:
+        import fal_client
+        fal = fal_client.AsyncClient(key=os.getenv("FAL_KEY"))
+    return fal
+
+async def warm_up():
+    """Pay Mongo, DNS/TLS and import costs up front instead of on the first user request"""
+    global startup_complete
+    
+    async def step(name: str, coro):
+        try:
+            await asyncio.wait_for(coro, timeout=WARMUP_TIMEOUT_SECONDS)
+            warm_state[name] = True
+        except Exception as e:
+            warm_state[name] = False
+            logging.warning("Warm-up step %s failed: %s", name, e)
+    
+    async def warm_llm():
+        upstream_reachability.update(await llm_router.warm(WARMUP_TIMEOUT_SECONDS))
+    
+    async def warm_fal():
+        await asyncio.to_thread(get_fal)
+    
+    try:
+        await asyncio.gather(
+            step("mongo", db.command("ping")),
+            step("llm_pool", warm_llm()),
+            step("fal_client", warm_fal()),
+            step("suggest_index", ensure_personality_suggestions()),
+        )
+    finally:
+        startup_complete = True
+
+async def load_personality_suggestions():
+    """Index the names and tags of every public personality for /api/personalities/suggest"""
+    projection = {"_id": 0, "id": 1, "name": 1, "emoji": 1, "gender": 1, "tags": 1, "usage_count": 1}
+    with mongo_op("find"):
+        personalities = await db.public_personalities.find({"is_public": True}, projection).to_list(length=None)
+    personality_suggestions.load(personalities)
+    logging.info("Suggest index loaded with %d public personalities", len(personality_suggestions))
+
+async def ensure_personality_suggestions():
+    """Load the suggest index once; concurrent callers share the load, and a failed one is retried"""
+    global suggest_load
+    if suggest_load is None or (suggest_load.done() and not personality_suggestions.loaded):
+        suggest_load = asyncio.create_task(load_personality_suggestions())
+    # Shielded, so a warm-up step that times out leaves the load running for the first request
+    await asyncio.shield(suggest_load)
+
+def create_admission_controllers(llm_concurrency: int):
+    """Admission control: bounded concurrency per upstream, served by priority class"""
+    llm = AdmissionController(
+        "llm",
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", str(llm_concurrency))),
+        max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+        queue_timeouts={
+            Priority.INTERACTIVE: float(os.getenv("LLM_QUEUE_TIMEOUT_INTERACTIVE", "10")),
+            Priority.OPENING: float(os.getenv("LLM_QUEUE_TIMEOUT_OPENING", "8")),
+            Priority.PROACTIVE: float(os.getenv("LLM_QUEUE_TIMEOUT_PROACTIVE", "2")),
+            Priority.IMAGE: float(os.getenv("LLM_QUEUE_TIMEOUT_IMAGE", "5")),
+        }
+    )
+    image = AdmissionController(
+        "fal",
+        max_concurrency=int(os.getenv("IMAGE_MAX_CONCURRENCY", "4")),
+        max_queue=int(os.getenv("IMAGE_MAX_QUEUE", "32")),
+        queue_timeouts={
+            Priority.INTERACTIVE: float(os.getenv("IMAGE_QUEUE_TIMEOUT_INTERACTIVE", "15")),
+            Priority.OPENING: float(os.getenv("IMAGE_QUEUE_TIMEOUT_OPENING", "10")),
+            Priority.PROACTIVE: float(os.getenv("IMAGE_QUEUE_TIMEOUT_PROACTIVE", "5")),
+            Priority.IMAGE: float(os.getenv("IMAGE_QUEUE_TIMEOUT_IMAGE", "20")),
+        }
+    )
+    return llm, image
+
+def store_backend(variable: str) -> str:
+    """The backend a store is configured with; refuses per-process stores when several workers share traffic"""
+    backend = os.getenv(variable, STORE_BACKEND_DEFAULT)
+    if backend == "memory" and BACKEND_WORKERS > 1:
+        raise RuntimeError(f"{variable}=memory cannot be shared by {BACKEND_WORKERS} workers; use mongo or WEB_CONCURRENCY=1")
+    return backend
+
+def create_image_job_store(database) -> ImageJobStore:
+    """Job store for progressive renders (memory, or mongo when polls can reach another worker)"""
+    if store_backend("IMAGE_JOB_BACKEND") == "mongo":
+        backend = MongoImageJobBackend(database.image_jobs)
+    else:
+        backend = MemoryImageJobBackend(int(os.getenv("IMAGE_JOB_MAX_ENTRIES", "256")))
+    return ImageJobStore(backend, ttl_seconds=int(os.getenv("IMAGE_JOB_TTL_SECONDS", "900")))
+
+def create_image_store(database) -> ImageStore:
+    """Image originals plus on-demand size/format variants (memory, or mongo so any worker can serve them)"""
+    if store_backend("IMAGE_STORE_BACKEND") == "mongo":
+        backend = MongoImageBackend(database.images)
+    else:
+        backend = MemoryImageBackend(int(os.getenv("IMAGE_STORE_MAX_MB", "256")) * 1024 * 1024)
+    return ImageStore(
+        backend,
+        # Pillow releases the GIL while encoding, so a couple of threads keep transcodes off the loop
+        ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_TRANSCODE_WORKERS", "2")), thread_name_prefix="transcode"),
+        variants=parse_variants(os.getenv("IMAGE_VARIANTS", "thumb:256,chat:768,full:0")),
+        formats=available_formats(os.getenv("IMAGE_FORMATS", "avif,webp,jpeg").split(",")),
+        default_format=os.getenv("IMAGE_DEFAULT_FORMAT", "webp"),
+        ttl_seconds=int(os.getenv("IMAGE_STORE_TTL_SECONDS", str(7 * 24 * 60 * 60))),
+        cache_max_bytes=int(os.getenv("IMAGE_VARIANT_CACHE_MB", "128")) * 1024 * 1024
+    )
+
+def create_conversation_archive(database) -> ConversationArchive:
+    """Conversation archive (memory, or mongo so every worker and device sees the same history)"""
+    if store_backend("ARCHIVE_BACKEND") == "mongo":
+        backend = MongoArchiveBackend(database.conversations, database.conversation_buckets)
+    else:
+        backend = MemoryArchiveBackend()
+    return ConversationArchive(
+        backend,
+        hot_messages=int(os.getenv("ARCHIVE_HOT_MESSAGES", "50")),
+        bucket_messages=int(os.getenv("ARCHIVE_BUCKET_MESSAGES", "100")),
+        level=int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "9")),
+        sync_overlap_seconds=float(os.getenv("ARCHIVE_SYNC_OVERLAP_SECONDS", "60"))
+    )
+
+def create_trending_ranker(database) -> TrendingRanker:
+    """Trending ranker (memory, or mongo so every worker's uses count toward one ranking)"""
+    if store_backend("TRENDING_BACKEND") == "mongo":
+        backend = MongoUsageBackend(database.personality_usage)
+    else:
+        backend = MemoryUsageBackend()
+    return TrendingRanker(
+        backend,
+        half_life=float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24")) * 3600,
+        window=float(os.getenv("TRENDING_WINDOW_DAYS", "7")) * 24 * 3600,
+        bucket_seconds=int(os.getenv("TRENDING_BUCKET_MINUTES", "60")) * 60,
+        popular_tags=int(os.getenv("TRENDING_POPULAR_TAGS", "20"))
+    )
+
+async def refresh_trending_forever():
+    """Recompute the catalog ranking now and then every TRENDING_REFRESH_SECONDS.
+
+    The same read resyncs the suggest index, which otherwise only sees this worker's creates and deletes.
+    """
+    projection = {"_id": 0, "id": 1, "name": 1, "emoji": 1, "gender": 1, "tags": 1, "usage_count": 1}
+    while True:
+        try:
+            # Until the first load has run, the suggest index is ensure_personality_suggestions' to fill
+            resync = personality_suggestions.loaded
+            if resync:
+                personality_suggestions.begin_snapshot()
+            with mongo_op("find"):
+                personalities = await db.public_personalities.find({"is_public": True}, projection).to_list(length=None)
+            if resync:
+                # Comparing a large catalog takes milliseconds: diff a copy off the loop, apply on it
+                changes = await asyncio.to_thread(SuggestIndex.diff, personalities, personality_suggestions.cards())
+                personality_suggestions.apply(changes)
+            await trending_ranker.refresh(personalities)
+        except Exception as e:
+            logging.warning("Trending refresh failed, serving the previous ranking: %s", e)
+        await asyncio.sleep(TRENDING_REFRESH_SECONDS)
+
+def create_idempotency_store(database) -> IdempotencyStore:
+    """Idempotency store for retried POSTs (memory or mongo)"""
+    if store_backend("IDEMPOTENCY_BACKEND") == "mongo":
+        backend = MongoIdempotencyBackend(database.idempotency_keys)
+    else:
+        backend = MemoryIdempotencyBackend()
+    return IdempotencyStore(
+        backend,
+        ttl_seconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared clients inside the worker process, drain and close them on shutdown"""
+    global client, db, llm_router, http_client, idempotency_store, image_jobs, image_store, conversation_archive, trending_ranker, rate_limiter, llm_admission, image_admission, startup_complete
+    
+    # MongoDB connection
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    
+    llm_router = load_llm_router(LLM_TIMEOUT_SECONDS, llm_retry, LLM_HEDGE_PERCENTILE)
+    http_client = httpx.AsyncClient(
+        timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+    idempotency_store = create_idempotency_store(db)
+    image_jobs = create_image_job_store(db)
+    image_store = create_image_store(db)
+    conversation_archive = create_conversation_archive(db)
+    trending_ranker = create_trending_ranker(db)
+    rate_limiter = TokenBucketLimiter(
+        create_bucket_storage(os.getenv("RATE_LIMIT_STORAGE", "shared"), db),
+        {scope: RateLimitRule(spec) for scope, spec in RATE_LIMITS.items()},
+        ip_multiplier=float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "5"))
+    )
+    llm_admission, image_admission = create_admission_controllers(llm_router.total_concurrency)
+    
+    for store in (idempotency_store.backend, image_jobs.backend, image_store.backend, conversation_archive.backend, trending_ranker.backend, rate_limiter.storage):
+        if hasattr(store, "ensure_indexes"):
+            await store.ensure_indexes()
+    
+    # Serve /api/health straight away; /api/ready turns 200 once warm-up has finished
+    warm_task = asyncio.create_task(warm_up()) if WARMUP_ON_STARTUP else None
+    if warm_task is None:
+        startup_complete = True
+    trending_task = asyncio.create_task(refresh_trending_forever())
+    drain_on_signal(in_flight, close_websockets, DRAIN_GRACE_SECONDS)
+    
+    yield
+    
+    if warm_task is not None and not warm_task.done():
+        warm_task.cancel()
+    if suggest_load is not None and not suggest_load.done():
+        suggest_load.cancel()
+    trending_task.cancel()
+    leftover = await in_flight.drain(DRAIN_TIMEOUT_SECONDS)
+    if leftover:
+        logging.warning("Shutting down with %d requests still in flight", leftover)
+    await image_jobs.close()
+    try:
+        await trending_ranker.flush()
+    except Exception as e:
+        logging.warning("Could not save the last personality uses: %s", e)
+    image_store.executor.shutdown(wait=False, cancel_futures=True)
+    await http_client.aclose()
+    await llm_router.close()
+    client.close()
 
 # Create the main app
-app = FastAPI(title="Private AI Chatbot API")
+app = FastAPI(title="Private AI Chatbot API", lifespan=lifespan)
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+# orjson for everything; handlers with large payloads return respond(...) to also skip FastAPI's encoder
+api_router = APIRouter(prefix="/api", default_response_class=FastJSONResponse)
+
+# Track in-flight requests and streams for graceful drain
+app.add_middleware(InFlightMiddleware, tracker=in_flight)
 
-# Rate limiting setup
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Server-Timing header on every /api response
+app.add_middleware(server_timing.ServerTimingMiddleware, path_prefix="/api")
+
+# Root trace span and X-Request-ID per /api request (export via TRACING_EXPORTER)
+app.add_middleware(tracing.TracingMiddleware, path_prefix="/api")
+
+# On-demand profiling (disabled unless ADMIN_TOKEN is set)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+active_profiler: Optional[SamplingProfiler] = None
 
 # CORS setup
 app.add_middleware(
@@ -67,6 +454,8 @@ class ChatRequest(BaseModel):
     is_first_message: bool = False  # Flag to indicate if this is the first message in conversation
     max_tokens: int = 1000
     temperature: float = 0.7
+    progressive_images: Optional[bool] = None  # Preview first, HD via /api/images/jobs; defaults to IMAGE_PROGRESSIVE
+    conversation_id: Optional[str] = None  # Turns on memory recall for long histories; without it the whole history is sent
 
 class PublicPersonality(BaseModel):
     id: str
@@ -83,16 +472,48 @@ class PublicPersonality(BaseModel):
     created_at: str
     usage_count: int = 0
 
+class ChatImage(BaseModel):
+    prompt: str
+    image: Optional[bytes] = None  # The original, or the size variant named by X-Image-Variant (base64 in JSON, raw in msgpack); None when this render failed
+    mime_type: Optional[str] = None  # Format of `image`; negotiated from Accept when a variant was requested
+    image_id: Optional[str] = None
+    variants: Dict[str, str] = {}  # Size variant name -> URL, format negotiated per fetch
+    quality: Optional[str] = None  # Tier the image was rendered at
+    job_id: Optional[str] = None  # Progressive mode: poll /api/images/jobs/{job_id} for the HD render
+
 class ChatResponse(BaseModel):
     response: str
     personality_used: str
     timestamp: str
-    image: Optional[str] = None  # Base64 encoded image
+    image: Optional[bytes] = None  # Image bytes (base64 in JSON, raw in msgpack)
     image_prompt: Optional[str] = None  # Prompt used for image generation
+    images: List[ChatImage] = []  # Every image in the reply, in order; image/image_prompt mirror the first rendered one
 
 class ImageGenerationRequest(BaseModel):
     prompt: str
     style: str = "realistic"  # realistic, anime, cartoon, artistic
+    quality: Optional[str] = None  # preview, standard, hd or a configured tier; defaults per endpoint
+    progressive: bool = False  # Return a fast preview now and a job_id to poll for the full render
+
+class ImageBatchItem(BaseModel):
+    prompt: str
+    style: str = "realistic"
+    count: int = Field(1, ge=1)  # Independent renders of this prompt/style
+
+class ImageBatchRequest(BaseModel):
+    items: List[ImageBatchItem] = []  # Explicit prompt/style pairs...
+    prompts: List[str] = []  # ...and/or every prompt in every style
+    styles: List[str] = []  # Defaults to realistic when prompts are given without styles
+    count: int = Field(1, ge=1)  # Renders per prompt/style pair from prompts x styles
+    quality: Optional[str] = None
+
+class ArchivedMessage(BaseModel):
+    role: str
+    content: str
+    timestamp: Optional[str] = None  # When the client sent or received it
+
+class ArchiveAppendRequest(BaseModel):
+    messages: List[ArchivedMessage] = Field(..., min_length=1)
 
 class ProactiveMessageRequest(BaseModel):
     personality: str
@@ -100,6 +521,10 @@ class ProactiveMessageRequest(BaseModel):
     custom_personalities: List[Dict] = []
     conversation_history: List[Dict] = []
     time_since_last_message: int = 0  # minutes since last user message
+    conversation_id: Optional[str] = None
+
+class ProactiveSubscription(ProactiveMessageRequest):
+    last_message_time: Optional[str] = None  # ISO time of the last message; chat turns on the connection update it
 
 # Personality system prompts
 PERSONALITY_PROMPTS = {
@@ -137,58 +562,11 @@ If you'd like to see what I look like, I can show you my professional appearance
 # Image generation utility functions
 def detect_image_request(text: str) -> Optional[str]:
     """Detect if user is requesting an image and extract the prompt"""
-    image_keywords = [
-        "create", "generate", "make", "draw", "show", "picture", "image", 
-        "photo", "illustration", "art", "sketch", "paint", "design"
-    ]
-    
-    request_patterns = [
-        r"(create|generate|make|draw|show|paint).*?(picture|image|photo|illustration|art|sketch|drawing)",
-        r"(picture|image|photo|illustration|art|sketch|drawing).*?(of|showing|with)",
-        r"can you (create|generate|make|draw|show|paint)",
-        r"i want.*?(picture|image|photo|illustration|art)"
-    ]
-    
-    text_lower = text.lower()
-    
-    # First check if it's a self-image request
-    if detect_self_image_request(text):
-        return text
-    
-    # Check for explicit image request patterns
-    for pattern in request_patterns:
-        if re.search(pattern, text_lower):
-            return text
-    
-    # Check if multiple image keywords are present
-    keyword_count = sum(1 for keyword in image_keywords if keyword in text_lower)
-    if keyword_count >= 2:
-        return text
-        
-    return None
+    return text if classify_intent(text) is not Intent.NONE else None
 
 def detect_self_image_request(text: str) -> bool:
     """Detect if user is asking the chatbot to show themselves"""
-    self_image_patterns = [
-        r"show me (what you look like|how you look|yourself)",
-        r"take a (selfie|picture of yourself|photo of yourself)",
-        r"what do you look like",
-        r"can i see you",
-        r"show yourself",
-        r"picture of you",
-        r"image of you",
-        r"how do you appear",
-        r"your appearance",
-        r"describe yourself visually"
-    ]
-    
-    text_lower = text.lower()
-    
-    for pattern in self_image_patterns:
-        if re.search(pattern, text_lower):
-            return True
-            
-    return False
+    return classify_intent(text) is Intent.SELF
 
 def build_system_prompt_with_scenario(base_prompt: str, custom_personalities: list, personality_id: str, is_first_message: bool = False) -> str:
     """Build system prompt incorporating scenario context for custom personalities"""
@@ -275,14 +653,24 @@ def generate_self_image_prompt(personality_id: str, custom_personalities: list,
     
     return self_prompts.get(personality_id, self_prompts["neutral"])
 
-def generate_proactive_message_prompt(personality_id: str, conversation_history: list, time_since_last: int, custom_personalities: list) -> str:
+def generate_proactive_message_prompt(
+    personality_id: str,
+    conversation_history: list,
+    time_since_last: int,
+    custom_personalities: list,
+    memories: Optional[List[Recollection]] = None
+) -> str:
     """Generate a prompt for the chatbot to send a proactive message"""
     
-    # Get recent conversation context
+    # Get recent conversation context, after anything recalled from earlier on
     recent_messages = conversation_history[-3:] if conversation_history else []
     context = ""
+    if memories:
+        context = "Earlier in the conversation:\n" + "\n".join(
+            f"{memory.role}: {memory.text}" for memory in memories
+        ) + "\n\n"
     if recent_messages:
-        context = "Recent conversation:\n" + "\n".join([
+        context += "Recent conversation:\n" + "\n".join([
             f"{msg.get('role', 'user')}: {msg.get('content', '')}" 
             for msg in recent_messages
         ]) + "\n\n"
@@ -318,6 +706,9 @@ def generate_proactive_message_prompt(personality_id: str, conversation_history:
     
     return proactive_styles.get(personality_id, proactive_styles["neutral"])
 
+# Clients poll this constantly; its own logger lets LOG_SAMPLE_RATES thin it out
+proactive_logger = logging.getLogger("chat.proactive")
+
 async def should_send_proactive_message(last_message_time: str, personality_id: str) -> bool:
     """Determine if a proactive message should be sent based on timing and personality"""
     try:
@@ -350,30 +741,59 @@ async def should_send_proactive_message(last_message_time: str, personality_id:
         min_interval = proactive_intervals.get(personality_id, 30)
         should_send = minutes_passed >= min_interval
         
-        logging.info(f"Proactive check for {personality_id}: {minutes_passed:.1f} minutes passed, need {min_interval}, should_send: {should_send}")
+        proactive_logger.info(
+            "Proactive check for %s: %.1f minutes passed, need %d, should_send: %s",
+            personality_id, minutes_passed, min_interval, should_send
+        )
         return should_send
         
     except Exception as e:
-        logging.error(f"Error checking proactive message timing: {e}")
+        logging.error("Error checking proactive message timing: %s", e)
         return False
 
+memory_scope: ContextVar[str] = ContextVar("memory_scope", default="anonymous")
+
+def bind_memory_scope(connection: HTTPConnection):
+    """Key this request's conversation memory by its user token, or by client address without one"""
+    user_id = request_user(connection)
+    memory_scope.set(f"user:{user_id}" if user_id else f"ip:{client_ip(connection)}")
+
+async def recall_memories(conversation_id: Optional[str], history: list, query: str, skip_recent: int) -> List[Recollection]:
+    """Older messages relevant to query from the conversation's memory (none for short histories or without a conversation_id)"""
+    if conversation_memory is None or not conversation_id or len(history) <= skip_recent or not query:
+        return []
+    # ChatMessage models from /chat, plain dicts from /proactive_message
+    pairs = [
+        (m.role, m.content) if isinstance(m, ChatMessage) else (str(m.get("role", "user")), str(m.get("content", "")))
+        for m in history
+    ]
+    key = (memory_scope.get(), conversation_id)
+    with metrics.stage("memory_recall"):
+        # Usually one new message to embed, but a conversation new to this worker is embedded whole
+        return await asyncio.to_thread(conversation_memory.recall, key, pairs, query, MEMORY_TOP_K, skip_recent)
+
+def remembered_context(memories: List[Recollection]) -> str:
+    """System prompt addendum with the recalled messages, oldest first"""
+    if not memories:
+        return ""
+    lines = "\n".join(f"- {'They' if memory.role == 'user' else 'You'} said: {memory.text}" for memory in memories)
+    return f"\n\nThings you remember from earlier in this conversation:\n{lines}"
+
 def extract_image_from_response(text: str) -> Optional[str]:
     """Extract image generation prompt from AI response"""
-    # Look for [IMAGE: description] pattern
-    image_pattern = r'\[IMAGE:\s*([^\]]+)\]'
-    match = re.search(image_pattern, text, re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    return None
+    return first_image_prompt(text)
 
 def clean_response_text(text: str) -> str:
     """Remove image generation markers from response text"""
-    # Remove [IMAGE: ...] patterns
-    cleaned = re.sub(r'\[IMAGE:\s*[^\]]+\]', '', text, flags=re.IGNORECASE)
-    return cleaned.strip()
+    return strip_markers(text)
 
-async def generate_image_with_fal(prompt: str, style: str = "realistic") -> Optional[str]:
-    """Generate image using fal.ai and return base64 encoded result"""
+async def generate_image_with_fal(
+    prompt: str,
+    style: str = "realistic",
+    priority: Priority = Priority.IMAGE,
+    tier: Optional[ImageTier] = None
+) -> Optional[RenderedImage]:
+    """Generate image using fal.ai, store it and return what to send inline"""
     try:
         # Style-specific prompt modifications
         style_prompts = {
@@ -384,44 +804,303 @@ async def generate_image_with_fal(prompt: str, style: str = "realistic") -> Opti
         }
         
         enhanced_prompt = style_prompts.get(style, f"{prompt}, high quality")
+        tier = tier or image_tiers.tier_for("generate_image")
         
         # Generate image using fal.ai
-        handler = await fal_client.submit_async(
-            "fal-ai/flux/dev",
-            arguments={
-                "prompt": enhanced_prompt,
-                "image_size": "square_hd",
-                "num_inference_steps": 28,
-                "guidance_scale": 3.5
-            }
-        )
-        
-        result = await handler.get()
+        async with image_admission.slot(priority):
+            result = await call_with_resilience(
+                lambda: run_fal_job(enhanced_prompt, tier),
+                breaker=fal_breaker,
+                timeout=IMAGE_SUBMIT_TIMEOUT_SECONDS + IMAGE_RESULT_TIMEOUT_SECONDS,
+                retry=image_retry
+            )
         
         if result and "images" in result and len(result["images"]) > 0:
             image_url = result["images"][0]["url"]
             
-            # Download the image and convert to base64
-            import httpx
-            async with httpx.AsyncClient() as client:
-                response = await client.get(image_url)
-                if response.status_code == 200:
-                    image_base64 = base64.b64encode(response.content).decode('utf-8')
-                    return image_base64
-                    
+            # Download the image, then store it (and encode the inline variant, if one was asked for)
+            with metrics.stage("image_download"):
+                content = await call_with_resilience(
+                    lambda: download_image(image_url),
+                    breaker=fal_breaker,
+                    timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS,
+                    retry=image_retry
+                )
+            if content:
+                with metrics.stage("image_transcode"):
+                    accept, inline_variant = current_image_request()
+                    rendered = await image_store.publish(content, inline_variant, image_store.negotiate(accept))
+                metrics.record_image("success")
+                return rendered
+        
+        metrics.record_image("empty")
         return None
         
+    except (AdmissionRejected, CircuitOpenError):
+        metrics.record_image("shed")
+        raise
+    except Exception as e:
+        metrics.record_image("error")
+        logging.error("Image generation error: %s", e)
+        return None
+
+async def run_fal_job(enhanced_prompt: str, tier: ImageTier) -> dict:
+    """Submit a flux job at the given tier and wait for its result, each step under its own deadline"""
+    with metrics.stage("image_submit", **{"fal.model": tier.model, "fal.tier": tier.name}):
+        handler = await asyncio.wait_for(
+            get_fal().submit(tier.model, arguments=tier.arguments(enhanced_prompt)),
+            timeout=IMAGE_SUBMIT_TIMEOUT_SECONDS
+        )
+    return await asyncio.wait_for(wait_for_fal_result(handler), timeout=IMAGE_RESULT_TIMEOUT_SECONDS)
+
+async def wait_for_fal_result(handler) -> dict:
+    """Follow the job's status events so queue time and render time are measured separately"""
+    queued_at = time.perf_counter()
+    running_at = None
+    with tracing.span("image_wait", **{"fal.request_id": getattr(handler, "request_id", "")}) as span:
+        try:
+            async for event in handler.iter_events(with_logs=False):
+                if running_at is None and type(event).__name__ in ("InProgress", "Completed"):
+                    running_at = time.perf_counter()
+                    metrics.observe_stage("image_queue", running_at - queued_at)
+                    span.add_event("render_started", queue_seconds=round(running_at - queued_at, 3))
+        except asyncio.CancelledError:
+            # Nobody will collect this image, so don't pay fal.ai to finish it
+            span.add_event("cancelled")
+            asyncio.create_task(cancel_fal_job(handler))
+            raise
+        metrics.observe_stage("image_render", time.perf_counter() - (running_at or queued_at))
+    
+    with metrics.stage("image_result"):
+        return await handler.get()
+
+async def cancel_fal_job(handler):
+    """Best-effort cancel of an abandoned fal.ai job"""
+    try:
+        await handler.cancel()
     except Exception as e:
-        logging.error(f"Image generation error: {str(e)}")
+        logging.warning("Could not cancel fal.ai job %s: %s", getattr(handler, 'request_id', ''), e)
+
+async def download_image(image_url: str) -> Optional[bytes]:
+    """Fetch rendered image bytes from the fal.ai CDN"""
+    response = await http_client.get(image_url)
+    response.raise_for_status()
+    return response.content
+
+async def create_chat_completion(messages: list, max_tokens: int, temperature: float, purpose: str = "chat"):
+    """Route a completion to the best LLM endpoint, failing over on provider errors"""
+    with metrics.stage("llm"):
+        response = await llm_router.complete(messages, max_tokens, temperature, purpose)
+    metrics.record_tokens(getattr(response, "usage", None))
+    return response
+
+async def stream_chat_completion(messages: list, max_tokens: int, temperature: float, on_token, purpose: str = "chat") -> str:
+    """Stream a completion, passing on_token the visible text as it arrives; returns the full reply text"""
+    parts = []
+    stripper = MarkerStripper()  # [IMAGE: ...] markers are held back, as the final text drops them
+    started = time.perf_counter()
+    with metrics.stage("llm"):
+        async for chunk in llm_router.stream(messages, max_tokens, temperature, purpose):
+            metrics.record_tokens(getattr(chunk, "usage", None))
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if not parts:
+                metrics.observe_time_to_first_token(time.perf_counter() - started)
+            parts.append(delta)
+            shown = stripper.feed(delta)
+            if shown:
+                await on_token(shown)
+        shown = stripper.flush()
+        if shown:
+            await on_token(shown)
+    return "".join(parts)
+
+def image_fields(rendered: Optional[RenderedImage]) -> dict:
+    """Response fields for a rendered image: the inline bytes and a URL per size variant"""
+    if rendered is None:
+        return {}
+    return {
+        "image": rendered.data,
+        "mime_type": rendered.mime_type,
+        "image_id": rendered.image_id,
+        "variants": {name: f"/api/images/{rendered.image_id}/{name}" for name in image_store.variants}
+    }
+
+async def generate_reply_image(prompt: str, style: str, priority: Priority, tier: ImageTier) -> Optional[RenderedImage]:
+    """Best-effort image for a chat reply; a shed render drops the image, not the reply"""
+    try:
+        return await generate_image_with_fal(prompt, style, priority, tier)
+    except (AdmissionRejected, CircuitOpenError) as e:
+        logging.warning("Reply image skipped: %s", e.reason)
         return None
 
+async def generate_reply_images(
+    prompts: List[str],
+    style: str,
+    priority: Priority,
+    limit: asyncio.Semaphore,
+    tier: ImageTier,
+    progressive: bool = False
+) -> List[ChatImage]:
+    """Render several reply images concurrently, at most `limit` at a time; results keep prompt order"""
+    async def render(prompt: str) -> ChatImage:
+        if not progressive:
+            async with limit:
+                rendered = await generate_reply_image(prompt, style, priority, tier)
+            return ChatImage(prompt=prompt, quality=tier.name if rendered else None, **image_fields(rendered))
+        preview, job_id = await render_progressive(prompt, style, priority, limit, tier)
+        return ChatImage(
+            prompt=prompt,
+            quality=image_tiers.preview.name if preview else None,
+            job_id=job_id,
+            **preview
+        )
+    return await asyncio.gather(*(render(prompt) for prompt in prompts))
+
+async def render_progressive(prompt: str, style: str, priority: Priority, limit: asyncio.Semaphore, tier: ImageTier):
+    """Wait only for the fast preview; the full-tier render follows it and lands in an image job.
+
+    Both renders take a slot of the reply's `limit`. The final one queues once its preview holds a
+    slot, so every preview of the reply is served before the full-tier renders.
+    """
+    async def render_final() -> Optional[RenderedImage]:
+        async with limit:
+            return await generate_reply_image(prompt, style, Priority.IMAGE, tier)
+
+    final = None
+    try:
+        async with limit:
+            final = asyncio.create_task(render_final())
+            preview = image_fields(await generate_reply_image(prompt, style, priority, image_tiers.preview))
+        job_id = await image_jobs.start(prompt, preview, image_tiers.preview.name, tier.name, lambda: final_fields(final))
+    except BaseException:
+        if final is not None:
+            final.cancel()
+        raise
+    return preview, job_id
+
+async def final_fields(final: "asyncio.Task[Optional[RenderedImage]]") -> dict:
+    return image_fields(await final)
+
+@contextmanager
+def mongo_op(operation: str):
+    """Time one Motor round trip (reported as the mongo stage, Server-Timing entry and a trace span)"""
+    with metrics.stage("mongo", **{"db.system": "mongodb", "db.operation": operation}):
+        yield
+
+def upstream_busy_error(e) -> HTTPException:
+    """Translate a shed or short-circuited request into a fast 429/503 with Retry-After"""
+    return HTTPException(
+        status_code=e.status_code,
+        detail=f"Service busy: {e.reason}",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def client_ip(request: HTTPConnection) -> str:
+    """Client address, taken from nginx's X-Real-IP when the request came through a trusted proxy"""
+    peer = request.client.host if request.client else "unknown"
+    if RATE_LIMIT_TRUST_PROXY and peer in RATE_LIMIT_TRUSTED_PROXIES:
+        # X-Real-IP is set by nginx; the last X-Forwarded-For hop is the one nginx appended
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[-1]
+        if forwarded.strip():
+            return forwarded.strip()
+    return peer
+
+async def enforce_rate_limit(request: HTTPConnection, scope: str, cost: float):
+    """Charge the request's estimated cost to its user and IP buckets"""
+    try:
+        await rate_limiter.check(
+            scope,
+            cost,
+            ip=client_ip(request),
+            user_id=request_user(request)
+        )
+    except RateLimitExceeded as e:
+        metrics.record_rate_limited(scope)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded, retry in {e.retry_after}s",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+def history_chars(messages: list) -> int:
+    """Prompt size of a history made of ChatMessage models or plain dicts"""
+    return sum(len(m.content if isinstance(m, ChatMessage) else str(m.get("content", ""))) for m in messages)
+
+def chat_cost(chat_request: ChatRequest) -> float:
+    user_message = chat_request.messages[-1].content if chat_request.messages else ""
+    return estimate_cost(
+        max_tokens=chat_request.max_tokens,
+        history_chars=history_chars(chat_request.messages) + len(chat_request.custom_prompt or ""),
+        images=1 if detect_image_request(user_message) else 0,
+        image_cost=IMAGE_COST
+    )
+
+def opening_cost(chat_request: ChatRequest) -> float:
+    return estimate_cost(max_tokens=300, history_chars=len(chat_request.custom_prompt or ""))
+
+def proactive_cost(proactive_request: ProactiveMessageRequest) -> float:
+    return estimate_cost(max_tokens=300, history_chars=history_chars(proactive_request.conversation_history[-3:]))
+
+async def run_idempotent(request: Request, response: Response, body: BaseModel, producer):
+    """Run producer once per Idempotency-Key; retries attach to or replay the first result"""
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return await producer()
+    
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters"
+        )
+    
+    try:
+        result, replayed = await idempotency_store.run(
+            f"{request.url.path}:{key}",
+            request_fingerprint(body.dict()),
+            producer
+        )
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=422,
+            detail=f"{IDEMPOTENCY_HEADER} was already used with a different request body"
+        )
+    except IdempotencyInProgress:
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this idempotency key is still in progress"
+        )
+    
+    metrics.record_cache("idempotency", replayed)
+    if replayed:
+        response.headers[REPLAYED_HEADER] = "true"
+    return result
+
 @api_router.post("/chat", response_model=ChatResponse)
-@limiter.limit("20/minute")
 async def chat_completion(
     request: Request,
+    response: Response,
     chat_request: ChatRequest
 ):
+    metrics.bind("chat", chat_request.personality)
+    bind_image_request(request.headers)
+    bind_memory_scope(request)
+    
+    async def produce():
+        # Charged inside the idempotent section so retries of a key cost nothing
+        await enforce_rate_limit(request, "chat", chat_cost(chat_request))
+        return await complete_chat_turn(chat_request)
+    
+    return respond(request, await run_idempotent(request, response, chat_request, produce), response)
+
+async def complete_chat_turn(chat_request: ChatRequest, on_token=None) -> dict:
+    """Run one chat turn (LLM reply plus optional image) and return the ChatResponse payload.
+
+    With on_token, the reply is streamed from the LLM and its text passed to on_token as it arrives.
+    """
     try:
+        prompt_started = time.perf_counter()
         # Use custom prompt if provided, otherwise use built-in personality
         if chat_request.custom_prompt:
             base_system_prompt = chat_request.custom_prompt
@@ -441,34 +1120,48 @@ async def chat_completion(
         
         # Check if user is requesting an image
         user_message = chat_request.messages[-1].content if chat_request.messages else ""
-        image_request = detect_image_request(user_message)
+        with metrics.stage("detect_image_request"):
+            user_intent = classify_intent(user_message)
+        image_request = user_message if user_intent is not Intent.NONE else None
+        
+        # Long conversations keep a constant-size prompt: the recent messages verbatim,
+        # plus the older messages most relevant to this one in the system prompt
+        history = chat_request.messages
+        if len(history) > MEMORY_RECENT_MESSAGES and conversation_memory is not None and chat_request.conversation_id:
+            system_prompt += remembered_context(await recall_memories(
+                chat_request.conversation_id,
+                history,
+                user_message,
+                MEMORY_RECENT_MESSAGES
+            ))
+            history = history[-MEMORY_RECENT_MESSAGES:]
         
         # Prepare messages for SambaNova API
         messages = [{"role": "system", "content": system_prompt}]
         messages.extend([
             {"role": msg.role, "content": msg.content} 
-            for msg in chat_request.messages
+            for msg in history
         ])
-        
-        # Call SambaNova API
-        response = samba_client.chat.completions.create(
-            model="Meta-Llama-3.1-8B-Instruct",
-            messages=messages,
-            max_tokens=chat_request.max_tokens,
-            temperature=chat_request.temperature,
-            stream=False
-        )
-        
-        response_text = response.choices[0].message.content
-        
-        # Check if AI wants to generate an image
-        image_prompt = extract_image_from_response(response_text)
-        generated_image = None
-        
-        # Generate image if requested by user or AI
-        if image_request or image_prompt:
-            prompt_to_use = None
-            if detect_self_image_request(user_message):
+        metrics.observe_stage("prompt_assembly", time.perf_counter() - prompt_started)
+        
+        # Determine style based on personality
+        style_mapping = {
+            "fantasy_rpg": "artistic",
+            "best_friend": "cartoon",
+            "lover": "artistic",
+            "therapist": "realistic",
+            "neutral": "realistic"
+        }
+        style = style_mapping.get(chat_request.personality, "realistic")
+        
+        # The user's intent already fixes the prompt for self-images and explicit requests,
+        # so the render runs alongside the LLM call and the turn takes max(LLM, image)
+        tier = image_tiers.tier_for("chat", chat_request.personality)
+        progressive = image_tiers.progressive if chat_request.progressive_images is None else chat_request.progressive_images
+        render_limit = asyncio.Semaphore(REPLY_IMAGE_CONCURRENCY)
+        image_task = None
+        if user_intent is not Intent.NONE:
+            if user_intent is Intent.SELF:
                 # Use custom personalities passed in request
                 prompt_to_use = generate_self_image_prompt(
                     chat_request.personality,
@@ -476,45 +1169,87 @@ async def chat_completion(
                     PERSONALITY_PROMPTS
                 )
             else:
-                prompt_to_use = image_prompt if image_prompt else image_request
-            
-            # Determine style based on personality
-            style_mapping = {
-                "fantasy_rpg": "artistic",
-                "best_friend": "cartoon",
-                "lover": "artistic",
-                "therapist": "realistic",
-                "neutral": "realistic"
-            }
-            style = style_mapping.get(chat_request.personality, "realistic")
-            
-            generated_image = await generate_image_with_fal(prompt_to_use, style)
+                prompt_to_use = image_request
+            image_task = asyncio.create_task(
+                generate_reply_images([prompt_to_use], style, Priority.INTERACTIVE, render_limit, tier, progressive)
+            )
         
-        # Clean the response text of image markers
-        clean_text = clean_response_text(response_text)
+        # Call SambaNova API
+        try:
+            async with llm_admission.slot(Priority.INTERACTIVE):
+                if on_token is None:
+                    response = await create_chat_completion(
+                        messages,
+                        max_tokens=chat_request.max_tokens,
+                        temperature=chat_request.temperature
+                    )
+                    response_text = response.choices[0].message.content
+                else:
+                    response_text = await stream_chat_completion(
+                        messages,
+                        max_tokens=chat_request.max_tokens,
+                        temperature=chat_request.temperature,
+                        on_token=on_token
+                    )
+        except BaseException:
+            # No reply means no image; don't leave the render holding a slot
+            if image_task:
+                image_task.cancel()
+            raise
+        
+        # Check if AI wants to generate images; markers and cleaned text come from one scan
+        parsed = parse_response(response_text)
+        marker_prompts = parsed.image_prompts
+        if len(marker_prompts) > REPLY_IMAGES_MAX:
+            logging.warning("Reply has %d image markers, rendering the first %d", len(marker_prompts), REPLY_IMAGES_MAX)
+            marker_prompts = marker_prompts[:REPLY_IMAGES_MAX]
+        
+        # The early render stands in for the first marker (the model's take on the same request):
+        # it is already paid for and under way, so rendering the model's refined prompt too would
+        # bill the same picture twice and hold the reply for a second full render. Any further
+        # markers render concurrently with it and with each other.
+        if image_task:
+            marker_prompts = marker_prompts[1:]
+        marker_images = await generate_reply_images(
+            marker_prompts, style, Priority.INTERACTIVE, render_limit, tier, progressive
+        )
+        images = (await image_task if image_task else []) + marker_images
+        first = next((image for image in images if image.image), None)
         
         return ChatResponse(
-            response=clean_text,
+            response=parsed.text,
             personality_used=chat_request.personality,
             timestamp=datetime.utcnow().isoformat(),
-            image=generated_image,
-            image_prompt=image_prompt or (image_request if generated_image else None)
-        )
+            image=first.image if first else None,
+            # The prompt that was rendered (or tried), never a marker that was skipped
+            image_prompt=first.prompt if first else (images[0].prompt if images else None),
+            images=images
+        ).dict()
         
+    except HTTPException:
+        raise
+    except (AdmissionRejected, CircuitOpenError) as e:
+        raise upstream_busy_error(e)
     except Exception as e:
-        logging.error(f"Chat completion error: {str(e)}")
+        logging.error("Chat completion error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"AI service error: {str(e)}"
         )
 
 @api_router.post("/opening_message")
-@limiter.limit("10/minute")
 async def generate_opening_message(
     request: Request,
     chat_request: ChatRequest
 ):
     """Generate an opening message for custom personalities with scenarios"""
+    metrics.bind("opening_message", chat_request.personality)
+    bind_image_request(request.headers)
+    await enforce_rate_limit(request, "opening_message", opening_cost(chat_request))
+    return respond(request, await complete_opening_message(chat_request))
+
+async def complete_opening_message(chat_request: ChatRequest) -> ChatResponse:
+    """Run the opening-message LLM call (plus its optional image) and return the response"""
     try:
         # Use custom prompt if provided, otherwise use built-in personality
         if chat_request.custom_prompt:
@@ -542,19 +1277,20 @@ async def generate_opening_message(
         messages = [{"role": "system", "content": opening_prompt}]
         
         # Call SambaNova API
-        response = samba_client.chat.completions.create(
-            model="Meta-Llama-3.1-8B-Instruct",
-            messages=messages,
-            max_tokens=300,
-            temperature=0.8,
-            stream=False
-        )
+        async with llm_admission.slot(Priority.OPENING):
+            response = await create_chat_completion(
+                messages,
+                max_tokens=300,
+                temperature=0.8,
+                purpose="opening"
+            )
         
         response_text = response.choices[0].message.content
         
         # Check if AI wants to generate an image with the opening message
-        image_prompt = extract_image_from_response(response_text)
-        generated_image = None
+        parsed = parse_response(response_text)
+        image_prompt = parsed.image_prompts[0] if parsed.image_prompts else None
+        images = []
         
         if image_prompt:
             style_mapping = {
@@ -565,33 +1301,44 @@ async def generate_opening_message(
                 "neutral": "realistic"
             }
             style = style_mapping.get(chat_request.personality, "realistic")
-            generated_image = await generate_image_with_fal(image_prompt, style)
-        
-        # Clean the response text of image markers
-        clean_text = clean_response_text(response_text)
+            tier = image_tiers.tier_for("opening_message", chat_request.personality)
+            rendered = await generate_reply_image(image_prompt, style, Priority.OPENING, tier)
+            images = [ChatImage(prompt=image_prompt, quality=tier.name if rendered else None, **image_fields(rendered))]
         
         return ChatResponse(
-            response=clean_text,
+            response=parsed.text,
             personality_used=chat_request.personality,
             timestamp=datetime.utcnow().isoformat(),
-            image=generated_image,
-            image_prompt=image_prompt
+            image=images[0].image if images else None,
+            image_prompt=image_prompt,
+            images=images
         )
         
+    except HTTPException:
+        raise
+    except (AdmissionRejected, CircuitOpenError) as e:
+        raise upstream_busy_error(e)
     except Exception as e:
-        logging.error(f"Opening message generation error: {str(e)}")
+        logging.error("Opening message generation error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Opening message error: {str(e)}"
         )
 
 @api_router.post("/proactive_message")
-@limiter.limit("30/minute")
 async def generate_proactive_message(
     request: Request,
     proactive_request: ProactiveMessageRequest
 ):
     """Generate a proactive message from the chatbot"""
+    metrics.bind("proactive_message", proactive_request.personality)
+    bind_image_request(request.headers)
+    bind_memory_scope(request)
+    await enforce_rate_limit(request, "proactive_message", proactive_cost(proactive_request))
+    return respond(request, await complete_proactive_message(proactive_request))
+
+async def complete_proactive_message(proactive_request: ProactiveMessageRequest) -> ChatResponse:
+    """Run the proactive-message LLM call (plus its optional image) and return the response"""
     try:
         # Use custom prompt if provided, otherwise use built-in personality
         if proactive_request.custom_prompt:
@@ -602,12 +1349,22 @@ async def generate_proactive_message(
                 PERSONALITY_PROMPTS["neutral"]
             )
         
+        # Recall what the last few messages bring to mind from further back
+        history = proactive_request.conversation_history
+        memories = await recall_memories(
+            proactive_request.conversation_id,
+            history,
+            " ".join(str(msg.get("content", "")) for msg in history[-3:]),
+            3
+        )
+        
         # Generate proactive message prompt
         proactive_prompt = generate_proactive_message_prompt(
             proactive_request.personality,
-            proactive_request.conversation_history,
+            history,
             proactive_request.time_since_last_message,
-            proactive_request.custom_personalities
+            proactive_request.custom_personalities,
+            memories
         )
         
         # Combine personality with proactive prompt
@@ -617,19 +1374,20 @@ async def generate_proactive_message(
         messages = [{"role": "system", "content": system_prompt}]
         
         # Call SambaNova API
-        response = samba_client.chat.completions.create(
-            model="Meta-Llama-3.1-8B-Instruct",
-            messages=messages,
-            max_tokens=300,  # Shorter for proactive messages
-            temperature=0.8,  # Slightly more creative
-            stream=False
-        )
+        async with llm_admission.slot(Priority.PROACTIVE):
+            response = await create_chat_completion(
+                messages,
+                max_tokens=300,  # Shorter for proactive messages
+                temperature=0.8,  # Slightly more creative
+                purpose="proactive"
+            )
         
         response_text = response.choices[0].message.content
         
         # Check if AI wants to generate an image with the proactive message
-        image_prompt = extract_image_from_response(response_text)
-        generated_image = None
+        parsed = parse_response(response_text)
+        image_prompt = parsed.image_prompts[0] if parsed.image_prompts else None
+        images = []
         
         if image_prompt:
             # Determine style based on personality
@@ -641,21 +1399,25 @@ async def generate_proactive_message(
                 "neutral": "realistic"
             }
             style = style_mapping.get(proactive_request.personality, "realistic")
-            generated_image = await generate_image_with_fal(image_prompt, style)
-        
-        # Clean the response text of image markers
-        clean_text = clean_response_text(response_text)
+            tier = image_tiers.tier_for("proactive_message", proactive_request.personality)
+            rendered = await generate_reply_image(image_prompt, style, Priority.PROACTIVE, tier)
+            images = [ChatImage(prompt=image_prompt, quality=tier.name if rendered else None, **image_fields(rendered))]
         
         return ChatResponse(
-            response=clean_text,
+            response=parsed.text,
             personality_used=proactive_request.personality,
             timestamp=datetime.utcnow().isoformat(),
-            image=generated_image,
-            image_prompt=image_prompt
+            image=images[0].image if images else None,
+            image_prompt=image_prompt,
+            images=images
         )
         
+    except HTTPException:
+        raise
+    except (AdmissionRejected, CircuitOpenError) as e:
+        raise upstream_busy_error(e)
     except Exception as e:
-        logging.error(f"Proactive message generation error: {str(e)}")
+        logging.error("Proactive message generation error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Proactive message error: {str(e)}"
@@ -675,31 +1437,51 @@ async def check_proactive_timing(
             "check_time": datetime.utcnow().isoformat()
         }
     except Exception as e:
-        logging.error(f"Proactive timing check error: {str(e)}")
+        logging.error("Proactive timing check error: %s", e)
         return {
             "should_send": False,
             "error": str(e)
         }
 
 @api_router.post("/generate_image")
-@limiter.limit("10/minute")
 async def generate_image(
     request: Request,
+    response: Response,
     image_request: ImageGenerationRequest
 ):
     """Generate an image directly from a prompt"""
+    metrics.bind("generate_image")
+    bind_image_request(request.headers)
+    async def produce():
+        await enforce_rate_limit(request, "generate_image", IMAGE_COST / 2)
+        return await render_requested_image(image_request)
+    
+    return respond(request, await run_idempotent(request, response, image_request, produce), response)
+
+async def render_requested_image(image_request: ImageGenerationRequest) -> dict:
+    """Render a single ImageGenerationRequest and return the response payload"""
     try:
+        try:
+            tier = image_tiers.tier_for("generate_image", requested=image_request.quality)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        if image_request.progressive:
+            return await render_requested_preview(image_request, tier)
+        
         generated_image = await generate_image_with_fal(
             image_request.prompt, 
-            image_request.style
+            image_request.style,
+            tier=tier
         )
         
         if generated_image:
             return {
                 "success": True,
-                "image": generated_image,
+                **image_fields(generated_image),
                 "prompt": image_request.prompt,
                 "style": image_request.style,
+                "quality": tier.name,
                 "timestamp": datetime.utcnow().isoformat()
             }
         else:
@@ -708,13 +1490,359 @@ async def generate_image(
                 detail="Failed to generate image"
             )
             
+    except HTTPException:
+        raise
+    except (AdmissionRejected, CircuitOpenError) as e:
+        raise upstream_busy_error(e)
     except Exception as e:
-        logging.error(f"Direct image generation error: {str(e)}")
+        logging.error("Direct image generation error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Image generation error: {str(e)}"
         )
 
+async def render_requested_preview(image_request: ImageGenerationRequest, tier: ImageTier) -> dict:
+    """Progressive mode: answer with the fast preview and a job that receives the full-tier render"""
+    final = asyncio.create_task(generate_reply_image(image_request.prompt, image_request.style, Priority.IMAGE, tier))
+    try:
+        preview = image_fields(await generate_image_with_fal(
+            image_request.prompt,
+            image_request.style,
+            tier=image_tiers.preview
+        ))
+        job_id = await image_jobs.start(
+            image_request.prompt, preview, image_tiers.preview.name, tier.name, lambda: final_fields(final)
+        )
+    except BaseException:
+        final.cancel()
+        raise
+    
+    # A failed preview still returns the job, since the full render may yet succeed
+    return {
+        "success": True,
+        "image": None,
+        **preview,
+        "prompt": image_request.prompt,
+        "style": image_request.style,
+        "quality": image_tiers.preview.name if preview else None,
+        "job_id": job_id,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@api_router.get("/images/jobs/{job_id}")
+async def get_image_job(request: Request, job_id: str, wait: float = 0):
+    """State of a progressive render; with ?wait=N, hold the request up to N seconds for the full image"""
+    metrics.bind("image_job")
+    wait = min(max(wait, 0), IMAGE_JOB_WAIT_MAX_SECONDS)
+    job = await (image_jobs.wait(job_id, wait) if wait else image_jobs.get(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Image job not found or expired")
+    return respond(request, job_fields(job))
+
+def job_fields(job: dict) -> dict:
+    """An image job as clients see it, without the backend's bookkeeping"""
+    return {key: value for key, value in job.items() if key not in ("_id", "expires_at")}
+
+@api_router.get("/images/{image_id}/{variant}")
+async def get_image_variant(request: Request, image_id: str, variant: str):
+    """One size variant of a rendered image, as AVIF/WebP/JPEG depending on what the client accepts"""
+    metrics.bind("image_variant")
+    if variant not in image_store.variants:
+        raise HTTPException(status_code=404, detail=f"Unknown variant, expected one of: {', '.join(image_store.variants)}")
+    found = await image_store.variant(image_id, variant, image_store.negotiate(request.headers.get("accept")))
+    if found is None:
+        raise HTTPException(status_code=404, detail="Image not found or expired")
+    content, mime_type = found
+    # Ids are content hashes, so a URL never changes meaning; only the format varies by Accept
+    return Response(
+        content=content,
+        media_type=mime_type,
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "Vary": "Accept"}
+    )
+
+def expand_batch(batch: ImageBatchRequest) -> List[ImageBatchItem]:
+    """One single-render item per image the batch asks for, in request order"""
+    pairs = [(item.prompt, item.style, item.count) for item in batch.items]
+    pairs += [(prompt, style, batch.count) for prompt in batch.prompts for style in (batch.styles or ["realistic"])]
+    return [ImageBatchItem(prompt=prompt, style=style) for prompt, style, count in pairs for _ in range(count)]
+
+@api_router.post("/generate_images")
+async def generate_images(request: Request, batch: ImageBatchRequest):
+    """Render several prompts/styles concurrently, streaming each result as an NDJSON line as soon as it lands"""
+    metrics.bind("generate_images")
+    bind_image_request(request.headers)
+    renders = expand_batch(batch)
+    if not renders or len(renders) > IMAGE_BATCH_MAX_RENDERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch must ask for between 1 and {IMAGE_BATCH_MAX_RENDERS} images, not {len(renders)}"
+        )
+    try:
+        tier = image_tiers.tier_for("generate_image", requested=batch.quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Charged up front at the single-image price per render, so a batch costs what its parts would
+    await enforce_rate_limit(request, "generate_image", IMAGE_COST / 2 * len(renders))
+    return StreamingResponse(stream_batch(renders, tier), media_type="application/x-ndjson")
+
+async def stream_batch(renders: List[ImageBatchItem], tier: ImageTier):
+    """Yield one line per render in completion order (each carries its request index), then a summary line"""
+    limit = asyncio.Semaphore(IMAGE_BATCH_CONCURRENCY)
+    
+    async def render(index: int, item: ImageBatchItem):
+        # Each render still queues for the global image admission slots, behind chat images
+        async with limit:
+            try:
+                rendered = await generate_image_with_fal(item.prompt, item.style, Priority.IMAGE, tier)
+            except (AdmissionRejected, CircuitOpenError) as e:
+                return index, {"success": False, "error": f"Service busy: {e.reason}"}
+        if rendered is None:
+            return index, {"success": False, "error": "Failed to generate image"}
+        return index, {"success": True, "quality": tier.name, **image_fields(rendered)}
+    
+    tasks = [asyncio.create_task(render(index, item)) for index, item in enumerate(renders)]
+    succeeded = 0
+    try:
+        for finished in asyncio.as_completed(tasks):
+            index, result = await finished
+            succeeded += result["success"]
+            line = {"index": index, "prompt": renders[index].prompt, "style": renders[index].style, **result}
+            yield dumps_json(line) + b"\n"
+        yield dumps_json({"done": True, "succeeded": succeeded, "failed": len(renders) - succeeded}) + b"\n"
+    finally:
+        # The client went away mid-stream: stop (and cancel upstream) whatever is still rendering
+        for task in tasks:
+            task.cancel()
+
+@api_router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """One connection per client for chat turns with streamed tokens, image-ready and proactive pushes (see realtime)"""
+    if in_flight.draining:
+        await websocket.close(GOING_AWAY)  # refuses the handshake; the client reconnects elsewhere
+        return
+    bind_image_request(websocket.headers)
+    bind_memory_scope(websocket)
+    session = Session(
+        websocket,
+        WS_HANDLERS,
+        max_in_flight=WS_MAX_IN_FLIGHT,
+        max_background=WS_MAX_PUSHES,
+        send_queue=WS_SEND_QUEUE,
+        send_timeout=WS_SEND_TIMEOUT_SECONDS,
+        max_message_bytes=WS_MAX_MESSAGE_KB * 1024,
+        token_interval=WS_TOKEN_FLUSH_MS / 1000
+    )
+    ws_sessions.add(session)
+    try:
+        await session.run()
+    finally:
+        ws_sessions.discard(session)
+
+def close_websockets():
+    """On shutdown: close idle connections with 1001 now, busy ones once their requests answer"""
+    for session in list(ws_sessions):
+        session.go_away()
+
+async def ws_chat(session: Session, request_id: str, body: dict) -> dict:
+    """A chat turn whose reply text streams as token frames before the result"""
+    chat_request = ChatRequest.model_validate(body)
+    metrics.bind("chat", chat_request.personality)
+    await enforce_rate_limit(session.websocket, "chat", chat_cost(chat_request))
+    tokens = session.token_stream(request_id)
+    result = await complete_chat_turn(chat_request, on_token=tokens.write)
+    await tokens.flush()
+    session.state.setdefault("last_message_time", {})[chat_request.personality] = result["timestamp"]
+    watch_image_jobs(session, request_id, result["images"])
+    return result
+
+async def ws_opening_message(session: Session, request_id: str, body: dict) -> dict:
+    chat_request = ChatRequest.model_validate(body)
+    metrics.bind("opening_message", chat_request.personality)
+    await enforce_rate_limit(session.websocket, "opening_message", opening_cost(chat_request))
+    return (await complete_opening_message(chat_request)).model_dump()
+
+async def ws_proactive_message(session: Session, request_id: str, body: dict) -> dict:
+    proactive_request = ProactiveMessageRequest.model_validate(body)
+    metrics.bind("proactive_message", proactive_request.personality)
+    await enforce_rate_limit(session.websocket, "proactive_message", proactive_cost(proactive_request))
+    return (await complete_proactive_message(proactive_request)).model_dump()
+
+async def ws_subscribe_proactive(session: Session, request_id: str, body: dict) -> dict:
+    """Push proactive messages on this connection when they are due; resubscribe with the same id to update the history"""
+    subscription = ProactiveSubscription.model_validate(body)
+    session.cancel_background(request_id)
+    if not session.background(request_id, push_proactive_messages(session, request_id, subscription)):
+        raise HTTPException(status_code=429, detail=f"At most {WS_MAX_PUSHES} pushes can be pending per connection")
+    return {"subscribed": True, "personality": subscription.personality}
+
+async def push_proactive_messages(session: Session, request_id: str, subscription: ProactiveSubscription):
+    personality = subscription.personality
+    last_message_time = session.state.setdefault("last_message_time", {})
+    last_message_time.setdefault(personality, subscription.last_message_time)
+    while True:
+        await asyncio.sleep(WS_PROACTIVE_CHECK_SECONDS)
+        if not await should_send_proactive_message(last_message_time.get(personality), personality):
+            continue
+        metrics.bind("proactive_message", personality)
+        try:
+            await enforce_rate_limit(session.websocket, "proactive_message", proactive_cost(subscription))
+            message = await complete_proactive_message(subscription)
+        except HTTPException as e:
+            logging.warning("Proactive push for %s skipped: %s", personality, e.detail)
+            continue
+        last_message_time[personality] = message.timestamp
+        await session.send({"id": request_id, "type": "proactive", "body": message.model_dump()})
+
+async def ws_generate_image(session: Session, request_id: str, body: dict) -> dict:
+    image_request = ImageGenerationRequest.model_validate(body)
+    metrics.bind("generate_image")
+    await enforce_rate_limit(session.websocket, "generate_image", IMAGE_COST / 2)
+    result = await render_requested_image(image_request)
+    watch_image_jobs(session, request_id, [result])
+    return result
+
+async def ws_image_job(session: Session, request_id: str, body: dict) -> dict:
+    """An image job's current state, plus an image_ready push when it is still rendering"""
+    metrics.bind("image_job")
+    job = await image_jobs.get(str(body.get("job_id")))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Image job not found or expired")
+    watch_image_jobs(session, request_id, [job] if job["status"] == RENDERING else [])
+    return job_fields(job)
+
+def watch_image_jobs(session: Session, request_id: str, images: List[dict]):
+    """Push image_ready for each progressive render in images once its full-tier image lands"""
+    for image in images:
+        if image.get("job_id") and not session.background(request_id, push_image_ready(session, request_id, image["job_id"])):
+            logging.warning("Too many pushes pending on one connection; image job %s must be polled", image['job_id'])
+
+async def push_image_ready(session: Session, request_id: str, job_id: str):
+    job = await image_jobs.wait(job_id, IMAGE_RESULT_TIMEOUT_SECONDS)
+    if job is not None:
+        await session.send({"id": request_id, "type": "image_ready", "body": job_fields(job)})
+
+WS_HANDLERS = {
+    "chat": ws_chat,
+    "opening_message": ws_opening_message,
+    "proactive_message": ws_proactive_message,
+    "subscribe_proactive": ws_subscribe_proactive,
+    "generate_image": ws_generate_image,
+    "image_job": ws_image_job,
+}
+
+@api_router.post("/users")
+async def create_user(request: Request):
+    """A new user id and the token that proves it; send it as "Authorization: Bearer <token>" """
+    await enforce_rate_limit(request, "create_user", 1)
+    user_id, token = user_tokens.issue()
+    return {"user_id": user_id, "token": token}
+
+def request_user(connection: HTTPConnection) -> Optional[str]:
+    """The user id whose token from POST /api/users the client sent, or None"""
+    scheme, _, token = connection.headers.get("authorization", "").partition(" ")
+    return user_tokens.verify(token.strip()) if scheme.lower() == "bearer" else None
+
+def archive_user(request: Request) -> str:
+    """Archives belong to the user whose token the request carries"""
+    user_id = request_user(request)
+    if user_id is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Conversation archives need a user token from POST /api/users",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return user_id
+
+async def archive_head(request: Request, conversation_id: str) -> dict:
+    head = await conversation_archive.head(archive_user(request), conversation_id)
+    if head is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return head
+
+@api_router.post("/conversations/{conversation_id}/messages")
+async def append_conversation_messages(request: Request, conversation_id: str, append: ArchiveAppendRequest):
+    """Archive new messages; the response carries their seqs for later delta syncs"""
+    metrics.bind("archive_append")
+    if len(append.messages) > ARCHIVE_MAX_APPEND:
+        raise HTTPException(status_code=400, detail=f"At most {ARCHIVE_MAX_APPEND} messages per request")
+    return await conversation_archive.append(
+        archive_user(request),
+        conversation_id,
+        [message.model_dump() for message in append.messages]
+    )
+
+@api_router.get("/conversations/changes")
+async def get_conversation_changes(request: Request, since: Optional[str] = None, cursor: Optional[str] = None):
+    """Messages archived in every conversation of the user's since the last sync.
+
+    Start from a time (`since`, ISO 8601), then pass back each response's `cursor`; messages
+    seen through the cursor are not sent twice.
+    """
+    metrics.bind("archive_changes")
+    seen: Dict[str, int] = {}
+    if cursor:
+        try:
+            since, seen = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif since:
+        try:
+            parsed = datetime.fromisoformat(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an ISO 8601 timestamp")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        since = utc_timestamp(parsed)
+    else:
+        raise HTTPException(status_code=400, detail="Pass since (first sync) or cursor")
+    read_at = utc_timestamp()
+    conversations = await conversation_archive.changes(archive_user(request), since, seen)
+    return respond(request, {
+        "since": since,
+        "cursor": encode_cursor(read_at, {c["conversation_id"]: c["last_seq"] for c in conversations}),
+        "conversations": conversations
+    })
+
+@api_router.get("/conversations/{conversation_id}")
+async def get_conversation_stats(request: Request, conversation_id: str):
+    """Message counts and hot/compressed storage sizes of one conversation"""
+    metrics.bind("archive_stats")
+    return conversation_archive.stats(await archive_head(request, conversation_id))
+
+@api_router.get("/conversations/{conversation_id}/messages")
+async def get_conversation_messages(request: Request, conversation_id: str, after_seq: int = -1):
+    """Delta sync for one conversation: every message with a seq above after_seq"""
+    metrics.bind("archive_messages")
+    head = await archive_head(request, conversation_id)
+    messages = [message async for message in conversation_archive.messages(head, after_seq=after_seq)]
+    return respond(request, {
+        "conversation_id": conversation_id,
+        "last_seq": head["hot_start"] + len(head["hot"]) - 1,
+        "messages": messages
+    })
+
+@api_router.get("/conversations/{conversation_id}/export")
+async def export_conversation(request: Request, conversation_id: str):
+    """The whole conversation as NDJSON: a summary line, then one line per message, oldest first"""
+    metrics.bind("archive_export")
+    head = await archive_head(request, conversation_id)
+    
+    async def lines():
+        yield dumps_json({
+            "conversation_id": conversation_id,
+            "message_count": head["hot_start"] + len(head["hot"]),
+            "exported_at": utc_timestamp()
+        }) + b"\n"
+        async for message in conversation_archive.messages(head):
+            yield dumps_json(message) + b"\n"
+    
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{conversation_id}.ndjson"'}
+    )
+
 @api_router.post("/personalities/public")
 async def create_public_personality(personality: PublicPersonality):
     """Create or update a public personality"""
@@ -728,11 +1856,13 @@ async def create_public_personality(personality: PublicPersonality):
         
         # Store in MongoDB
         collection = db.public_personalities
-        result = await collection.replace_one(
-            {"id": personality.id},
-            personality.dict(),
-            upsert=True
-        )
+        with mongo_op("replace_one"):
+            result = await collection.replace_one(
+                {"id": personality.id},
+                personality.dict(),
+                upsert=True
+            )
+        personality_suggestions.put(personality.dict())
         
         return {
             "success": True,
@@ -741,7 +1871,7 @@ async def create_public_personality(personality: PublicPersonality):
         }
         
     except Exception as e:
-        logging.error(f"Error creating public personality: {str(e)}")
+        logging.error("Error creating public personality: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to create public personality: {str(e)}"
@@ -749,11 +1879,13 @@ async def create_public_personality(personality: PublicPersonality):
 
 @api_router.get("/personalities/public")
 async def get_public_personalities(
+    request: Request,
     limit: int = 50, 
     offset: int = 0, 
     tags: str = None, 
     gender: str = None,
-    search: str = None
+    search: str = None,
+    sort: str = "trending"
 ):
     """Get list of public personalities with filtering options"""
     try:
@@ -761,14 +1893,43 @@ async def get_public_personalities(
         query = {"is_public": True}
         
         # Filter by gender if provided
-        if gender and gender in ["male", "female", "non-binary", "other"]:
+        if gender and gender in GENDERS:
             query["gender"] = gender
         
         # Filter by tags if provided
+        tag_list = []
         if tags:
             tag_list = [tag.strip() for tag in tags.split(",")]
             query["tags"] = {"$in": tag_list}
         
+        # Trending order is precomputed: slice the ranked ids and fetch just that page.
+        # Free-text search still goes to Mongo, ordered by lifetime usage.
+        ranking = trending_ranker.ranking
+        if sort == "trending" and not search and ranking is not None:
+            page_ids, total = ranking.page(query.get("gender"), tag_list, offset, limit)
+            with mongo_op("find"):
+                found = await collection.find({"id": {"$in": page_ids}, "is_public": True}).to_list(length=limit)
+            by_id = {personality["id"]: personality for personality in found}
+            personalities = []
+            for personality_id in page_ids:
+                personality = by_id.get(personality_id)
+                if personality is None:
+                    continue  # deleted or unpublished since the last refresh
+                del personality["_id"]
+                personality["trending_score"] = round(ranking.scores.get(personality_id, 0.0), 3)
+                personalities.append(personality)
+            
+            return respond(request, {
+                "personalities": personalities,
+                "total": total,
+                "filters": {
+                    "gender": gender,
+                    "tags": tags,
+                    "search": search,
+                    "sort": "trending"
+                }
+            })
+        
         # Search in name and description if provided
         if search:
             query["$or"] = [
@@ -778,36 +1939,42 @@ async def get_public_personalities(
         
         # Get personalities with pagination
         cursor = collection.find(query).sort("usage_count", -1).skip(offset).limit(limit)
-        personalities = await cursor.to_list(length=limit)
+        with mongo_op("find"):
+            personalities = await cursor.to_list(length=limit)
+        
+        with mongo_op("count_documents"):
+            total = await collection.count_documents(query)
         
         # Convert ObjectId to string for JSON serialization
         for personality in personalities:
             if "_id" in personality:
                 del personality["_id"]
         
-        return {
+        return respond(request, {
             "personalities": personalities,
-            "total": await collection.count_documents(query),
+            "total": total,
             "filters": {
                 "gender": gender,
                 "tags": tags,
-                "search": search
+                "search": search,
+                "sort": "usage"
             }
-        }
+        })
         
     except Exception as e:
-        logging.error(f"Error getting public personalities: {str(e)}")
+        logging.error("Error getting public personalities: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to get public personalities: {str(e)}"
         )
 
 @api_router.get("/personalities/public/{personality_id}")
-async def get_public_personality(personality_id: str):
+async def get_public_personality(request: Request, personality_id: str):
     """Get a specific public personality"""
     try:
         collection = db.public_personalities
-        personality = await collection.find_one({"id": personality_id, "is_public": True})
+        with mongo_op("find_one"):
+            personality = await collection.find_one({"id": personality_id, "is_public": True})
         
         if not personality:
             raise HTTPException(status_code=404, detail="Public personality not found")
@@ -817,41 +1984,45 @@ async def get_public_personality(personality_id: str):
             del personality["_id"]
         
         # Increment usage count
-        await collection.update_one(
-            {"id": personality_id},
-            {"$inc": {"usage_count": 1}}
-        )
+        with mongo_op("update_one"):
+            await collection.update_one(
+                {"id": personality_id},
+                {"$inc": {"usage_count": 1}}
+            )
+        personality_suggestions.record_use(personality_id)
+        trending_ranker.record_use(personality_id)
         
-        return personality
+        return respond(request, personality)
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error getting public personality: {str(e)}")
+        logging.error("Error getting public personality: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to get public personality: {str(e)}"
         )
 
 @api_router.get("/personalities/user/{creator_id}")
-async def get_user_personalities(creator_id: str):
+async def get_user_personalities(request: Request, creator_id: str):
     """Get all personalities created by a specific user"""
     try:
         collection = db.public_personalities
-        personalities = await collection.find({"creator_id": creator_id}).to_list(length=100)
+        with mongo_op("find"):
+            personalities = await collection.find({"creator_id": creator_id}).to_list(length=100)
         
         # Convert ObjectId to string
         for personality in personalities:
             if "_id" in personality:
                 del personality["_id"]
         
-        return {
+        return respond(request, {
             "personalities": personalities,
             "total": len(personalities)
-        }
+        })
         
     except Exception as e:
-        logging.error(f"Error getting user personalities: {str(e)}")
+        logging.error("Error getting user personalities: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to get user personalities: {str(e)}"
@@ -872,7 +2043,11 @@ async def get_available_tags():
             {"$limit": 50}
         ]
         
-        result = await collection.aggregate(pipeline).to_list(length=50)
+        with mongo_op("aggregate"):
+            result = await collection.aggregate(pipeline).to_list(length=50)
+        
+        with mongo_op("count_documents"):
+            total_personalities = await collection.count_documents({"is_public": True})
         
         tags = [{"tag": item["_id"], "count": item["count"]} for item in result]
         
@@ -891,38 +2066,57 @@ async def get_available_tags():
         return {
             "popular_tags": tags,
             "categories": predefined_categories,
-            "total_personalities": await collection.count_documents({"is_public": True})
+            "total_personalities": total_personalities
         }
         
     except Exception as e:
-        logging.error(f"Error getting tags: {str(e)}")
+        logging.error("Error getting tags: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to get tags: {str(e)}"
         )
 
+@api_router.get("/personalities/suggest")
+async def suggest_personalities(request: Request, q: str = "", limit: int = 8):
+    """Autocomplete for the catalog search box: names and tags by prefix, most used first, without Mongo"""
+    if not personality_suggestions.loaded:
+        try:
+            await ensure_personality_suggestions()
+        except Exception as e:
+            logging.error("Error loading the suggest index: %s", e)
+            raise HTTPException(status_code=503, detail="Suggestions are not available yet")
+    
+    personalities, tags = personality_suggestions.suggest(q[:SUGGEST_MAX_QUERY_CHARS], limit)
+    return respond(request, {
+        "query": q,
+        "personalities": personalities,
+        "tags": tags
+    })
+
 @api_router.delete("/personalities/public/{personality_id}")
 async def delete_public_personality(personality_id: str, creator_id: str):
     """Delete a public personality (only by creator)"""
     try:
         collection = db.public_personalities
-        result = await collection.delete_one({
-            "id": personality_id,
-            "creator_id": creator_id
-        })
+        with mongo_op("delete_one"):
+            result = await collection.delete_one({
+                "id": personality_id,
+                "creator_id": creator_id
+            })
         
         if result.deleted_count == 0:
             raise HTTPException(
                 status_code=404, 
                 detail="Personality not found or you don't have permission to delete it"
             )
+        personality_suggestions.remove(personality_id)
         
         return {"success": True, "message": "Personality deleted successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error deleting public personality: {str(e)}")
+        logging.error("Error deleting public personality: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to delete public personality: {str(e)}"
@@ -941,20 +2135,129 @@ async def get_personalities():
         ]
     }
 
+def require_admin(request: Request):
+    """Admin endpoints need the ADMIN_TOKEN in X-Admin-Token; without a token they do not exist"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if request.headers.get("x-admin-token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@api_router.post("/admin/profile")
+async def profile_event_loop(
+    request: Request,
+    seconds: float = 10,
+    requests: int = 0,
+    interval_ms: float = 5
+):
+    """Sample the event-loop thread for N seconds (or until N more requests finish) and return folded stacks"""
+    global active_profiler
+    require_admin(request)
+    if active_profiler is not None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    completed_at_start = in_flight.completed
+    
+    active_profiler = SamplingProfiler(threading.get_ident(), interval=max(interval_ms, 1) / 1000)
+    active_profiler.start()
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            # The profile request itself is still open, so it never counts towards the target
+            if requests and in_flight.completed - completed_at_start >= requests:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        profiler, active_profiler = active_profiler, None
+        profiler.stop()
+    
+    return Response(
+        content=profiler.folded(),
+        media_type="text/plain",
+        headers={
+            "X-Profile-Samples": str(profiler.sample_count),
+            "X-Profile-Seconds": f"{profiler.stopped_at - profiler.started_at:.2f}"
+        }
+    )
+
+@api_router.get("/admission")
+async def admission_stats():
+    """Queue depth, wait time and shed counts for each upstream"""
+    return {
+        "upstreams": [llm_admission.snapshot(), image_admission.snapshot()]
+    }
+
 @api_router.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "Private AI Chatbot API"}
+    llm_endpoints = llm_router.snapshot()
+    breakers = {endpoint.breaker.name: endpoint.breaker.snapshot() for endpoint in llm_router.endpoints}
+    breakers[fal_breaker.name] = fal_breaker.snapshot()
+    degraded = any(b["state"] != CircuitBreaker.CLOSED for b in breakers.values())
+    return {
+        "status": "degraded" if degraded else "healthy",
+        "service": "Private AI Chatbot API",
+        "circuit_breakers": breakers,
+        "llm_endpoints": llm_endpoints
+    }
+
+@api_router.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness probe: 200 once warm-up is done and Mongo answers, 503 while starting or draining"""
+    try:
+        started = time.perf_counter()
+        await asyncio.wait_for(db.command("ping"), timeout=READY_PING_TIMEOUT_SECONDS)
+        mongo = {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+    except Exception as e:
+        mongo = {"ok": False, "error": str(e)}
+    
+    # Upstream state is informational: an LLM outage should not take every worker out of nginx
+    upstreams = {
+        endpoint.name: {
+            "reachable_at_startup": upstream_reachability.get(endpoint.name),
+            "circuit": endpoint.breaker.state
+        }
+        for endpoint in llm_router.endpoints
+    }
+    upstreams["fal"] = {"circuit": fal_breaker.state}
+    
+    ready = startup_complete and not in_flight.draining and mongo["ok"]
+    response.status_code = 200 if ready else 503
+    return {
+        "ready": ready,
+        "startup_complete": startup_complete,
+        "draining": in_flight.draining,
+        "mongo": mongo,
+        "upstreams": upstreams,
+        "caches": warm_state,
+        "trending": trending_ranker.snapshot()
+    }
 
 # Include the router in the main app
 app.include_router(api_router)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Admission queues and breakers are read at scrape time
+metrics.register_snapshot_collector(
+    lambda: [c for c in (llm_admission, image_admission) if c is not None],
+    lambda: ([e.breaker for e in llm_router.endpoints] if llm_router else []) + [fal_breaker]
+)
+metrics.register_log_collector(log_pipeline.stats)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus scrape endpoint; served per worker port and not proxied under /api by nginx"""
+    body, content_type = metrics.render_latest()
+    return Response(content=body, media_type=content_type)
+
+# Configure logging: records are queued and written by a background thread, never from the event loop
+# Sampling applies below WARNING per logger; the rate limit applies per call site to every level
+log_pipeline.configure(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    json_format=os.getenv("LOG_FORMAT", "text").lower() == "json",
+    max_queue=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+    sample_rates=log_pipeline.parse_rates(os.getenv("LOG_SAMPLE_RATES", "chat.proactive=0.05")),
+    rate_limit_per_second=float(os.getenv("LOG_RATE_LIMIT_PER_SECOND", "5")),
+    rate_limit_burst=int(os.getenv("LOG_RATE_LIMIT_BURST", "20")),
+    capture_uvicorn=os.getenv("LOG_CAPTURE_UVICORN", "true").lower() == "true"
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
@@ -0,0 +1,56 @@
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("server_timings", default=None)
+
+
+def category(stage: str) -> str:
+    """Fold the fine-grained image stages into one Server-Timing entry"""
+    return "image" if stage.startswith("image") else stage
+
+
+def add(name: str, seconds: float):
+    """Add time to the current request's Server-Timing entry; a no-op outside a request.
+
+    Stages get here through metrics.stage, which also records them as metrics and spans.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        key = category(name)
+        timings[key] = timings.get(key, 0.0) + seconds
+
+
+def format_header(timings: Dict[str, float], total: float) -> str:
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header (llm, image, mongo, serialization, ...) to responses under a path prefix"""
+
+    def __init__(self, app, path_prefix: str = "/api"):
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            return await self.app(scope, receive, send)
+
+        timings: Dict[str, float] = {}
+        token = _timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                header = format_header(timings, time.perf_counter() - started)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", header.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
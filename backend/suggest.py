@@ -0,0 +1,216 @@
+import heapq
+import time
+import unicodedata
+from bisect import bisect_left
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+CARD_FIELDS = ("id", "name", "emoji", "gender", "tags", "usage_count")  # no description, prompt or avatar
+END = "\U0010ffff"  # sorts after every character, so prefix + END bounds a prefix range
+
+
+def normalize(text: str) -> str:
+    """Casefolded, accents stripped and whitespace collapsed, so "Zoë" is found by typing "zoe" """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def name_terms(name: str) -> Set[str]:
+    """The whole name plus every later word in it: "Moon Luna" is found by "moon l" and by "lu" """
+    normalized = normalize(name)
+    words = normalized.split(" ")
+    return {normalized, *words[1:]} - {""}
+
+
+class SortedTerms:
+    """(term, key) pairs in two parallel sorted lists; a prefix is one bisect away from its matches"""
+
+    def __init__(self):
+        self.terms: List[str] = []
+        self.keys: List[str] = []
+
+    def add(self, term: str, key: str):
+        position = bisect_left(self.terms, term)
+        self.terms.insert(position, term)
+        self.keys.insert(position, key)
+
+    def remove(self, term: str, key: str):
+        position = bisect_left(self.terms, term)
+        while position < len(self.terms) and self.terms[position] == term:
+            if self.keys[position] == key:
+                del self.terms[position]
+                del self.keys[position]
+                return
+            position += 1
+
+    def matching(self, prefix: str) -> List[str]:
+        return self.keys[bisect_left(self.terms, prefix):bisect_left(self.terms, prefix + END)]
+
+
+class SnapshotChanges(NamedTuple):
+    puts: List[dict]  # personalities new to the index or changed beyond their usage count
+    usage: Dict[str, int]  # id -> usage_count, for cards that differ only in that
+    removed: List[str]  # ids no longer in the snapshot
+
+
+class SuggestIndex:
+    """In-memory prefix index over public personality names and tags, ranked by usage_count.
+
+    Personalities are matched by name, tags by their own prefix; a tag ranks by the summed usage
+    of the personalities carrying it. Everything runs on the event loop and never awaits, so no
+    locking is needed. Each worker sees only its own put/remove calls, so the index is reloaded
+    from the collection now and then; put/remove made while a snapshot is read win over it.
+
+    Short prefixes match a large share of the catalog, so rankings over more than broad_matches
+    names are cached per prefix for cache_seconds (dropped on any put or remove); usage recorded
+    in between reorders them when they expire.
+    """
+
+    def __init__(self, max_results: int = 10, broad_matches: int = 256, cache_seconds: float = 5.0):
+        self.max_results = max_results
+        self.broad_matches = broad_matches
+        self.cache_seconds = cache_seconds
+        self.loaded = False
+        self._cards: Dict[str, dict] = {}
+        self._names = SortedTerms()
+        self._tag_names = SortedTerms()
+        self._tags: Dict[str, List[int]] = {}  # normalized tag -> [personality count, usage sum]
+        # Ids put or removed since the snapshot being read was requested (the first: since construction)
+        self._changed_since_snapshot: Optional[Set[str]] = set()
+        self._broad: Dict[str, Tuple[float, List[str]]] = {}  # prefix -> (expires at, ranked ids)
+
+    def __len__(self) -> int:
+        return len(self._cards)
+
+    def cards(self) -> Dict[str, dict]:
+        """A shallow copy of the indexed cards by id, for diff()"""
+        return dict(self._cards)
+
+    def begin_snapshot(self):
+        """Call before reading the snapshot for a reload, so changes made while it is read are kept"""
+        self._changed_since_snapshot = set()
+
+    def load(self, personalities: Iterable[dict]):
+        """Make the index match a snapshot of the public personalities, all on the calling thread"""
+        self.apply(self.diff(personalities, dict(self._cards)))
+
+    @classmethod
+    def diff(cls, personalities: Iterable[dict], cards: Dict[str, dict]) -> SnapshotChanges:
+        """What apply() must change to make cards (a copy of the index's) match a snapshot.
+
+        Touches neither argument, so a large catalog can be compared off the event loop.
+        """
+        current, puts, usage = set(), [], {}
+        for personality in personalities:
+            card = cls._card(personality)
+            current.add(card["id"])
+            indexed = cards.get(card["id"])
+            if indexed is None or card != {**indexed, "usage_count": card["usage_count"]}:
+                puts.append(personality)
+            elif card["usage_count"] != indexed["usage_count"]:
+                usage[card["id"]] = card["usage_count"]
+        return SnapshotChanges(puts, usage, [key for key in cards if key not in current])
+
+    def apply(self, changes: SnapshotChanges):
+        """Apply a diff(), except to ids put or removed since the snapshot was requested"""
+        changed = self._changed_since_snapshot or set()
+        self._changed_since_snapshot = None
+        for personality in changes.puts:
+            if personality["id"] not in changed:
+                self._put(personality)
+        for key, usage_count in changes.usage.items():
+            card = self._cards.get(key)
+            if card is not None and key not in changed:
+                self.record_use(key, usage_count - card["usage_count"])
+        for key in changes.removed:
+            if key not in changed:
+                self._remove(key)
+        self.loaded = True
+
+    def put(self, personality: dict):
+        """Index a created or updated personality (or drop it, if it is no longer public)"""
+        if self._changed_since_snapshot is not None:
+            self._changed_since_snapshot.add(personality["id"])
+        self._put(personality)
+
+    def remove(self, personality_id: str):
+        if self._changed_since_snapshot is not None:
+            self._changed_since_snapshot.add(personality_id)
+        self._remove(personality_id)
+
+    @staticmethod
+    def _card(personality: dict) -> dict:
+        card = {field: personality.get(field) for field in CARD_FIELDS}
+        card["tags"] = list(card["tags"] or [])
+        card["usage_count"] = card["usage_count"] or 0
+        return card
+
+    def _put(self, personality: dict):
+        self._remove(personality["id"])
+        self._broad.clear()
+        if not personality.get("is_public", True):
+            return
+        card = self._card(personality)
+        self._cards[card["id"]] = card
+        for term in name_terms(card["name"] or ""):
+            self._names.add(term, card["id"])
+        for tag in self._normalized_tags(card):
+            stats = self._tags.get(tag)
+            if stats is None:
+                stats = self._tags[tag] = [0, 0]
+                self._tag_names.add(tag, tag)
+            stats[0] += 1
+            stats[1] += card["usage_count"]
+
+    def _remove(self, personality_id: str):
+        card = self._cards.pop(personality_id, None)
+        if card is None:
+            return
+        self._broad.clear()
+        for term in name_terms(card["name"] or ""):
+            self._names.remove(term, personality_id)
+        for tag in self._normalized_tags(card):
+            stats = self._tags[tag]
+            stats[0] -= 1
+            stats[1] -= card["usage_count"]
+            if stats[0] == 0:
+                del self._tags[tag]
+                self._tag_names.remove(tag, tag)
+
+    def record_use(self, personality_id: str, count: int = 1):
+        """Mirror a usage_count increment, so the ranking follows without a reload"""
+        card = self._cards.get(personality_id)
+        if card is None:
+            return
+        card["usage_count"] += count
+        for tag in self._normalized_tags(card):
+            self._tags[tag][1] += count
+
+    def suggest(self, query: str, limit: Optional[int] = None) -> Tuple[List[dict], List[dict]]:
+        """The most used personalities whose name matches query, and the most used matching tags"""
+        prefix = normalize(query)
+        limit = min(limit or self.max_results, self.max_results)
+        if not prefix or limit <= 0:
+            return [], []
+        cards = self._cards
+        best = self._ranked_names(prefix)[:limit]
+        tags = heapq.nlargest(limit, self._tag_names.matching(prefix), key=lambda tag: (self._tags[tag][1], tag))
+        return (
+            [cards[key] for key in best],
+            [{"tag": tag, "count": self._tags[tag][0], "usage_count": self._tags[tag][1]} for tag in tags],
+        )
+
+    def _ranked_names(self, prefix: str) -> List[str]:
+        cached = self._broad.get(prefix)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        matching = self._names.matching(prefix)
+        cards = self._cards
+        # One personality can match through several words of its name
+        ranked = heapq.nlargest(self.max_results, set(matching), key=lambda key: (cards[key]["usage_count"], key))
+        if len(matching) > self.broad_matches:
+            self._broad[prefix] = (time.monotonic() + self.cache_seconds, ranked)
+        return ranked
+
+    @staticmethod
+    def _normalized_tags(card: dict) -> Set[str]:
+        return {normalize(tag) for tag in card["tags"] if isinstance(tag, str)} - {""}
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "private-ai-chatbot-api")
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "events", "status", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: str = "internal"):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes: Dict[str, object] = {}
+        self.events: List[Dict] = []
+        self.status = "ok"
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def record_error(self, exc: BaseException):
+        self.status = "error"
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "events": self.events,
+            "status": self.status,
+            "error": self.error,
+            "service": SERVICE_NAME,
+        }
+
+
+class StdoutExporter:
+    def export(self, spans: List[Span]):
+        for span in spans:
+            sys.stdout.write(json.dumps(span.to_dict(), default=str) + "\n")
+        sys.stdout.flush()
+
+
+class OTLPHTTPExporter:
+    """Posts spans in OTLP/JSON to a collector, e.g. the OpenTelemetry Collector on :4318"""
+
+    KINDS = {"internal": 1, "server": 2, "client": 3}
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+
+    def export(self, spans: List[Span]):
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "chat-api"}, "spans": [self._encode(s) for s in spans]}],
+        }]}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+    def _encode(self, span: Span) -> Dict:
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": self.KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+            "events": [
+                {
+                    "name": event["name"],
+                    "timeUnixNano": str(event["time_ns"]),
+                    "attributes": [_otlp_attribute(k, v) for k, v in event["attributes"].items()],
+                }
+                for event in span.events
+            ],
+            "status": {"code": 2, "message": span.error} if span.status == "error" else {"code": 1},
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        return encoded
+
+
+def _otlp_attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class BatchSpanProcessor:
+    """Hands finished spans to an exporter from a daemon thread; drops spans rather than block"""
+
+    def __init__(self, exporter, max_queue: int = 10000, batch_size: int = 256, flush_interval: float = 2.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: "queue.Queue[Span]" = queue.Queue(max_queue)
+        self._thread = None
+        self._pid = None
+
+    def on_end(self, span: Span):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        # Started lazily (and again after a fork) so import time stays free of threads
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                except Exception as e:
+                    self.dropped += len(batch)
+                    logging.getLogger(__name__).debug("Span export failed: %s", e)
+
+
+class Tracer:
+    """OpenTelemetry-shaped spans without the SDK; TRACING_EXPORTER picks none, stdout (JSON lines) or otlp"""
+
+    def __init__(self, processor: Optional[BatchSpanProcessor]):
+        self.processor = processor
+
+    def start_span(self, name: str, kind: str = "internal", trace_id: Optional[str] = None, parent_id: Optional[str] = None) -> Span:
+        parent = _current_span.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent else secrets.token_hex(16)
+            parent_id = parent.span_id if parent else None
+        return Span(name, trace_id, parent_id, kind)
+
+    def end_span(self, span: Span):
+        span.end_ns = time.time_ns()
+        if self.processor is not None:
+            self.processor.on_end(span)
+
+
+def _create_tracer() -> Tracer:
+    exporter_name = os.getenv("TRACING_EXPORTER", "none").lower()
+    if exporter_name == "stdout":
+        return Tracer(BatchSpanProcessor(StdoutExporter()))
+    if exporter_name == "otlp":
+        endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
+        return Tracer(BatchSpanProcessor(OTLPHTTPExporter(endpoint)))
+    return Tracer(None)
+
+
+tracer = _create_tracer()
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """Child span of whatever span is current; spans are still created when export is off so ids flow into logs"""
+    current = tracer.start_span(name, kind)
+    current.attributes.update(attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        tracer.end_span(current)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def parse_traceparent(header: Optional[str]):
+    """W3C traceparent: version-traceid-parentid-flags"""
+    if not header:
+        return None, None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+class TracingMiddleware:
+    """Root server span per request, continuing an incoming traceparent and echoing X-Request-ID"""
+
+    def __init__(self, app, path_prefix: str = "/api"):
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or not scope["path"].startswith(self.path_prefix):
+            return await self.app(scope, receive, send)
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        trace_id, parent_id = parse_traceparent(headers.get("traceparent"))
+        root = tracer.start_span(f"{scope.get('method', 'WS')} {scope['path']}", "server", trace_id, parent_id)
+        request_id = headers.get("x-request-id") or root.trace_id
+        root.attributes.update({
+            "http.method": scope.get("method", "GET"),
+            "http.target": scope["path"],
+            "request.id": request_id,
+        })
+        span_token = _current_span.set(root)
+        request_token = _request_id.set(request_id)
+
+        async def send_with_ids(message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    root.status = "error"
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1")),
+                    (b"traceparent", f"00-{root.trace_id}-{root.span_id}-01".encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_ids)
+        except BaseException as e:
+            root.record_error(e)
+            raise
+        finally:
+            route = scope.get("route")
+            if route is not None and getattr(route, "path", None):
+                root.name = f"{scope.get('method', 'WS')} {route.path}"
+            _current_span.reset(span_token)
+            _request_id.reset(request_token)
+            tracer.end_span(root)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps every log record with the request id and the active trace/span ids"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        current = _current_span.get()
+        record.request_id = _request_id.get() or "-"
+        record.trace_id = current.trace_id if current else "-"
+        record.span_id = current.span_id if current else "-"
+        return True
@@ -0,0 +1,222 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+GENDERS = ("male", "female", "non-binary", "other")
+
+
+class MemoryUsageBackend:
+    """Per-process usage buckets, for development and single-worker deployments"""
+
+    def __init__(self):
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    async def add(self, counts: Dict[Tuple[str, int], int], expires_after: float):
+        for key, count in counts.items():
+            self._counts[key] = self._counts.get(key, 0) + count
+
+    async def scores(self, now: float, since: float, half_life: float) -> Dict[str, float]:
+        scores: Dict[str, float] = {}
+        for (personality_id, bucket), count in list(self._counts.items()):
+            if bucket < since:
+                del self._counts[(personality_id, bucket)]
+                continue
+            scores[personality_id] = scores.get(personality_id, 0.0) + count * 0.5 ** ((now - bucket) / half_life)
+        return scores
+
+
+class MongoUsageBackend:
+    """One document per personality and bucket, shared by every worker; Mongo computes the decayed sums"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("bucket")
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def add(self, counts: Dict[Tuple[str, int], int], expires_after: float):
+        from pymongo import UpdateOne
+
+        expires_at = datetime.utcnow() + timedelta(seconds=expires_after)
+        await self.collection.bulk_write([
+            UpdateOne(
+                {"_id": f"{personality_id}:{bucket}"},
+                {
+                    "$inc": {"count": count},
+                    "$setOnInsert": {"personality_id": personality_id, "bucket": bucket, "expires_at": expires_at},
+                },
+                upsert=True,
+            )
+            for (personality_id, bucket), count in counts.items()
+        ], ordered=False)
+
+    async def scores(self, now: float, since: float, half_life: float) -> Dict[str, float]:
+        pipeline = [
+            {"$match": {"bucket": {"$gte": since}}},
+            {"$group": {
+                "_id": "$personality_id",
+                "score": {"$sum": {"$multiply": [
+                    "$count",
+                    {"$pow": [0.5, {"$divide": [{"$subtract": [now, "$bucket"]}, half_life]}]},
+                ]}},
+            }},
+        ]
+        return {row["_id"]: row["score"] async for row in self.collection.aggregate(pipeline)}
+
+
+class TrendingRanking:
+    """Public personality ids ranked by trending score, materialized per catalog filter.
+
+    Lists exist for everything, each gender, each popular tag and each gender with a popular tag.
+    Any other filter (several tags, a rare tag) is derived by filtering the closest list on first
+    use and memoized, since a ranking never changes once built.
+    """
+
+    MAX_DERIVED = 128
+
+    def __init__(
+        self,
+        ranked: List[str],
+        scores: Dict[str, float],
+        genders: Dict[str, str],
+        tags: Dict[str, FrozenSet[str]],
+        popular_tags: List[str],
+        computed_at: float,
+    ):
+        self.scores = scores
+        self.genders = genders
+        self.tags = tags
+        self.popular_tags = popular_tags
+        self.computed_at = computed_at
+        self.lists: Dict[str, List[str]] = {"all": ranked}
+        for gender in GENDERS:
+            self.lists[f"gender:{gender}"] = []
+            for tag in popular_tags:
+                self.lists[f"gender:{gender}:tag:{tag}"] = []
+        for tag in popular_tags:
+            self.lists[f"tag:{tag}"] = []
+        popular = frozenset(popular_tags)
+        for key in ranked:
+            gender = genders[key] if genders[key] in GENDERS else None
+            if gender:
+                self.lists[f"gender:{gender}"].append(key)
+            for tag in tags[key] & popular:
+                self.lists[f"tag:{tag}"].append(key)
+                if gender:
+                    self.lists[f"gender:{gender}:tag:{tag}"].append(key)
+        self._derived: Dict[Tuple[Optional[str], FrozenSet[str]], List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.lists["all"])
+
+    def matching(self, gender: Optional[str], tags: Iterable[str]) -> List[str]:
+        """Ranked ids with this gender (None for any) carrying at least one of tags (empty for any)"""
+        wanted = frozenset(tags)
+        prefix = f"gender:{gender}" if gender else ""
+        if not wanted:
+            return self.lists[prefix or "all"]
+        if len(wanted) == 1:
+            materialized = self.lists.get(f"{prefix}:tag:{next(iter(wanted))}" if gender else f"tag:{next(iter(wanted))}")
+            if materialized is not None:
+                return materialized
+        derived = self._derived.get((gender, wanted))
+        if derived is None:
+            # Linear in the catalog (milliseconds at 10k), paid once per filter per refresh
+            tags_of = self.tags
+            derived = [key for key in self.lists[prefix or "all"] if not tags_of[key].isdisjoint(wanted)]
+            if len(self._derived) >= self.MAX_DERIVED:
+                self._derived.clear()
+            self._derived[(gender, wanted)] = derived
+        return derived
+
+    def page(self, gender: Optional[str], tags: Iterable[str], offset: int, limit: int) -> Tuple[List[str], int]:
+        """One catalog page of ids, and how many match in total"""
+        matching = self.matching(gender, tags)
+        return matching[offset:offset + limit], len(matching)
+
+
+def build_ranking(
+    scores: Dict[str, float],
+    personalities: List[dict],
+    popular_tag_count: int,
+    computed_at: float,
+) -> TrendingRanking:
+    """Rank personalities by score, breaking ties (and ranking those with no recent use) by lifetime usage"""
+    genders = {p["id"]: p.get("gender") for p in personalities}
+    tags = {p["id"]: frozenset(tag for tag in p.get("tags") or [] if isinstance(tag, str)) for p in personalities}
+    usage = {p["id"]: p.get("usage_count") or 0 for p in personalities}
+    ranked = sorted(genders, key=lambda key: (-scores.get(key, 0.0), -usage[key], key))
+    tag_counts = Counter(tag for personality_tags in tags.values() for tag in personality_tags)
+    popular_tags = [tag for tag, _ in tag_counts.most_common(popular_tag_count)]
+    return TrendingRanking(
+        ranked,
+        {key: scores[key] for key in genders if key in scores},
+        genders,
+        tags,
+        popular_tags,
+        computed_at,
+    )
+
+
+class TrendingRanker:
+    """Counts personality uses into time buckets and periodically turns them into a TrendingRanking.
+
+    A use is worth 1 in the bucket it happened in and decays by half every half_life seconds;
+    buckets older than window seconds no longer count. Uses are counted in memory and written
+    to the backend in one batch per refresh, so recording one costs a dict update.
+    """
+
+    def __init__(
+        self,
+        backend,
+        half_life: float = 24 * 3600,
+        window: float = 7 * 24 * 3600,
+        bucket_seconds: int = 3600,
+        popular_tags: int = 20,
+    ):
+        self.backend = backend
+        self.half_life = half_life
+        self.window = window
+        self.bucket_seconds = bucket_seconds
+        self.popular_tags = popular_tags
+        self.ranking: Optional[TrendingRanking] = None
+        self._pending: Dict[Tuple[str, int], int] = {}
+
+    def record_use(self, personality_id: str, now: Optional[float] = None):
+        moment = time.time() if now is None else now
+        key = (personality_id, int(moment // self.bucket_seconds * self.bucket_seconds))
+        self._pending[key] = self._pending.get(key, 0) + 1
+
+    async def flush(self):
+        """Write the uses counted since the last flush; they are counted again if the write fails"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await self.backend.add(pending, self.window + self.bucket_seconds)
+        except BaseException:
+            for key, count in pending.items():
+                self._pending[key] = self._pending.get(key, 0) + count
+            raise
+
+    async def refresh(self, personalities: List[dict]) -> TrendingRanking:
+        """Flush, recompute the scores and swap in a ranking of personalities (the public catalog)"""
+        await self.flush()
+        now = time.time()
+        scores = await self.backend.scores(now, now - self.window, self.half_life)
+        # Sorting and filtering a large catalog takes milliseconds; keep it off the event loop
+        self.ranking = await asyncio.to_thread(build_ranking, scores, personalities, self.popular_tags, now)
+        return self.ranking
+
+    def snapshot(self) -> dict:
+        ranking = self.ranking
+        return {
+            "ranked": len(ranking) if ranking else 0,
+            "scored": len(ranking.scores) if ranking else 0,
+            "popular_tags": ranking.popular_tags if ranking else [],
+            "age_seconds": round(time.time() - ranking.computed_at, 1) if ranking else None,
+            "pending_uses": sum(self._pending.values()),
+        }
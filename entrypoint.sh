@@ -4,38 +4,100 @@ set -e
 # Start the FastAPI backend
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
-echo "Starting FastAPI backend"
-# Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
-BACKEND_PID=$!
+# One uvicorn process per core by default, each on its own port; nginx balances across them
+WORKERS=${WEB_CONCURRENCY:-$(nproc 2>/dev/null || echo 1)}
+BASE_PORT=${BACKEND_BASE_PORT:-8001}
+# The workers read this to keep their stores in Mongo rather than each in its own memory
+export BACKEND_WORKERS="$WORKERS"
+# Every worker must verify the user tokens the others issue; a generated secret lasts until restart
+if [ -z "$USER_TOKEN_SECRET" ]; then
+    USER_TOKEN_SECRET=$(head -c 32 /dev/urandom | od -An -tx1 | tr -d ' \n')
+    echo "USER_TOKEN_SECRET is not set; user tokens will not survive a restart"
+fi
+export USER_TOKEN_SECRET
+GRACEFUL_TIMEOUT=${GRACEFUL_SHUTDOWN_TIMEOUT:-30}
+UPSTREAM_CONF=/etc/nginx/backend_upstream.conf
 
-echo "Waiting for backend to start..."
-sleep 30
+echo "upstream backend {" > "$UPSTREAM_CONF"
+echo "  least_conn;" >> "$UPSTREAM_CONF"
 
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend failed to start at initialization, exiting"
-    exit 1
-fi
+BACKEND_PIDS=""
+i=0
+while [ "$i" -lt "$WORKERS" ]; do
+    PORT=$((BASE_PORT + i))
+    echo "Starting FastAPI backend worker $i on port $PORT"
+    # Start Uvicorn with proper host binding
+    uvicorn server:app --host 0.0.0.0 --port "$PORT" --timeout-graceful-shutdown "$GRACEFUL_TIMEOUT" &
+    BACKEND_PIDS="$BACKEND_PIDS $!"
+    echo "  server 127.0.0.1:$PORT max_fails=3 fail_timeout=10s;" >> "$UPSTREAM_CONF"
+    i=$((i + 1))
+done
+
+echo "  keepalive 64;" >> "$UPSTREAM_CONF"
+echo "}" >> "$UPSTREAM_CONF"
+
+backends_alive() {
+    for pid in $BACKEND_PIDS; do
+        kill -0 "$pid" 2>/dev/null || return 1
+    done
+    return 0
+}
+
+# Wait until every worker reports ready (Mongo reachable, pools warmed) instead of a fixed sleep
+READY_TIMEOUT=${BACKEND_READY_TIMEOUT:-60}
+echo "Waiting for backend to become ready..."
+attempts=0
+i=0
+while [ "$i" -lt "$WORKERS" ]; do
+    if ! backends_alive; then
+        echo "Backend failed to start at initialization, exiting"
+        kill $BACKEND_PIDS 2>/dev/null || true
+        exit 1
+    fi
+    if wget -q -O /dev/null "http://127.0.0.1:$((BASE_PORT + i))/api/ready" 2>/dev/null; then
+        i=$((i + 1))
+        continue
+    fi
+    if [ "$attempts" -ge $((READY_TIMEOUT * 2)) ]; then
+        echo "Backend not ready after ${READY_TIMEOUT}s, starting nginx anyway"
+        break
+    fi
+    sleep 0.5
+    attempts=$((attempts + 1))
+done
 
 # Start Nginx
 nginx -g 'daemon off;' &
 NGINX_PID=$!
 
+# Graceful shutdown: stop accepting at nginx, then let every worker drain its in-flight requests
+shutdown() {
+    echo "Shutting down, draining in-flight requests..."
+    nginx -s quit 2>/dev/null || kill "$NGINX_PID" 2>/dev/null || true
+    kill -TERM $BACKEND_PIDS 2>/dev/null || true
+    for pid in $BACKEND_PIDS; do
+        wait "$pid" 2>/dev/null || true
+    done
+    wait "$NGINX_PID" 2>/dev/null || true
+    exit 0
+}
+
 # Handle termination signals
-trap 'kill $BACKEND_PID $NGINX_PID; exit 0' SIGTERM SIGINT
+trap shutdown TERM INT
 
 # Check if processes are still running
-while kill -0 $BACKEND_PID 2>/dev/null && kill -0 $NGINX_PID 2>/dev/null; do
+while backends_alive && kill -0 $NGINX_PID 2>/dev/null; do
     sleep 1
 done
 
 # If we get here, one of the processes died
-if kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Nginx died, shutting down backend..."
-    kill $BACKEND_PID
-else
+if kill -0 $NGINX_PID 2>/dev/null; then
     echo "Backend died, shutting down nginx..."
     kill $NGINX_PID
+    kill $BACKEND_PIDS 2>/dev/null || true
+else
+    echo "Nginx died, shutting down backend..."
+    kill $BACKEND_PIDS 2>/dev/null || true
 fi
 
 exit 1
@@ -0,0 +1,371 @@
+"""Load-test driver: open-loop arrivals at stepped rates, per-endpoint latency and memory report.
+
+Against a running worker (talk to the uvicorn port directly, so /metrics is reachable for RSS):
+
+    python -m loadtest.run --target http://127.0.0.1:8001 --mix default --rates 2,5,10,20 --duration 30
+
+Self-contained: start the stubs and one API worker against a local Mongo, then tear them down:
+
+    python -m loadtest.run --spawn --mongo-url mongodb://127.0.0.1:27017 --rates 5,10,20,40
+
+Replay a recorded capture (see loadtest/traffic.py for the NDJSON format) at 2x speed:
+
+    python -m loadtest.run --target http://127.0.0.1:8001 --replay capture.ndjson --speed 2
+
+The saturation point is the last rate step whose p99 stayed under --slo-p99-ms, whose error
+rate stayed under --max-error-rate and whose completions kept pace with arrivals once the first responses were back.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from loadtest.traffic import MIXES, PlannedRequest, TrafficGenerator, load_replay, mix_sampler
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RSS_PATTERN = re.compile(r"^process_resident_memory_bytes\s+(\S+)$", re.MULTILINE)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class PhaseResult:
+    """Latencies and outcomes for one rate step, keyed by traffic label"""
+
+    def __init__(self, name: str, offered_rps: Optional[float]):
+        self.name = name
+        self.offered_rps = offered_rps
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.dropped = 0
+        self.started = time.monotonic()
+        self.arrivals_end = self.started
+        self.finished = self.started
+        self.arrivals: List[float] = []
+        self.completions: List[float] = []
+        self.rss_samples: List[float] = []
+
+    def record(self, label: str, status: str, seconds: float):
+        self.latencies[label].append(seconds)
+        self.statuses[label][status] += 1
+        self.completions.append(time.monotonic())
+
+    def steady_state(self):
+        """Arrival and completion rates over the second half of the arrival window.
+
+        Once the first responses are back, a worker that keeps up completes requests as fast
+        as they arrive, whatever their latency; a saturated one completes them at its capacity.
+        """
+        window_start = self.started + (self.arrivals_end - self.started) / 2
+        window = max(self.arrivals_end - window_start, 1e-9)
+        arrived = sum(1 for t in self.arrivals if window_start <= t < self.arrivals_end)
+        completed = sum(1 for t in self.completions if window_start <= t < self.arrivals_end)
+        return arrived / window, completed / window
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.finished - self.started, 1e-9)
+
+    def summary(self) -> Dict:
+        endpoints = {}
+        for label, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            ok = sum(count for status, count in self.statuses[label].items() if status.startswith("2"))
+            endpoints[label] = {
+                "requests": len(values),
+                "ok_rate": ok / len(values),
+                "rps": len(values) / self.elapsed,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": values[-1] * 1000,
+                "statuses": dict(self.statuses[label]),
+            }
+        all_values = sorted(v for values in self.latencies.values() for v in values)
+        total = len(all_values)
+        arrival_rps, completion_rps = self.steady_state()
+        failed = sum(
+            count for statuses in self.statuses.values() for status, count in statuses.items() if not status.startswith("2")
+        )
+        return {
+            "phase": self.name,
+            "offered_rps": self.offered_rps,
+            "arrival_rps": arrival_rps,
+            "achieved_rps": completion_rps,
+            "requests": total,
+            "dropped": self.dropped,
+            "error_rate": (failed + self.dropped) / max(total + self.dropped, 1),
+            "p99_ms": percentile(all_values, 0.99) * 1000,
+            "rss_start_mb": self.rss_samples[0] / 2**20 if self.rss_samples else None,
+            "rss_peak_mb": max(self.rss_samples) / 2**20 if self.rss_samples else None,
+            "endpoints": endpoints,
+        }
+
+
+async def fire(client: httpx.AsyncClient, planned: PlannedRequest, result: PhaseResult):
+    started = time.perf_counter()
+    try:
+        response = await client.request(planned.method, planned.path, json=planned.body, headers=planned.headers)
+        status = str(response.status_code)
+    except httpx.TimeoutException:
+        status = "timeout"
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    result.record(planned.label, status, time.perf_counter() - started)
+
+
+async def sample_rss(client: httpx.AsyncClient, result: PhaseResult, stop: asyncio.Event, interval: float = 0.5):
+    """Worker RSS from the Prometheus process collector on /metrics"""
+    while not stop.is_set():
+        try:
+            response = await client.get("/metrics", timeout=2)
+            match = RSS_PATTERN.search(response.text)
+            if match:
+                result.rss_samples.append(float(match.group(1)))
+        except httpx.HTTPError:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_tasks(client: httpx.AsyncClient, result: PhaseResult, schedule, max_in_flight: int, drain_timeout: float):
+    """Fire requests at the times yielded by schedule (open loop: arrivals do not wait for responses)"""
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(client, result, stop))
+    tasks = set()
+    async for planned in schedule:
+        result.arrivals.append(time.monotonic())
+        if len(tasks) >= max_in_flight:
+            result.dropped += 1
+            continue
+        task = asyncio.create_task(fire(client, planned, result))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    result.arrivals_end = time.monotonic()
+    if tasks:
+        await asyncio.wait(set(tasks), timeout=drain_timeout)
+    for task in tasks:
+        task.cancel()
+    result.finished = time.monotonic()
+    stop.set()
+    await sampler
+
+
+async def poisson_schedule(sample, rate: float, duration: float, rng: random.Random):
+    started = time.monotonic()
+    next_at = started
+    while True:
+        next_at += rng.expovariate(rate)
+        if next_at - started >= duration:
+            return
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+        yield sample()
+
+
+async def replay_schedule(path: Path, speed: float):
+    started = time.monotonic()
+    for offset, planned in load_replay(path):
+        await asyncio.sleep(max(0.0, started + offset / speed - time.monotonic()))
+        yield planned
+
+
+async def seed_catalog(client: httpx.AsyncClient, generator: TrafficGenerator, count: int):
+    semaphore = asyncio.Semaphore(16)
+
+    async def seed(index: int):
+        planned = generator.seed_personality(index)
+        async with semaphore:
+            await client.request(planned.method, planned.path, json=planned.body, headers=planned.headers)
+
+    await asyncio.gather(*(seed(i) for i in range(count)))
+
+
+def saturation_point(summaries: List[Dict], slo_p99_ms: float, max_error_rate: float) -> Optional[float]:
+    """Highest offered rate that still met the SLO; None if even the first step missed it"""
+    sustained = None
+    for summary in summaries:
+        keeps_up = summary["achieved_rps"] >= 0.9 * summary["arrival_rps"]
+        if summary["p99_ms"] > slo_p99_ms or summary["error_rate"] > max_error_rate or not keeps_up:
+            break
+        sustained = summary["offered_rps"]
+    return sustained
+
+
+def print_summary(summary: Dict):
+    offered = f"{summary['offered_rps']:.1f}" if summary["offered_rps"] is not None else "replay"
+    rss = ""
+    if summary["rss_peak_mb"] is not None:
+        rss = f", RSS {summary['rss_start_mb']:.0f} -> peak {summary['rss_peak_mb']:.0f} MB"
+    print(
+        f"\n== {summary['phase']}: offered {offered} rps, steady state {summary['arrival_rps']:.1f} in / "
+        f"{summary['achieved_rps']:.1f} done rps, "
+        f"errors {summary['error_rate']:.1%}, dropped {summary['dropped']}{rss}"
+    )
+    print(f"  {'endpoint':<18} {'reqs':>6} {'ok':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, stats in summary["endpoints"].items():
+        print(
+            f"  {label:<18} {stats['requests']:>6} {stats['ok_rate']:>6.1%} {stats['rps']:>7.1f} "
+            f"{stats['p50_ms']:>8.0f} {stats['p95_ms']:>8.0f} {stats['p99_ms']:>8.0f} {stats['max_ms']:>8.0f}"
+        )
+        failures = {status: count for status, count in stats["statuses"].items() if not status.startswith("2")}
+        if failures:
+            print(f"  {'':<18} failures: {failures}")
+
+
+def spawn_stack(args) -> List[subprocess.Popen]:
+    """Start the upstream stubs and one API worker wired to them"""
+    cert_dir = Path(args.cert_dir)
+    stubs = subprocess.Popen(
+        [sys.executable, "-m", "loadtest.stubs", "--llm-port", str(args.llm_port), "--fal-port", str(args.fal_port),
+         "--cert-dir", str(cert_dir), *args.stub_arg],
+        cwd=REPO_ROOT,
+    )
+    fal_host = f"localhost:{args.fal_port}"
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "DB_NAME": args.db_name,
+        "SAMBA_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+        "SAMBA_API_KEY": "stub",
+        "FAL_KEY": "stub",
+        "FAL_RUN_HOST": fal_host,
+        "FAL_QUEUE_RUN_HOST": fal_host,
+        "SSL_CERT_FILE": str(cert_dir / "stub.crt"),
+        # The harness measures capacity, not the per-user limits
+        "RATE_LIMIT_CHAT": "1000000/minute",
+        "RATE_LIMIT_OPENING": "1000000/minute",
+        "RATE_LIMIT_PROACTIVE": "1000000/minute",
+        "RATE_LIMIT_IMAGE": "1000000/minute",
+        "RATE_LIMIT_STORAGE": "memory",
+    }
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(args.api_port), "--log-level", "warning"],
+        cwd=REPO_ROOT / "backend",
+        env=env,
+    )
+    return [api, stubs]
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/api/ready", timeout=2)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"API not ready after {timeout:.0f}s")
+
+
+async def main_async(args) -> int:
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.target, timeout=args.request_timeout, limits=limits) as client:
+        await wait_ready(client, args.ready_timeout)
+        generator = TrafficGenerator(seed=args.seed, users=args.users)
+        rng = random.Random(args.seed)
+        summaries = []
+
+        if args.replay:
+            result = PhaseResult(f"replay {args.replay.name}", None)
+            await run_tasks(client, result, replay_schedule(args.replay, args.speed), args.max_in_flight, args.request_timeout)
+            summaries.append(result.summary())
+            print_summary(summaries[-1])
+        else:
+            weights = MIXES[args.mix]
+            if args.seed_personalities and "catalog" in weights:
+                await seed_catalog(client, generator, args.seed_personalities)
+            # --isolate ramps each traffic class on its own, so RSS growth is attributable to one endpoint
+            groups = {label: {label: 1} for label in weights} if args.isolate else {args.mix: weights}
+            for group, group_weights in groups.items():
+                sample = mix_sampler(generator, group_weights)
+                group_summaries = []
+                for rate in args.rates:
+                    result = PhaseResult(f"{group} @ {rate:g} rps", rate)
+                    await run_tasks(client, result, poisson_schedule(sample, rate, args.duration, rng), args.max_in_flight, args.request_timeout)
+                    group_summaries.append(result.summary())
+                    print_summary(group_summaries[-1])
+                    if args.pause:
+                        await asyncio.sleep(args.pause)
+                point = saturation_point(group_summaries, args.slo_p99_ms, args.max_error_rate)
+                verdict = f"~{point:g} rps" if point is not None else f"below {args.rates[0]:g} rps"
+                print(f"\n>> {group}: sustained {verdict} within p99 {args.slo_p99_ms:.0f} ms / errors {args.max_error_rate:.0%}")
+                summaries.extend(group_summaries)
+
+        if args.json_out:
+            args.json_out.write_text(json.dumps(summaries, indent=2))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Load-test the chat API against local upstream stubs")
+    parser.add_argument("--target", default=None, help="API base URL (a single uvicorn worker); defaults to the spawned one")
+    parser.add_argument("--mix", default="default", choices=sorted(MIXES))
+    parser.add_argument("--replay", type=Path, help="NDJSON capture to replay instead of a synthetic mix")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--rates", type=lambda s: [float(r) for r in s.split(",")], default=[2.0, 5.0, 10.0, 20.0])
+    parser.add_argument("--duration", type=float, default=30, help="seconds per rate step")
+    parser.add_argument("--pause", type=float, default=2, help="idle seconds between steps")
+    parser.add_argument("--isolate", action="store_true", help="ramp each traffic class of the mix separately")
+    parser.add_argument("--max-in-flight", type=int, default=512)
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--slo-p99-ms", type=float, default=10000)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--seed-personalities", type=int, default=200, help="public personalities to create before catalog traffic")
+    parser.add_argument("--json-out", type=Path)
+    parser.add_argument("--ready-timeout", type=float, default=60)
+
+    spawn = parser.add_argument_group("spawned stack")
+    spawn.add_argument("--spawn", action="store_true", help="start the stubs and one API worker")
+    spawn.add_argument("--mongo-url", default="mongodb://127.0.0.1:27017")
+    spawn.add_argument("--db-name", default="loadtest")
+    spawn.add_argument("--api-port", type=int, default=8101)
+    spawn.add_argument("--llm-port", type=int, default=9001)
+    spawn.add_argument("--fal-port", type=int, default=9002)
+    spawn.add_argument("--cert-dir", default="/tmp/loadtest-certs")
+    spawn.add_argument("--stub-arg", action="append", default=[], help="passed through to loadtest.stubs, e.g. --stub-arg=--llm-ttft-ms=800")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    processes = []
+    if args.spawn:
+        processes = spawn_stack(args)
+        args.target = args.target or f"http://127.0.0.1:{args.api_port}"
+    elif not args.target:
+        print("Pass --target or --spawn", file=sys.stderr)
+        return 2
+    try:
+        return asyncio.run(main_async(args))
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
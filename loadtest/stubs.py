@@ -0,0 +1,264 @@
+"""Local stand-ins for the paid upstreams, for load tests.
+
+One process serves two ports:
+  * an OpenAI-compatible API (what SambaNova exposes) on --llm-port over plain HTTP, with
+    configurable time-to-first-token, token rate and SSE streaming;
+  * a fal.ai queue API (submit / status / result) plus a CDN on --fal-port over HTTPS,
+    because fal_client always talks https to FAL_QUEUE_RUN_HOST. A self-signed
+    certificate is written to --cert-dir; point the API at it with SSL_CERT_FILE.
+
+    python -m loadtest.stubs --llm-port 9001 --fal-port 9002 --cert-dir /tmp/loadtest-certs
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import ipaddress
+import json
+import os
+import random
+import time
+import uuid
+from pathlib import Path
+from typing import Dict
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "i missed you today and kept thinking about our talk the river was calm "
+    "and the light was soft so tell me more about your week"
+).split()
+
+
+def stub_image(kb: int) -> bytes:
+    """A decodable 1024x1024 JPEG, so the API's transcoding runs as in production; random bytes without Pillow"""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return os.urandom(kb * 1024)
+    image = Image.new("RGB", (1024, 1024))
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 1024, 4):
+        draw.line([(x, 0), (1024 - x, 1024)], fill=(x % 256, (x * 3) % 256, 200))
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=92)
+    return output.getvalue()
+
+
+class StubConfig:
+    """Latency and payload knobs; every delay is jittered by +/- jitter (a fraction)"""
+
+    def __init__(self, args):
+        self.model = args.model
+        self.ttft = args.llm_ttft_ms / 1000
+        self.tokens_per_second = args.llm_tokens_per_second
+        self.completion_tokens = args.llm_completion_tokens
+        self.image_marker_rate = args.llm_image_marker_rate
+        self.image_markers = args.llm_image_markers
+        self.llm_error_rate = args.llm_error_rate
+        self.fal_queue = args.fal_queue_ms / 1000
+        self.fal_render = args.fal_render_ms / 1000
+        self.fal_error_rate = args.fal_error_rate
+        self.cdn_latency = args.cdn_latency_ms / 1000
+        self.image_bytes = stub_image(args.image_kb)
+        self.jitter = args.jitter
+        self.rng = random.Random(args.seed)
+
+    def delay(self, seconds: float) -> float:
+        return max(0.0, seconds * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+
+def create_llm_app(config: StubConfig) -> FastAPI:
+    app = FastAPI(title="LLM stub")
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": config.model, "object": "model", "created": 0, "owned_by": "stub"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if config.rng.random() < config.llm_error_rate:
+            return JSONResponse({"error": {"message": "stub overloaded", "type": "server_error"}}, status_code=503)
+
+        completion_tokens = min(int(body.get("max_tokens") or config.completion_tokens), config.completion_tokens)
+        words = [config.rng.choice(WORDS) for _ in range(completion_tokens)]
+        if config.rng.random() < config.image_marker_rate:
+            for scene in range(config.image_markers):
+                words += ["[IMAGE:", "a", "stub", "portrait", "at", "golden", "hour,", "scene", f"{scene + 1}]"]
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        per_token = 1 / config.tokens_per_second
+
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(config.delay(config.ttft))
+                for i, word in enumerate(words):
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                        "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await asyncio.sleep(per_token)
+                final = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+                }
+                yield f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(config.delay(config.ttft + len(words) * per_token))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+        }
+
+    return app
+
+
+def create_fal_app(config: StubConfig) -> FastAPI:
+    """Queue protocol as used by fal_client: POST submit, GET .../status, GET result, then a CDN fetch"""
+    app = FastAPI(title="fal.ai stub")
+    jobs: Dict[str, dict] = {}
+
+    def job_urls(request: Request, owner: str, alias: str, request_id: str) -> dict:
+        base = f"{str(request.base_url).rstrip('/')}/{owner}/{alias}/requests/{request_id}"
+        return {"request_id": request_id, "response_url": base, "status_url": f"{base}/status", "cancel_url": f"{base}/cancel"}
+
+    def job_state(job: dict) -> str:
+        elapsed = time.monotonic() - job["submitted_at"]
+        if elapsed < job["queue"]:
+            return "IN_QUEUE"
+        if elapsed < job["queue"] + job["render"]:
+            return "IN_PROGRESS"
+        return "COMPLETED"
+
+    @app.get("/cdn/{name}")
+    async def cdn(name: str):
+        await asyncio.sleep(config.delay(config.cdn_latency))
+        return Response(content=config.image_bytes, media_type="image/jpeg")
+
+    @app.post("/{owner}/{alias}/{path:path}")
+    @app.post("/{owner}/{alias}")
+    async def submit(owner: str, alias: str, request: Request, path: str = ""):
+        arguments = await request.json()
+        if config.rng.random() < config.fal_error_rate:
+            raise HTTPException(status_code=503, detail="stub overloaded")
+        request_id = uuid.uuid4().hex
+        jobs[request_id] = {
+            "submitted_at": time.monotonic(),
+            "queue": config.delay(config.fal_queue),
+            # --fal-render-ms is for a 28-step render; fewer steps (preview tiers) finish proportionally sooner
+            "render": config.delay(config.fal_render) * arguments.get("num_inference_steps", 28) / 28,
+        }
+        return job_urls(request, owner, alias, request_id)
+
+    @app.get("/{owner}/{alias}/requests/{request_id}/status")
+    async def status(owner: str, alias: str, request_id: str):
+        job = jobs.get(request_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown request")
+        state = job_state(job)
+        if state == "IN_QUEUE":
+            return JSONResponse({"status": state, "queue_position": 0}, status_code=202)
+        if state == "IN_PROGRESS":
+            return JSONResponse({"status": state, "logs": None}, status_code=202)
+        return {"status": state, "logs": None, "metrics": {"inference_time": job["render"]}}
+
+    @app.get("/{owner}/{alias}/requests/{request_id}")
+    async def result(owner: str, alias: str, request_id: str, request: Request):
+        job = jobs.get(request_id)
+        if job is None or job_state(job) != "COMPLETED":
+            raise HTTPException(status_code=400, detail="request is still in progress")
+        jobs.pop(request_id)
+        url = f"{str(request.base_url).rstrip('/')}/cdn/{request_id}.jpg"
+        return {"images": [{"url": url, "width": 1024, "height": 1024, "content_type": "image/jpeg"}], "seed": 0}
+
+    @app.put("/{owner}/{alias}/requests/{request_id}/cancel")
+    async def cancel(owner: str, alias: str, request_id: str):
+        jobs.pop(request_id, None)
+        return {"status": "CANCELLATION_REQUESTED"}
+
+    return app
+
+
+def write_self_signed_cert(cert_dir: Path, hostnames) -> tuple:
+    """Certificate for localhost plus any extra hostnames (e.g. the compose service name)"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    cert_dir.mkdir(parents=True, exist_ok=True)
+    key = ec.generate_private_key(ec.SECP256R1())
+    names = [x509.DNSName(name) for name in ("localhost", *hostnames)] + [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "loadtest-stub")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .add_extension(x509.SubjectAlternativeName(names), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = cert_dir / "stub.crt", cert_dir / "stub.key"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    return cert_path, key_path
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="OpenAI-compatible and fal.ai stubs for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--llm-port", type=int, default=9001)
+    parser.add_argument("--fal-port", type=int, default=9002)
+    parser.add_argument("--cert-dir", type=Path, default=Path("/tmp/loadtest-certs"))
+    parser.add_argument("--hostname", action="append", default=[], help="extra certificate hostname")
+    parser.add_argument("--model", default="Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--llm-ttft-ms", type=float, default=400)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200)
+    parser.add_argument("--llm-completion-tokens", type=int, default=120)
+    parser.add_argument("--llm-image-marker-rate", type=float, default=0.1, help="fraction of replies carrying [IMAGE: ...]")
+    parser.add_argument("--llm-image-markers", type=int, default=1, help="markers per reply that carries any")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--fal-queue-ms", type=float, default=500)
+    parser.add_argument("--fal-render-ms", type=float, default=3000, help="render time of a 28-step job")
+    parser.add_argument("--fal-error-rate", type=float, default=0.0)
+    parser.add_argument("--cdn-latency-ms", type=float, default=50)
+    parser.add_argument("--image-kb", type=int, default=300, help="payload size when Pillow is missing")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=7)
+    return parser
+
+
+async def serve(args):
+    config = StubConfig(args)
+    cert_path, key_path = write_self_signed_cert(args.cert_dir, args.hostname)
+    servers = [
+        uvicorn.Server(uvicorn.Config(create_llm_app(config), host=args.host, port=args.llm_port, log_level="warning")),
+        uvicorn.Server(uvicorn.Config(
+            create_fal_app(config), host=args.host, port=args.fal_port, log_level="warning",
+            ssl_certfile=str(cert_path), ssl_keyfile=str(key_path)
+        )),
+    ]
+    print(f"LLM stub on http://{args.host}:{args.llm_port}/v1, fal stub on https://{args.host}:{args.fal_port} (cert {cert_path})", flush=True)
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(build_parser().parse_args()))
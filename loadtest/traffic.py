@@ -0,0 +1,145 @@
+"""Request generators for each traffic class, the built-in mixes, and NDJSON replay files.
+
+A replay file has one request per line, with its offset in seconds from the start of the capture:
+
+    {"offset": 0.0, "label": "chat", "method": "POST", "path": "/api/chat", "body": {...}, "headers": {...}}
+"""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+PERSONALITIES = ["lover", "therapist", "best_friend", "fantasy_rpg", "neutral"]
+TAGS = ["romance", "adventure", "anime", "gaming", "study", "fantasy", "support"]
+SMALL_TALK = [
+    "hey, how was your day?",
+    "i couldn't sleep, can we talk for a bit",
+    "work was rough today, my manager moved the deadline again",
+    "tell me something that made you smile recently",
+    "what should i cook tonight? i have rice, eggs and spinach",
+]
+IMAGE_ASKS = [
+    "can you create a picture of a lighthouse on a cliff at dawn?",
+    "draw me an image of a cozy cabin in the snow",
+    "show me what you look like",
+    "i want a photo of us at the beach",
+]
+
+
+class PlannedRequest(NamedTuple):
+    label: str
+    method: str
+    path: str
+    body: Optional[dict]
+    headers: Dict[str, str]
+
+
+class TrafficGenerator:
+    """Synthetic requests shaped like the frontend's traffic; seeded, so runs are repeatable"""
+
+    def __init__(self, seed: int = 42, users: int = 500):
+        self.rng = random.Random(seed)
+        self.users = users
+
+    def headers(self) -> Dict[str, str]:
+        user = self.rng.randrange(self.users)
+        # Distinct users and addresses, so per-user rate limits behave as in production
+        return {"X-User-ID": f"loadtest-{user}", "X-Real-IP": f"10.{user // 250}.{user % 250}.{self.rng.randrange(1, 250)}"}
+
+    def history(self, last: str) -> List[dict]:
+        turns = self.rng.randint(1, 20)
+        messages = []
+        for i in range(turns * 2 - 1):
+            role = "user" if i % 2 == 0 else "assistant"
+            messages.append({"role": role, "content": self.rng.choice(SMALL_TALK) * self.rng.randint(1, 3)})
+        messages.append({"role": "user", "content": last})
+        return messages
+
+    def chat(self) -> PlannedRequest:
+        body = {"messages": self.history(self.rng.choice(SMALL_TALK)), "personality": self.rng.choice(PERSONALITIES), "max_tokens": 300}
+        return PlannedRequest("chat", "POST", "/api/chat", body, self.headers())
+
+    def image_turn(self) -> PlannedRequest:
+        body = {"messages": self.history(self.rng.choice(IMAGE_ASKS)), "personality": self.rng.choice(PERSONALITIES), "max_tokens": 300}
+        return PlannedRequest("image_turn", "POST", "/api/chat", body, self.headers())
+
+    def generate_image(self) -> PlannedRequest:
+        body = {"prompt": "a watercolor fox in a misty forest", "style": self.rng.choice(["realistic", "anime", "cartoon", "artistic"])}
+        return PlannedRequest("generate_image", "POST", "/api/generate_image", body, self.headers())
+
+    def proactive_poll(self) -> PlannedRequest:
+        personality = self.rng.choice(PERSONALITIES)
+        if self.rng.random() < 0.9:
+            # The frontend polls the timing check far more often than it asks for a message
+            minutes = self.rng.randint(1, 90)
+            last = (datetime.now(timezone.utc) - timedelta(minutes=minutes)).isoformat().replace("+00:00", "Z")
+            return PlannedRequest("proactive_poll", "GET", f"/api/should_send_proactive/{personality}?last_message_time={last}", None, self.headers())
+        body = {
+            "personality": personality,
+            "conversation_history": self.history(self.rng.choice(SMALL_TALK))[-6:],
+            "time_since_last_message": self.rng.randint(5, 180),
+        }
+        return PlannedRequest("proactive_message", "POST", "/api/proactive_message", body, self.headers())
+
+    def catalog(self) -> PlannedRequest:
+        roll = self.rng.random()
+        if roll < 0.6:
+            query = f"limit=20&offset={self.rng.randrange(0, 100, 20)}"
+            if self.rng.random() < 0.3:
+                query += f"&tags={self.rng.choice(TAGS)}"
+            return PlannedRequest("catalog", "GET", f"/api/personalities/public?{query}", None, self.headers())
+        if roll < 0.8:
+            return PlannedRequest("catalog", "GET", "/api/personalities/tags", None, self.headers())
+        return PlannedRequest("catalog", "GET", "/api/personalities", None, self.headers())
+
+    def seed_personality(self, index: int) -> PlannedRequest:
+        body = {
+            "id": f"loadtest_{index}",
+            "name": f"Loadtest Persona {index}",
+            "description": "A persona created by the load-test seeder",
+            "scenario": "You met at a night market and kept talking until closing time.",
+            "prompt": "A warm, curious companion who loves stories.",
+            "gender": self.rng.choice(["female", "male", "non-binary"]),
+            "tags": self.rng.sample(TAGS, 2),
+            "creator_id": f"loadtest-{index % self.users}",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        return PlannedRequest("seed", "POST", "/api/personalities/public", body, self.headers())
+
+
+# Weights per traffic class
+MIXES: Dict[str, Dict[str, float]] = {
+    "default": {"chat": 45, "image_turn": 8, "proactive_poll": 30, "catalog": 15, "generate_image": 2},
+    "chat": {"chat": 1},
+    "images": {"image_turn": 3, "generate_image": 1},
+    "proactive": {"proactive_poll": 1},
+    "catalog": {"catalog": 1},
+}
+
+
+def mix_sampler(generator: TrafficGenerator, weights: Dict[str, float]) -> Callable[[], PlannedRequest]:
+    labels = list(weights)
+    builders = [getattr(generator, label) for label in labels]
+    relative = [weights[label] for label in labels]
+
+    def sample() -> PlannedRequest:
+        return generator.rng.choices(builders, weights=relative)[0]()
+
+    return sample
+
+
+def load_replay(path: Path) -> Iterator[tuple]:
+    """(offset, PlannedRequest) pairs from an NDJSON capture, in file order"""
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield float(record["offset"]), PlannedRequest(
+                record.get("label") or record["path"].split("?")[0],
+                record.get("method", "GET").upper(),
+                record["path"],
+                record.get("body"),
+                record.get("headers") or {},
+            )